@@ -0,0 +1,262 @@
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import kernels
+import viterbi
+
+
+def random_map(rows, cols, obstacle_density, rng):
+    # Map rows in the same space-separated form parse_input produces
+    free = rng.random((rows, cols)) >= obstacle_density
+    return [' '.join('0' if cell else 'X' for cell in row) for row in free]
+
+
+def random_observations(T, rng):
+    return [format(int(v), '04b') for v in rng.integers(0, 16, size=T)]
+
+
+def time_call(fn, *args, repeat=1):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def compare_engines(free, Y, error_rate, run_reference=True, repeat=1):
+    index = viterbi.MapIndex.from_free(free)
+    Em = index.state_emission(error_rate)
+    Eg = index.grid_emission(error_rate)
+
+    row = {'K': index.states, 'T': len(Y), 'times': {}}
+    row['times']['sparse'], fast = time_call(
+        viterbi.viterbi_forward_sparse, Y, index.neighbours, index.weights, Em, repeat=repeat)
+    row['times']['grid'], grid = time_call(viterbi.viterbi_forward_grid, Y, free, Eg, repeat=repeat)
+    row['match'] = np.array_equal(grid[:, free].T, fast)
+    # The dense engines need the K x K matrix, so only run them when it
+    # fits, and they only take 2D maps
+    if run_reference and free.ndim == 2:
+        map_data = [' '.join('0' if cell else 'X' for cell in line) for line in free]
+        Tm = viterbi.transmission_matrix(map_data, free.shape[1])
+        row['times']['vectorized'], dense = time_call(
+            viterbi.viterbi_forward_vectorized, Y, Tm, Em, repeat=repeat)
+        row['times']['reference'], slow = time_call(viterbi.viterbi_forward, map_data, Y, Tm, Em)
+        row['match'] &= np.array_equal(slow, dense) and np.array_equal(slow, fast)
+    return row
+
+
+def bench_testcases(pattern, repeat):
+    results = []
+    for path in sorted(glob.glob(pattern)):
+        name = os.path.basename(path)
+        try:
+            free, observations, error_rate = viterbi.parse_input_arrays(viterbi.read_input_from_file(path))
+        except ValueError as e:
+            print(f"{name:>12}  skipped ({e})")
+            continue
+        row = compare_engines(free, observations.astype(np.int64) + 1, error_rate, repeat=repeat)
+        row['name'] = name
+        results.append(row)
+    return results
+
+
+def bench_synthetic(sizes, T, obstacle_density, reference_max_states, repeat, seed):
+    rng = np.random.default_rng(seed)
+    results = []
+    for n in sizes:
+        free = viterbi.free_grid(random_map(n, n, obstacle_density, rng))
+        Y = viterbi.binary_to_decimal(random_observations(T, rng))
+        row = compare_engines(free, Y, 0.2, run_reference=np.count_nonzero(free) <= reference_max_states,
+                              repeat=repeat)
+        row['name'] = f"{n}x{n}"
+        results.append(row)
+    return results
+
+
+def bench_backends(sizes, T, obstacle_density, repeat, seed, space='log'):
+    # NumPy vs compiled sparse forward pass (with backpointers, as --path
+    # runs it) and backtrace on large random grids
+    rng = np.random.default_rng(seed)
+    # Compile (or load the cached kernels) before anything is timed
+    warm_up = viterbi.MapIndex.from_free(np.ones((2, 2), dtype=bool))
+    for s in viterbi.SPACES:
+        viterbi.decode_path_sparse([1, 1], warm_up.neighbours, warm_up.weights, warm_up.state_emission(0.2),
+                                   warm_up.coords, s, backend='numba')
+    results = []
+    for n in sizes:
+        index = viterbi.MapIndex.from_free(rng.random((n, n)) >= obstacle_density)
+        Em = index.state_emission(0.2)
+        Y = rng.integers(1, 17, size=T)
+        row = {'name': f"{n}x{n}", 'K': index.states, 'T': T, 'times': {}}
+        paths = {}
+        for backend in ['numpy', 'numba']:
+            row['times'][backend], (trellis, backpointers) = time_call(
+                viterbi.viterbi_forward_sparse, Y, index.neighbours, index.weights, Em, space, True,
+                None, backend, repeat=repeat)
+            row['times'][backend + ' backtrace'], paths[backend] = time_call(
+                viterbi.backtrace_sparse, trellis[:, -1], backpointers, index.neighbours, None, backend, space,
+                repeat=repeat)
+        row['match'] = paths['numpy'] == paths['numba']
+        results.append(row)
+    return results
+
+
+def numba_load_seconds(processes):
+    # Time a fresh process spends in its first compiled forward pass on a
+    # tiny map: importing numba and loading the cached kernels. The best of
+    # `processes` runs, after one that fills numba's cache if it is empty.
+    script = ("import time\n"
+              "import numpy as np\n"
+              "import viterbi\n"
+              "index = viterbi.MapIndex.from_free(np.ones((2, 2), dtype=bool))\n"
+              "start = time.perf_counter()\n"
+              "viterbi.viterbi_forward_sparse([1, 1], index.neighbours, index.weights,\n"
+              "                               index.state_emission(0.2), backend='numba')\n"
+              "print(time.perf_counter() - start)\n")
+    directory = os.path.dirname(os.path.abspath(__file__))
+    times = [float(subprocess.run([sys.executable, '-c', script], cwd=directory, check=True,
+                                  capture_output=True, text=True).stdout) for _ in range(processes + 1)]
+    return min(times[1:])
+
+
+def bench_auto_threshold(sizes, T, obstacle_density, repeat, seed, processes=3):
+    # What kernels.AUTO_MIN_WORK trades off: the one-off cost of loading
+    # numba against the time its forward pass saves per state x step (prob
+    # space without backpointers, as a plain CLI run). break_even is the
+    # work at which loading numba starts to pay off.
+    load = numba_load_seconds(processes)
+    rng = np.random.default_rng(seed)
+    kernels.load()
+    results = []
+    for n in sizes:
+        index = viterbi.MapIndex.from_free(rng.random((n, n)) >= obstacle_density)
+        Em = index.state_emission(0.2)
+        Y = rng.integers(1, 17, size=T)
+        work = index.states * T
+        row = {'name': f"{n}x{n}", 'K': index.states, 'T': T, 'load': load, 'times': {}}
+        for backend in ['numpy', 'numba']:
+            row['times'][backend], _ = time_call(
+                viterbi.viterbi_forward_sparse, Y, index.neighbours, index.weights, Em, 'prob', False,
+                None, backend, repeat=repeat)
+        saved = (row['times']['numpy'] - row['times']['numba']) / work
+        row['break_even'] = load / saved if saved > 0 else float('inf')
+        results.append(row)
+    return results
+
+
+def bench_threads(sizes, T, obstacle_density, thread_counts, repeat, seed, space='log'):
+    # Threaded sparse forward pass (with backpointers) for every backend
+    # and thread count, on large random grids
+    rng = np.random.default_rng(seed)
+    backends = ['numpy', 'numba'] if kernels.available else ['numpy']
+    results = []
+    for n in sizes:
+        index = viterbi.MapIndex.from_free(rng.random((n, n)) >= obstacle_density)
+        Em = index.state_emission(0.2)
+        Y = rng.integers(1, 17, size=T)
+        row = {'name': f"{n}x{n}", 'K': index.states, 'T': T, 'times': {}}
+        for backend in backends:
+            for threads in thread_counts:
+                row['times'][backend, threads], _ = time_call(
+                    viterbi.viterbi_forward_sparse, Y, index.neighbours, index.weights, Em, space, True,
+                    None, backend, threads, repeat=repeat)
+        results.append(row)
+    return results
+
+
+def print_thread_results(results):
+    columns = list(results[0]['times']) if results else []
+    print(f"{'grid':>12} {'K':>8} {'T':>5}" + ''.join(f" {f'{b} x{t} s':>12}" for b, t in columns))
+    for row in results:
+        print(f"{row['name']:>12} {row['K']:>8} {row['T']:>5}"
+              + ''.join(f" {row['times'][column]:12.4f}" for column in columns))
+
+
+def print_threshold_results(results):
+    if results:
+        print(f"loading numba: {results[0]['load']:.3f} s, auto picks numba from "
+              f"{kernels.AUTO_MIN_WORK:.0f} states x steps")
+    print(f"{'grid':>12} {'K':>8} {'T':>5} {'numpy s':>10} {'numba s':>10} {'ns saved/cell':>14} "
+          f"{'break-even':>12}")
+    for row in results:
+        times = row['times']
+        saved = (times['numpy'] - times['numba']) / (row['K'] * row['T']) * 1e9
+        print(f"{row['name']:>12} {row['K']:>8} {row['T']:>5} {times['numpy']:10.4f} {times['numba']:10.4f} "
+              f"{saved:14.2f} {row['break_even']:12.0f}")
+
+
+def print_backend_results(results):
+    print(f"{'grid':>12} {'K':>8} {'T':>5} {'numpy s':>10} {'numba s':>10} {'speedup':>8} "
+          f"{'numpy bt s':>11} {'numba bt s':>11}  match")
+    for row in results:
+        times = row['times']
+        print(f"{row['name']:>12} {row['K']:>8} {row['T']:>5} {times['numpy']:10.4f} {times['numba']:10.4f} "
+              f"{times['numpy'] / times['numba']:8.1f} {times['numpy backtrace']:11.5f} "
+              f"{times['numba backtrace']:11.5f}  {row['match']}")
+
+
+ENGINES = ['reference', 'vectorized', 'sparse', 'grid']
+
+
+def print_results(results):
+    header = f"{'input':>12} {'K':>7} {'T':>5}" + ''.join(f" {name + ' s':>13}" for name in ENGINES)
+    print(header + f" {'speedup':>8}  match")
+    for row in results:
+        times = row['times']
+        line = f"{row['name']:>12} {row['K']:>7} {row['T']:>5}"
+        for name in ENGINES:
+            line += f" {times[name]:13.4f}" if name in times else f" {'-':>13}"
+        if 'reference' in times:
+            line += f" {times['reference'] / min(times.values()):8.1f}"
+        else:
+            line += f" {'-':>8}"
+        print(line + f"  {row.get('match', '-')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare Viterbi forward engines.")
+    parser.add_argument('--testcases', default=os.path.join(os.path.dirname(__file__) or '.',
+                                                            'assignment3-test-cases', 'ip*'))
+    parser.add_argument('--sizes', type=int, nargs='*', default=[10, 20, 40, 80, 160, 320])
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--density', type=float, default=0.25)
+    parser.add_argument('--reference-max-states', type=int, default=500,
+                        help="skip the dense engines on maps with more free cells")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend-sizes', type=int, nargs='*', default=[100, 300, 1000],
+                        help="grid sizes for the numpy vs numba sparse backend comparison")
+    parser.add_argument('--backend-steps', type=int, default=100)
+    parser.add_argument('--threads', type=int, nargs='*', default=sorted({1, 2, os.cpu_count() or 1}),
+                        help="thread counts for the threaded sparse engine comparison")
+    args = parser.parse_args()
+
+    print("assignment3 test cases")
+    print_results(bench_testcases(args.testcases, args.repeat))
+    print()
+    print("synthetic grids")
+    print_results(bench_synthetic(args.sizes, args.steps, args.density,
+                                  args.reference_max_states, args.repeat, args.seed))
+    print()
+    print("sparse backends")
+    if kernels.available:
+        print_backend_results(bench_backends(args.backend_sizes, args.backend_steps, args.density,
+                                             args.repeat, args.seed))
+        print()
+        print("numba load cost against --backend auto's threshold")
+        print_threshold_results(bench_auto_threshold(args.backend_sizes, args.backend_steps, args.density,
+                                                     args.repeat, args.seed))
+    else:
+        print("numba is not installed; skipped")
+    print()
+    print("threaded sparse engine")
+    print_thread_results(bench_threads(args.backend_sizes, args.backend_steps, args.density, args.threads,
+                                       args.repeat, args.seed))
@@ -0,0 +1,252 @@
+import argparse
+import importlib.metadata
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+
+import kernels
+import viterbi
+from benchmark import time_call
+
+# Engine benchmark on generated scenarios: random occupancy grids of any
+# size, obstacle density and dimension, with a simulated ground-truth walk
+# and its noisy readings. For every scenario and engine it records wall
+# time, peak traced memory, throughput in steps*states per second and how
+# often the engine's estimate is the true cell, and saves everything as
+# JSON so later runs can be compared against it (--baseline).
+
+
+def random_occupancy(shape, obstacle_density, rng):
+    # Boolean grid, True on free cells; always has two adjacent free cells,
+    # so simulate_walk has somewhere to walk
+    axes = [axis for axis, n in enumerate(shape) if n > 1]
+    if not axes:
+        raise ValueError(f"a {tuple(shape)} grid has no two adjacent cells")
+    free = rng.random(shape) >= obstacle_density
+    for axis in axes:
+        lower = tuple(slice(None, -1) if a == axis else slice(None) for a in range(len(shape)))
+        upper = tuple(slice(1, None) if a == axis else slice(None) for a in range(len(shape)))
+        if (free[lower] & free[upper]).any():
+            return free
+    axis = axes[rng.integers(len(axes))]
+    cell = [int(rng.integers(n)) for n in shape]
+    cell[axis] = int(rng.integers(shape[axis] - 1))
+    free[tuple(cell)] = True
+    cell[axis] += 1
+    free[tuple(cell)] = True
+    return free
+
+
+def simulate_walk(index, T, error_rate, rng):
+    # Ground truth for the HMM the engines assume: a start drawn uniformly
+    # from the cells with a free neighbour, then a uniformly random free
+    # neighbour every step, and readings with every sensor bit flipped with
+    # probability error_rate. The engines' transitions carry no mass out of
+    # a cell without free neighbours, so no walk of more than one step
+    # starts there. Returns (state ids, Y as binary_to_decimal gives it).
+    bits = index.neighbours.shape[1]
+    own = np.arange(index.states)[:, None]
+    states = np.empty(T, dtype=np.int64)
+    states[0] = rng.choice(np.flatnonzero(index.degree > 0))
+    for t in range(1, T):
+        options = index.neighbours[states[t-1]]
+        states[t] = rng.choice(options[options != own[states[t-1]]])
+    flips = rng.random((T, bits)) < error_rate
+    noise = (flips * (1 << np.arange(bits - 1, -1, -1))).sum(axis=1)
+    readings = index.signatures[states].astype(np.int64) ^ noise
+    return states, readings + 1
+
+
+def run_dense(index, Y, error_rate):
+    # The dense engine keeps no backpointers, so the path is traced back
+    # through the trellis and Tm. Probabilities underflow on long walks.
+    Tm = index.transition_matrix()
+    trellis = viterbi.viterbi_forward_vectorized(Y, Tm, index.state_emission(error_rate))
+    path = [trellis[:, -1].argmax()]
+    for j in range(trellis.shape[1] - 1, 0, -1):
+        path.append((trellis[:, j-1] * Tm[:, path[-1]]).argmax())
+    return np.array(path[::-1])
+
+
+def run_sparse(index, Y, error_rate, backend='numpy', threads=1):
+    trellis, backpointers = viterbi.viterbi_forward_sparse(
+        Y, index.neighbours, index.weights, index.state_emission(error_rate), 'log', True, None, backend, threads)
+    return np.array(viterbi.backtrace_sparse(trellis[:, -1], backpointers, index.neighbours, backend=backend))
+
+
+def run_grid(index, Y, error_rate):
+    trellis, backpointers = viterbi.viterbi_forward_grid(
+        Y, index.free, index.grid_emission(error_rate), 'log', return_backpointers=True)
+    path = viterbi.backtrace_grid(trellis[-1], backpointers)
+    return index.ids[tuple(np.array(path).T)]
+
+
+def run_beam(index, Y, error_rate, margin=10.0):
+    states, scores, directions, _ = viterbi.viterbi_forward_beam(
+        Y, index.neighbours, index.weights, index.state_emission(error_rate), margin)
+    return np.array(viterbi.backtrace_beam(states, scores, directions, index.neighbours))
+
+
+def run_checkpointed(index, Y, error_rate):
+    return np.array(viterbi.decode_path_sparse_checkpointed(
+        Y, index.neighbours, index.weights, index.state_emission(error_rate), np.arange(index.states),
+        backend='numpy'))
+
+
+def run_last_column(index, Y, error_rate):
+    # Only the final estimate is known
+    column = viterbi.viterbi_last_column_sparse(Y, index.neighbours, index.weights,
+                                                index.state_emission(error_rate), backend='numpy')
+    return np.array([column.argmax()])
+
+
+def run_filter(index, Y, error_rate, smooth=False):
+    trellis = viterbi.forward_backward_sparse(Y, index.neighbours, index.weights,
+                                              index.state_emission(error_rate), smooth=smooth)
+    return trellis.argmax(axis=0)
+
+
+# name -> (run(index, Y, error_rate) returning estimated state ids for all
+# steps or just the last, available)
+ENGINES = {
+    'dense': (run_dense, True),
+    'sparse': (run_sparse, True),
+    'sparse-numba': (lambda index, Y, e: run_sparse(index, Y, e, 'numba'), kernels.available),
+    'sparse-threaded': (lambda index, Y, e: run_sparse(index, Y, e, 'auto', None), True),
+    'grid': (run_grid, True),
+    'beam': (run_beam, True),
+    'checkpointed': (run_checkpointed, True),
+    'last-column': (run_last_column, True),
+    'filter': (run_filter, True),
+    'smooth': (lambda index, Y, e: run_filter(index, Y, e, True), True),
+}
+
+
+def parse_shape(text):
+    return tuple(int(n) for n in text.lower().split('x'))
+
+
+def peak_memory(fn, *args):
+    # Peak bytes traced while fn runs (NumPy buffers included)
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_scenario(shape, obstacle_density, error_rate, T, engines, repeat, rng, dense_max_states):
+    free = random_occupancy(shape, obstacle_density, rng)
+    index = viterbi.MapIndex.from_free(free)
+    truth, Y = simulate_walk(index, T, error_rate, rng)
+    scenario = {'shape': list(shape), 'density': obstacle_density, 'error_rate': error_rate, 'T': T,
+                'K': index.states}
+    rows = []
+    for name in engines:
+        run, available = ENGINES[name]
+        if not available or (name == 'dense' and index.states > dense_max_states):
+            continue
+        # Untimed first call, so compilation and caches are not counted
+        run(index, Y[:2], error_rate)
+        seconds, estimate = time_call(run, index, Y, error_rate, repeat=repeat)
+        correct = estimate == truth[-len(estimate):]
+        rows.append({
+            'scenario': scenario,
+            'engine': name,
+            'seconds': seconds,
+            'peak_bytes': peak_memory(run, index, Y, error_rate),
+            'throughput': T * index.states / seconds,
+            'accuracy': float(correct.mean()),
+            'final_correct': bool(correct[-1]),
+        })
+    return rows
+
+
+def result_key(row):
+    scenario = row['scenario']
+    return (tuple(scenario['shape']), scenario['density'], scenario['error_rate'], scenario['T'], row['engine'])
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    # Rows more than `tolerance` (a fraction) slower than the same
+    # scenario and engine in the baseline; scenarios are only comparable
+    # when both runs used the same seed
+    previous = {result_key(row): row for row in baseline['results']}
+    slower = []
+    for row in results:
+        old = previous.get(result_key(row))
+        if old is not None and row['seconds'] > old['seconds'] * (1 + tolerance):
+            slower.append((row, old))
+    return slower
+
+
+def print_results(results):
+    print(f"{'scenario':>22} {'K':>8} {'engine':>16} {'seconds':>9} {'peak MB':>9} "
+          f"{'Msteps*states/s':>16} {'accuracy':>9}")
+    for row in results:
+        scenario = row['scenario']
+        name = 'x'.join(map(str, scenario['shape'])) + f" T={scenario['T']}"
+        print(f"{name:>22} {scenario['K']:>8} {row['engine']:>16} {row['seconds']:9.4f} "
+              f"{row['peak_bytes'] / 1e6:9.1f} {row['throughput'] / 1e6:16.2f} {row['accuracy']:9.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the engines on generated maps and robot walks.")
+    parser.add_argument('--shapes', type=parse_shape, nargs='+', default=[(50, 50), (200, 200), (30, 30, 10)],
+                        help="map sizes such as 200x200 or 30x30x10")
+    parser.add_argument('--density', type=float, default=0.25, help="share of obstacle cells")
+    parser.add_argument('--error-rate', type=float, default=0.1)
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--engines', nargs='+', choices=list(ENGINES), default=list(ENGINES))
+    parser.add_argument('--dense-max-states', type=int, default=2000,
+                        help="skip the dense engine on maps with more free cells")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help="earlier --output file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="report engines this much slower than the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for shape in args.shapes:
+        try:
+            results.extend(bench_scenario(shape, args.density, args.error_rate, args.steps, args.engines,
+                                          args.repeat, rng, args.dense_max_states))
+        except ValueError as e:
+            parser.error(str(e))
+    print_results(results)
+
+    report = {
+        'meta': {
+            'seed': args.seed,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'numba': importlib.metadata.version('numba') if kernels.available else None,
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('seed') != args.seed:
+            print(f"baseline used seed {baseline['meta'].get('seed')}, this run {args.seed}: "
+                  "scenarios differ")
+        slower = compare_with_baseline(results, baseline, args.tolerance)
+        for row, old in slower:
+            print(f"slower than baseline: {row['engine']} on {'x'.join(map(str, row['scenario']['shape']))}: "
+                  f"{old['seconds']:.4f}s -> {row['seconds']:.4f}s")
+        if not slower:
+            print("no engine slower than the baseline")
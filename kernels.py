@@ -0,0 +1,121 @@
+import importlib.util
+import threading
+
+import numpy as np
+
+# Optional compiled kernels for the sparse engine. numba is not a
+# requirement: without it `available` is False and viterbi.py keeps to its
+# NumPy code. numba is only imported, and the functions below only
+# compiled (or loaded from numba's cache next to this file), the first
+# time the numba backend is picked, as importing numba alone takes longer
+# than a small run.
+
+BACKENDS = ['auto', 'numpy', 'numba']
+available = importlib.util.find_spec('numba') is not None
+# Loading the cached kernels takes a few tenths of a second, which the
+# compiled loop only wins back on about this many states x steps (see
+# bench_auto_threshold in benchmark.py)
+AUTO_MIN_WORK = 5_000_000
+# Set once load() has replaced the functions below with compiled ones
+loaded = False
+load_lock = threading.Lock()
+
+
+def resolve_backend(backend, work=None):
+    # 'auto' is numba when it is installed and either its kernels are
+    # already loaded or the call is big enough (work = states x steps) to
+    # repay loading them; numpy otherwise. Loads the kernels for numba.
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend!r}")
+    if backend == 'numba' and not available:
+        raise ValueError("the numba backend needs numba installed")
+    if backend == 'auto':
+        if not available:
+            return 'numpy'
+        backend = 'numba' if loaded or work is None or work >= AUTO_MIN_WORK else 'numpy'
+    if backend == 'numba':
+        load()
+    return backend
+
+
+def load():
+    global loaded, sparse_step, sparse_forward, sparse_backtrace
+    with load_lock:
+        if loaded:
+            return
+        import numba
+        jit = numba.njit(cache=True, nogil=True)
+        # sparse_forward calls sparse_step, so that one is compiled first
+        sparse_step = jit(sparse_step)
+        sparse_forward = jit(sparse_forward)
+        sparse_backtrace = jit(sparse_backtrace)
+        loaded = True
+
+
+def sparse_step(prev, out, backpointers, neighbours, weights, Em, o, lo, hi, log_space):
+    # One step of viterbi_forward_sparse for states lo..hi-1: gather,
+    # combine, max and argmax and the emission in one pass over the
+    # states, without the (K, 4) temporaries of the NumPy engine. The
+    # first maximal neighbour wins ties, like np.argmax. backpointers is
+    # the step's (K,) row, or empty to skip them. Returns the largest
+    # score written.
+    D = neighbours.shape[1]
+    keep = backpointers.shape[0] > 0
+    peak = 0.0
+    for i in range(lo, hi):
+        if log_space:
+            best = prev[neighbours[i, 0]] + weights[i, 0]
+        else:
+            best = prev[neighbours[i, 0]] * weights[i, 0]
+        direction = 0
+        for d in range(1, D):
+            if log_space:
+                candidate = prev[neighbours[i, d]] + weights[i, d]
+            else:
+                candidate = prev[neighbours[i, d]] * weights[i, d]
+            if candidate > best:
+                best = candidate
+                direction = d
+        if log_space:
+            value = best + Em[i, o]
+        else:
+            value = best * Em[i, o]
+        out[i] = value
+        if keep:
+            backpointers[i] = direction
+        if value > peak:
+            peak = value
+    return peak
+
+
+def sparse_forward(obs, neighbours, weights, Em, rows, backpointers, log_space, peaks):
+    # Steps 1..T-1 of viterbi_forward_sparse. rows is the (T, K) trellis
+    # with row 0 filled in.
+    #   backpointers  (T, K) directions, or (0, 0) to skip them
+    #   peaks         (T,) to divide every row by its maximum (the scaled
+    #                 space; rows with no positive entry get 1), or (0,)
+    T, K = rows.shape
+    keep = backpointers.shape[0] > 0
+    scale = peaks.shape[0] > 0
+    no_backpointers = backpointers.ravel()[:0]
+    for j in range(1, T):
+        out = rows[j]
+        step_backpointers = backpointers[j] if keep else no_backpointers
+        peak = sparse_step(rows[j - 1], out, step_backpointers, neighbours, weights, Em, obs[j], 0, K, log_space)
+        if scale:
+            if peak > 0:
+                for i in range(K):
+                    out[i] /= peak
+                peaks[j] = peak
+            else:
+                peaks[j] = 1.0
+
+
+def sparse_backtrace(end, backpointers, neighbours):
+    # backtrace_sparse over a (K, T) backpointer array, as a (T,) array
+    T = backpointers.shape[1]
+    path = np.empty(T, dtype=np.int64)
+    path[T - 1] = end
+    for j in range(T - 1, 0, -1):
+        path[j - 1] = neighbours[path[j], backpointers[path[j], j]]
+    return path
@@ -0,0 +1,320 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import mapfile
+import viterbi
+
+# Localization as a local service. Robots connect over TCP and send one
+# JSON object per line; every request gets one JSON line back, in the
+# order the requests were sent on that connection:
+#   {"robot": "r1", "map": "warehouse", "reading": "1011"}
+#       -> {"robot": "r1", "t": 3, "cell": [2, 5], "probability": 0.41}
+#   {"robot": "r1", "map": "warehouse", "reset": true}
+#       -> {"robot": "r1", "t": 0}
+#   anything else -> {"error": "..."}
+# Every robot keeps its own streaming column on its map, as
+# viterbi.StreamingLocalizer does: in mode 'filter' the probability is the
+# cell's forward posterior; in mode 'viterbi' the column is max-product
+# and the reply carries the best path's log score instead.
+# Requests are not computed one by one: the readings that arrive for a
+# map within one tick are applied together as a single
+# Localizer.step_batch call, run on a thread pool so the event loop keeps
+# accepting requests meanwhile.
+
+
+class MapSession:
+    # The robots on one map. Robot r's column is row rows[r] of `columns`;
+    # the arrays grow by doubling as robots join. Only the session's tick
+    # loop touches them, one batch at a time.
+
+    def __init__(self, localizer, mode, tick, executor):
+        self.localizer = localizer
+        self.mode = mode
+        self.tick = tick
+        self.executor = executor
+        self.rows = {}
+        self.columns = np.zeros((16, localizer.index.states))
+        self.steps = np.zeros(16, dtype=np.int64)
+        self.log_scale = np.zeros(16)
+        # (robot, reading index or None for a reset, future), oldest first
+        self.pending = []
+        self.wakeup = asyncio.Event()
+        self.batches = 0
+        self.updates = 0
+
+    def submit(self, robot, reading):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((robot, reading, future))
+        self.wakeup.set()
+        return future
+
+    def row(self, robot):
+        if robot not in self.rows:
+            if len(self.rows) == len(self.steps):
+                self.columns = np.concatenate([self.columns, np.zeros_like(self.columns)])
+                self.steps = np.concatenate([self.steps, np.zeros_like(self.steps)])
+                self.log_scale = np.concatenate([self.log_scale, np.zeros_like(self.log_scale)])
+            self.rows[robot] = len(self.rows)
+        return self.rows[robot]
+
+    def take_batch(self):
+        # At most one request per robot, so a robot's readings are applied
+        # in order; the rest wait for the next tick
+        batch, later, seen = [], [], set()
+        for request in self.pending:
+            if request[0] in seen:
+                later.append(request)
+            else:
+                seen.add(request[0])
+                batch.append(request)
+        self.pending = later
+        if not later:
+            self.wakeup.clear()
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            # Let the requests arriving right now join this batch
+            await asyncio.sleep(self.tick)
+            updates = []
+            for robot, reading, future in self.take_batch():
+                row = self.row(robot)
+                if reading is None:
+                    self.steps[row] = 0
+                    self.log_scale[row] = 0.0
+                    future.set_result({'robot': robot, 't': 0})
+                else:
+                    updates.append((robot, row, reading, future))
+            if not updates:
+                continue
+            rows = np.array([row for _, row, _, _ in updates])
+            readings = np.array([reading for _, _, reading, _ in updates])
+            try:
+                replies = await loop.run_in_executor(self.executor, self.step, rows, readings)
+            except Exception as e:
+                replies = [{'error': f"{type(e).__name__}: {e}"}] * len(updates)
+            for (robot, _, _, future), reply in zip(updates, replies):
+                if not future.done():
+                    future.set_result({'robot': robot, **reply})
+
+    def step(self, rows, readings):
+        # One batched update; runs on the executor
+        columns, log_scale = self.localizer.step_batch(self.columns[rows], readings, self.steps[rows] == 0,
+                                                       self.mode)
+        self.columns[rows] = columns
+        self.log_scale[rows] += log_scale
+        self.steps[rows] += 1
+        self.batches += 1
+        self.updates += len(rows)
+        best = columns.argmax(axis=1)
+        replies = []
+        for n, row in enumerate(rows):
+            reply = {'t': int(self.steps[row]), 'cell': list(self.localizer.S[best[n]])}
+            if self.mode == 'filter':
+                reply['probability'] = float(columns[n, best[n]])
+            else:
+                reply['log_score'] = float(self.log_scale[row])
+            replies.append(reply)
+        return replies
+
+
+class LocalizationServer:
+    # localizers maps names to viterbi.Localizer objects; workers is the
+    # size of the thread pool batches run on (default: one per core)
+
+    def __init__(self, localizers, mode='viterbi', tick=0.001, workers=None):
+        if mode not in ('viterbi', 'filter'):
+            raise ValueError(f"unknown mode {mode!r}")
+        self.localizers = localizers
+        self.mode = mode
+        self.tick = tick
+        self.workers = workers
+        self.sessions = {}
+        self.server = None
+        # handler task -> writer of every open connection
+        self.connections = {}
+
+    async def start(self, host='127.0.0.1', port=0):
+        # Listen on host:port (0 picks a free port); returns the port
+        self.executor = ThreadPoolExecutor(self.workers)
+        self.sessions = {name: MapSession(localizer, self.mode, self.tick, self.executor)
+                         for name, localizer in self.localizers.items()}
+        self.tasks = [asyncio.create_task(session.run()) for session in self.sessions.values()]
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.port
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        # Stop listening, close the connections once the replies already
+        # owed on them are sent, then stop the sessions
+        self.server.close()
+        for writer in list(self.connections.values()):
+            writer.close()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.executor.shutdown()
+
+    def request(self, line):
+        # Future of the reply to one request line
+        try:
+            request = json.loads(line)
+            robot, name = request['robot'], request['map']
+            if not isinstance(robot, (str, int)):
+                raise TypeError("robot must be a string or a number")
+            session = self.sessions[name]
+            reading = None
+            if not request.get('reset'):
+                reading = int(session.localizer.observations([request['reading']])[0])
+        except KeyError as e:
+            return self.done({'error': f"missing or unknown {e}"})
+        except (ValueError, TypeError) as e:
+            return self.done({'error': str(e)})
+        return session.submit(robot, reading)
+
+    def done(self, reply):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(reply)
+        return future
+
+    async def handle(self, reader, writer):
+        # Requests are read and submitted as they come; replies are written
+        # back in request order as they complete
+        replies = asyncio.Queue()
+
+        async def send_replies():
+            while (future := await replies.get()) is not None:
+                writer.write(json.dumps(await future).encode() + b'\n')
+                if replies.empty():
+                    await writer.drain()
+
+        self.connections[asyncio.current_task()] = writer
+        sender = asyncio.create_task(send_replies())
+        try:
+            while line := await reader.readline():
+                if line.strip():
+                    replies.put_nowait(self.request(line))
+        except (ConnectionError, ValueError):
+            # ValueError: a line longer than the stream's limit
+            pass
+        finally:
+            replies.put_nowait(None)
+            try:
+                await sender
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+            del self.connections[asyncio.current_task()]
+
+
+def load_localizer(path, error_rate=None, motion=None):
+    # Localizer of an input file or a map file (.rlmap); error_rate
+    # overrides the one stored in the file, motion is a MotionModel
+    if path.endswith(mapfile.SUFFIX):
+        map_file = mapfile.load_map(path)
+        return viterbi.Localizer(map_file.index(), map_file.error_rate if error_rate is None else error_rate,
+                                 motion=motion)
+    free, _, stored_rate = viterbi.parse_input_arrays(viterbi.read_input_from_file(path))
+    return viterbi.Localizer.from_free(free, stored_rate if error_rate is None else error_rate, motion=motion)
+
+
+def map_name(path):
+    name = os.path.basename(path)
+    return name[:-len(mapfile.SUFFIX)] if name.endswith(mapfile.SUFFIX) else name
+
+
+async def load_test(localizers, robots, steps, connections, mode='viterbi', tick=0.001, workers=None, seed=0):
+    # Start a server on a free localhost port and drive it with `robots`
+    # robots spread over the maps and `connections` connections, every
+    # robot sending `steps` random readings. Returns (updates per second,
+    # updates per batch).
+    server = LocalizationServer(localizers, mode, tick, workers)
+    port = await server.start()
+    rng = np.random.default_rng(seed)
+    names = list(localizers)
+
+    async def client(ids):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for _ in range(steps):
+            for robot in ids:
+                name = names[robot % len(names)]
+                bits = 2 * localizers[name].index.free.ndim
+                request = {'robot': robot, 'map': name, 'reading': format(int(rng.integers(2 ** bits)), f'0{bits}b')}
+                writer.write(json.dumps(request).encode() + b'\n')
+            await writer.drain()
+            for _ in ids:
+                reply = json.loads(await reader.readline())
+                if 'error' in reply:
+                    raise RuntimeError(reply['error'])
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(range(c, robots, connections)) for c in range(connections)))
+    elapsed = time.perf_counter() - start
+    batches = sum(session.batches for session in server.sessions.values())
+    await server.close()
+    return robots * steps / elapsed, robots * steps / max(batches, 1)
+
+
+async def serve(localizers, host, port, mode, tick, workers):
+    server = LocalizationServer(localizers, mode, tick, workers)
+    await server.start(host, port)
+    print(f"serving {', '.join(localizers)} on {host}:{server.port}", flush=True)
+    await server.server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve localization to many robots over TCP, one JSON "
+                                                 "request per line.")
+    parser.add_argument('maps', nargs='+',
+                        help="input files or map files (.rlmap); robots refer to them by file name "
+                             "(without .rlmap)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765, help="0 picks a free port")
+    parser.add_argument('--mode', choices=['viterbi', 'filter'], default='viterbi',
+                        help="viterbi: best path's end cell and log score, filter: most probable cell")
+    parser.add_argument('--error-rate', type=float, help="sensor error rate (default: the one in each file)")
+    parser.add_argument('--stay', type=float, default=0.0,
+                        help="probability that a robot stands still between readings")
+    parser.add_argument('--bias', type=float, nargs='+', metavar='W',
+                        help="relative weight of every move direction, in reading bit order")
+    parser.add_argument('--moves', type=int, default=1, help="cells a robot moves between two readings")
+    parser.add_argument('--tick', type=float, default=0.001,
+                        help="seconds to wait for more requests before running a batch")
+    parser.add_argument('--workers', type=int, help="compute threads (default: one per core)")
+    parser.add_argument('--load-test', type=int, metavar='ROBOTS',
+                        help="instead of serving, run this many simulated robots against a localhost "
+                             "server and report throughput")
+    parser.add_argument('--load-steps', type=int, default=20, help="readings per simulated robot")
+    parser.add_argument('--connections', type=int, default=8, help="client connections for --load-test")
+    args = parser.parse_args()
+
+    try:
+        motion = viterbi.MotionModel(args.stay, args.bias, args.moves)
+        localizers = {map_name(path): load_localizer(path, args.error_rate, motion) for path in args.maps}
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if args.load_test:
+        rate, batch = asyncio.run(load_test(localizers, args.load_test, args.load_steps, args.connections,
+                                            args.mode, args.tick, args.workers))
+        print(f"{args.load_test} robots x {args.load_steps} readings: {rate:.0f} updates/s, "
+              f"{batch:.1f} updates per batch")
+    else:
+        try:
+            asyncio.run(serve(localizers, args.host, args.port, args.mode, args.tick, args.workers))
+        except KeyboardInterrupt:
+            pass
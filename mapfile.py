@@ -0,0 +1,164 @@
+import argparse
+import json
+import struct
+
+import numpy as np
+
+import viterbi
+
+# Binary map/scenario format, for maps too large to re-parse per process.
+#
+#   8 bytes   MAGIC
+#   4 bytes   little-endian uint32 length of the JSON header
+#   JSON      {"version", "shape", "ndim", "states", "error_rate",
+#              "sections": {name: [offset, dtype, shape]}}
+#   sections  raw little-endian arrays, each starting on a 64-byte boundary:
+#     occupancy   uint8, np.packbits of the C-order occupancy grid
+#     cells       int64 (K,), flat C-order index of every free cell
+#     neighbours  int32 (K, 2*D), neighbour_table ids
+#     weights     float64 (K, 2*D), neighbour_table weights
+#     signatures  uint8/uint16 (K,), true reading of every free cell
+#     observations uint8/uint16 (T,), optional readings as parse_input_arrays codes
+#
+# Everything is memory-mapped read-only on load, so processes sharing one
+# file share its pages and start up without parsing or building tables.
+
+MAGIC = b'RLMAP\x00\x01\x00'
+SUFFIX = '.rlmap'
+ALIGNMENT = 64
+
+
+class MapFile:
+    # A loaded map file; array attributes are read-only np.memmap views
+
+    def __init__(self, path, header, sections):
+        self.path = path
+        self.shape = tuple(header['shape'])
+        self.ndim = header['ndim']
+        self.states = header['states']
+        self.error_rate = header['error_rate']
+        self.occupancy = sections['occupancy']
+        self.cells = sections['cells']
+        self.neighbours = sections['neighbours']
+        self.weights = sections['weights']
+        self.signatures = sections['signatures']
+        self.observations = sections.get('observations')
+
+    @property
+    def free(self):
+        # Boolean occupancy grid, unpacked on every access
+        cells = int(np.prod(self.shape))
+        return np.unpackbits(self.occupancy, count=cells).astype(bool).reshape(self.shape)
+
+    def state_emission(self, error_rate=None):
+        # viterbi.MapIndex.state_emission from the stored signatures
+        error_rate = self.error_rate if error_rate is None else error_rate
+        return viterbi.emission_table(float(error_rate), 2 * self.ndim)[self.signatures]
+
+    def index(self):
+        # viterbi.MapIndex over the memory-mapped tables
+        return viterbi.MapIndex(self.free, self.cells, self.neighbours, self.weights, self.signatures)
+
+
+def save_map(path, free, error_rate=None, observations=None, index=None):
+    # index: the map's viterbi.MapIndex, if one was already built
+    if index is None:
+        index = viterbi.MapIndex.from_free(free)
+    neighbours = index.neighbours
+    index_dtype = np.int32 if neighbours.shape[0] < 2 ** 31 else np.int64
+    sections = {
+        'occupancy': np.packbits(index.free.ravel()),
+        'cells': index.cells.astype(np.int64),
+        'neighbours': neighbours.astype(index_dtype),
+        'weights': index.weights,
+        'signatures': index.signatures,
+    }
+    if observations is not None:
+        sections['observations'] = np.asarray(observations, dtype=np.min_scalar_type(2 ** (2 * free.ndim) - 1))
+
+    header = {
+        'version': 1,
+        'shape': list(free.shape),
+        'ndim': free.ndim,
+        'states': int(neighbours.shape[0]),
+        'error_rate': None if error_rate is None else float(error_rate),
+        'sections': {},
+    }
+    # Section offsets depend on the header length and vice versa; grow the
+    # space reserved for the header until the encoded header fits
+    sections = {name: np.ascontiguousarray(array) for name, array in sections.items()}
+    header_size = ALIGNMENT
+    while True:
+        offset = header_size
+        for name, array in sections.items():
+            header['sections'][name] = [offset, array.dtype.newbyteorder('<').str, list(array.shape)]
+            offset = align(offset + array.nbytes)
+        needed = len(MAGIC) + 4 + len(json.dumps(header).encode())
+        if needed <= header_size:
+            break
+        header_size = align(needed)
+
+    encoded = json.dumps(header).encode()
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(encoded)))
+        f.write(encoded)
+        for name, array in sections.items():
+            f.seek(header['sections'][name][0])
+            array.astype(array.dtype.newbyteorder('<'), copy=False).tofile(f)
+        f.truncate(offset)
+
+
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def load_map(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path}: not a map file")
+        (length,) = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(length))
+    if header.get('version') != 1:
+        raise ValueError(f"{path}: unsupported map file version {header.get('version')}")
+
+    sections = {}
+    for name, (offset, dtype, shape) in header['sections'].items():
+        if np.prod(shape) == 0:
+            sections[name] = np.empty(shape, dtype=dtype)
+        else:
+            sections[name] = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+    return MapFile(path, header, sections)
+
+
+def load_scenario(path):
+    # Same result as viterbi.parse_input_arrays, for a map file saved with
+    # its readings and error rate
+    map_file = load_map(path)
+    if map_file.observations is None or map_file.error_rate is None:
+        raise ValueError(f"{path}: map file has no readings or error rate")
+    return map_file.free, np.asarray(map_file.observations), map_file.error_rate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert text inputs to the binary map format.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    convert = commands.add_parser('convert', help="write an input file as a map file")
+    convert.add_argument('input_file')
+    convert.add_argument('output_file')
+    convert.add_argument('--map-only', action='store_true', help="leave out the readings and error rate")
+    info = commands.add_parser('info', help="describe a map file")
+    info.add_argument('map_file')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        free, observations, error_rate = viterbi.parse_input_arrays(viterbi.read_input_from_file(args.input_file))
+        if args.map_only:
+            save_map(args.output_file, free)
+        else:
+            save_map(args.output_file, free, error_rate, observations)
+    else:
+        map_file = load_map(args.map_file)
+        print(f"shape {map_file.shape}, {map_file.states} free cells, error rate {map_file.error_rate}")
+        readings = 'none' if map_file.observations is None else len(map_file.observations)
+        print(f"readings: {readings}")
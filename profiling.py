@@ -0,0 +1,182 @@
+import functools
+import sys
+import threading
+import time
+import tracemalloc
+
+# Stage instrumentation. A stage is one coarse step of a run: reading and
+# parsing the input, building the index and the emission or transition
+# tables, the forward pass, the backtrace, preparing and writing the
+# output. Library functions are marked with @profiled(name) and other
+# blocks use `with stage(name):`.
+#
+# Every stage that finishes is passed to each callback registered with
+# subscribe(), as a dict:
+#   stage      the stage name
+#   start      time.perf_counter() when it began
+#   seconds    wall time
+#   depth      how many stages it ran inside (a checkpointed decode runs
+#              forward and backtrace stages, for instance)
+#   states, steps   map states and readings it worked on, when known
+#   allocated  bytes it allocated and still held when it ended
+#   peak       most bytes it held at once, above its starting usage
+# allocated and peak come from tracemalloc and are None unless a
+# subscriber asked for memory. With no subscribers a stage costs one
+# list check.
+
+subscribers = []
+memory_subscribers = []
+# Whether tracemalloc was started here, and so is ours to stop
+tracing = []
+# Open stages of the current thread, innermost last
+open_stages = threading.local()
+
+
+def subscribe(callback, memory=False):
+    # Call callback(record) for every stage that finishes; memory=True
+    # also traces allocations, which slows allocation-heavy stages down
+    subscribers.append(callback)
+    if memory:
+        memory_subscribers.append(callback)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            tracing.append(True)
+
+
+def unsubscribe(callback):
+    subscribers.remove(callback)
+    if callback in memory_subscribers:
+        memory_subscribers.remove(callback)
+        if not memory_subscribers and tracing:
+            tracemalloc.stop()
+            tracing.clear()
+
+
+class Stage:
+    def __init__(self, name, **counts):
+        self.name = name
+        self.counts = counts
+
+    def update(self, **counts):
+        # Counts known only once the stage has run
+        self.counts.update(counts)
+
+    def __enter__(self):
+        stack = open_stages.__dict__.setdefault('stack', [])
+        self.depth = len(stack)
+        self.memory = bool(memory_subscribers) and tracemalloc.is_tracing()
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # Hand the enclosing stage the peak it reached so far, before
+            # the peak is reset for this one
+            if stack and stack[-1].memory:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.start_memory = current
+            self.peak = current
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        stack = open_stages.stack
+        stack.pop()
+        record = {'stage': self.name, 'start': self.start, 'seconds': seconds, 'depth': self.depth,
+                  'states': self.counts.get('states'), 'steps': self.counts.get('steps'),
+                  'allocated': None, 'peak': None}
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            self.peak = max(self.peak, peak)
+            record['allocated'] = current - self.start_memory
+            record['peak'] = self.peak - self.start_memory
+            if stack and stack[-1].memory:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+        for callback in list(subscribers):
+            callback(record)
+
+
+class NoStage:
+    # What stage() returns while nobody is subscribed
+
+    def update(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_STAGE = NoStage()
+
+
+def stage(name, **counts):
+    return Stage(name, **counts) if subscribers else NO_STAGE
+
+
+def profiled(name, counts=None):
+    # Decorator that runs the function as a stage. counts(result, *args,
+    # **kwargs) returns the stage's states/steps counts; it is only called
+    # while someone is subscribed.
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not subscribers:
+                return fn(*args, **kwargs)
+            with Stage(name) as current:
+                result = fn(*args, **kwargs)
+                if counts is not None:
+                    current.update(**counts(result, *args, **kwargs))
+                return result
+        return wrapper
+    return decorate
+
+
+class ProfileReport:
+    # Subscriber that keeps every record and prints a per-stage breakdown,
+    # in order of first appearance, nested stages indented under the ones
+    # they ran in
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def summary(self):
+        # One row per (depth, stage): calls, total seconds, largest counts,
+        # summed allocations and the highest peak
+        rows = {}
+        for record in self.records:
+            key = (record['depth'], record['stage'])
+            row = rows.setdefault(key, {'stage': record['stage'], 'depth': record['depth'], 'calls': 0,
+                                        'start': record['start'], 'seconds': 0.0, 'states': None,
+                                        'steps': None, 'allocated': None, 'peak': None})
+            row['start'] = min(row['start'], record['start'])
+            row['calls'] += 1
+            row['seconds'] += record['seconds']
+            for field, merge in (('states', max), ('steps', max), ('allocated', sum), ('peak', max)):
+                if record[field] is not None:
+                    row[field] = record[field] if row[field] is None else merge((row[field], record[field]))
+        # Nested stages finish before the stage they ran in, so order the
+        # rows by when each stage first started
+        return sorted(rows.values(), key=lambda row: (row['start'], row['depth']))
+
+    def print_report(self, file=sys.stderr):
+        rows = self.summary()
+        total = sum(row['seconds'] for row in rows if row['depth'] == 0)
+        print(f"{'stage':<24} {'calls':>5} {'seconds':>10} {'share':>6} {'states':>9} {'steps':>7} "
+              f"{'alloc MB':>9} {'peak MB':>8}", file=file)
+        for row in rows:
+            name = '  ' * row['depth'] + row['stage']
+            share = f"{row['seconds'] / total:6.1%}" if total > 0 and row['depth'] == 0 else f"{'':>6}"
+            line = f"{name:<24} {row['calls']:>5} {row['seconds']:10.4f} {share}"
+            line += f" {row['states'] if row['states'] is not None else '-':>9}"
+            line += f" {row['steps'] if row['steps'] is not None else '-':>7}"
+            for field in ('allocated', 'peak'):
+                width = 9 if field == 'allocated' else 8
+                line += f" {row[field] / 1e6:{width}.2f}" if row[field] is not None else f" {'-':>{width}}"
+            print(line, file=file)
+        print(f"{'total':<24} {'':>5} {total:10.4f}", file=file)
@@ -0,0 +1,159 @@
+import argparse
+import functools
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import mapfile
+import viterbi
+
+
+# Per-worker caches of the map index and operators, so a worker that gets
+# many jobs on the same map only builds (or loads) them once
+@functools.lru_cache(maxsize=8)
+def load_index(cells, shape, cache_dir):
+    free = np.frombuffer(cells, dtype=bool).reshape(shape)
+    return viterbi.load_map_index(free, cache_dir)
+
+
+@functools.lru_cache(maxsize=8)
+def load_grid(cells, shape, error_rate, cache_dir=None):
+    index = load_index(cells, shape, cache_dir)
+    return index.free, index.grid_emission(error_rate)
+
+
+@functools.lru_cache(maxsize=8)
+def load_sparse(cells, shape, error_rate, cache_dir=None):
+    index = load_index(cells, shape, cache_dir)
+    return index.neighbours, index.weights, index.state_emission(error_rate)
+
+
+@functools.lru_cache(maxsize=8)
+def load_map_file(path):
+    # Map files are memory-mapped, so workers share one copy of the tables
+    map_file = mapfile.load_map(path)
+    return map_file, map_file.free
+
+
+def output_name(input_path):
+    # ip5 -> op5.npz, anything else -> <name>.npz
+    name = os.path.basename(input_path)
+    if name.endswith(mapfile.SUFFIX):
+        name = name[:-len(mapfile.SUFFIX)]
+    if name.startswith('ip'):
+        name = 'op' + name[2:]
+    return name + '.npz'
+
+
+def compare_maps(result, reference_path):
+    with np.load(reference_path) as data:
+        reference = [data[key] for key in data]
+    if len(reference) != len(result) or any(r.shape != m.shape for r, m in zip(reference, result)):
+        return False, float('inf')
+    max_rel = 0.0
+    for r, m in zip(reference, result):
+        scale = np.maximum(np.abs(r), np.finfo(float).tiny)
+        max_rel = max(max_rel, float((np.abs(r - m) / scale).max(initial=0.0)))
+    return all(np.allclose(m, r, rtol=1e-9, atol=0) for r, m in zip(reference, result)), max_rel
+
+
+def run_job(input_path, output_dir, reference_dir, engine, space, index_cache=None):
+    row = {'name': os.path.basename(input_path)}
+    start = time.perf_counter()
+    try:
+        map_file = None
+        if input_path.endswith(mapfile.SUFFIX):
+            map_file, free = load_map_file(input_path)
+            if map_file.observations is None or map_file.error_rate is None:
+                raise ValueError("map file has no readings or error rate")
+            observations, error_rate = np.asarray(map_file.observations), map_file.error_rate
+        else:
+            free, observations, error_rate = viterbi.parse_input_arrays(viterbi.read_input_from_file(input_path))
+        Y = observations.astype(np.int64) + 1
+        map_axes = tuple(range(1, free.ndim + 1))
+        if engine == 'grid':
+            result = viterbi.viterbi_forward_grid(
+                Y, *load_grid(free.tobytes(), free.shape, error_rate, index_cache), space)
+            if space != 'prob':
+                result = viterbi.probabilities_from_log(result, map_axes)
+        else:
+            if map_file is not None:
+                operators = map_file.neighbours, map_file.weights, map_file.state_emission()
+            else:
+                operators = load_sparse(free.tobytes(), free.shape, error_rate, index_cache)
+            trellis = viterbi.viterbi_forward_sparse(Y, *operators, space)
+            if space != 'prob':
+                trellis = viterbi.probabilities_from_log(trellis, 0)
+            result = viterbi.maps_from_states(free, trellis)
+    except (ValueError, IndexError) as e:
+        row['status'] = f"error: {type(e).__name__}: {e}"
+        row['seconds'] = time.perf_counter() - start
+        return row
+
+    name = output_name(input_path)
+    np.savez(os.path.join(output_dir, name), *result)
+    row['seconds'] = time.perf_counter() - start
+    row['T'] = len(Y)
+
+    reference_path = os.path.join(reference_dir or os.path.dirname(input_path), name)
+    if os.path.exists(reference_path):
+        match, row['max_rel_diff'] = compare_maps(result, reference_path)
+        row['status'] = 'match' if match else 'MISMATCH'
+    else:
+        row['status'] = 'no reference'
+    return row
+
+
+def expand_inputs(patterns):
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.extend(sorted(glob.glob(os.path.join(pattern, '*' + mapfile.SUFFIX))))
+            paths.extend(p for p in sorted(glob.glob(os.path.join(pattern, 'ip*')))
+                         if not p.endswith(('.npz', mapfile.SUFFIX)))
+        else:
+            paths.extend(p for p in sorted(glob.glob(pattern)) if not p.endswith('.npz'))
+    return paths
+
+
+def run_corpus(paths, output_dir, reference_dir=None, engine='grid', space='prob', workers=None,
+               index_cache=None):
+    # Fan the inputs out over a process pool. Outputs are written by the
+    # workers as each job finishes; summary rows come back in completion order.
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_job, path, output_dir, reference_dir, engine, space, index_cache) for path in paths]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Localize many input files in parallel and compare "
+                                                 "the results with reference op*.npz files.")
+    parser.add_argument('inputs', nargs='*',
+                        default=[os.path.join(os.path.dirname(__file__) or '.', 'assignment3-test-cases')],
+                        help="input files or map files (.rlmap), globs or directories "
+                             "(default: assignment3-test-cases)")
+    parser.add_argument('--output-dir', default='corpus_output')
+    parser.add_argument('--reference-dir', help="where op*.npz live (default: next to each input)")
+    parser.add_argument('--engine', choices=['grid', 'sparse'], default='grid')
+    parser.add_argument('--space', choices=viterbi.SPACES, default='prob')
+    parser.add_argument('--workers', type=int, help="worker processes (default: one per core)")
+    parser.add_argument('--index-cache', metavar='DIR',
+                        help="share map indexes between workers and runs through DIR")
+    args = parser.parse_args()
+
+    paths = expand_inputs(args.inputs)
+    start = time.perf_counter()
+    counts = {}
+    for row in run_corpus(paths, args.output_dir, args.reference_dir, args.engine, args.space, args.workers,
+                          args.index_cache):
+        diff = f"{row['max_rel_diff']:.2e}" if 'max_rel_diff' in row else '-'
+        print(f"{row['name']:>16} {row['seconds']:9.4f}s  max rel diff {diff:>9}  {row['status']}")
+        status = row['status'].split(':')[0]
+        counts[status] = counts.get(status, 0) + 1
+    elapsed = time.perf_counter() - start
+    print(f"{len(paths)} inputs in {elapsed:.2f}s: " + ', '.join(f"{n} {s}" for s, n in sorted(counts.items())))
@@ -0,0 +1,84 @@
+import glob
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import kernels  # noqa: E402
+import viterbi  # noqa: E402
+
+TESTCASES = os.path.join(ROOT, 'assignment3-test-cases')
+
+
+def header(path):
+    with open(path) as f:
+        return f.readline().split()
+
+
+INPUTS = sorted(glob.glob(os.path.join(TESTCASES, 'ip*')))
+# The dense engine and parse_input take 2D maps only
+INPUTS_2D = [path for path in INPUTS if len(header(path)) == 2]
+BACKENDS = ['numpy', 'numba'] if kernels.available else ['numpy']
+
+
+def reference_maps(input_path):
+    # op<n>.npz of ip<n> as one (T, *map shape) array
+    name = 'op' + os.path.basename(input_path)[2:] + '.npz'
+    with np.load(os.path.join(TESTCASES, name)) as data:
+        return np.array([data[f'arr_{t}'] for t in range(len(data.files))])
+
+
+def load_testcase(path):
+    # expected is the reference as a (K, T) trellis over the free cells,
+    # in state order
+    free, observations, error_rate = viterbi.parse_input_arrays(viterbi.read_input_from_file(path))
+    reference = reference_maps(path)
+    return SimpleNamespace(path=path, name=os.path.basename(path), free=free,
+                           Y=observations.astype(np.int64) + 1, error_rate=error_rate,
+                           S=[tuple(cell) for cell in np.argwhere(free).tolist()], reference=reference,
+                           expected=reference[:, free].T, index=viterbi.MapIndex.from_free(free))
+
+
+# The 2D input and the 3D one with the most readings
+TESTCASES_2D_3D = [max((path for path in INPUTS if len(header(path)) == ndim),
+                       key=lambda path: len(load_testcase(path).Y)) for ndim in (2, 3)]
+
+
+@pytest.fixture(params=INPUTS, ids=os.path.basename)
+def testcase(request):
+    return load_testcase(request.param)
+
+
+@pytest.fixture(params=INPUTS_2D, ids=os.path.basename)
+def testcase_2d(request):
+    # load_testcase plus what parse_input gives
+    testcase = load_testcase(request.param)
+    rows, cols, map_data, _, _, _ = viterbi.parse_input(viterbi.read_input_from_file(request.param))
+    testcase.rows, testcase.cols, testcase.map_data = rows, cols, map_data
+    return testcase
+
+
+def map_rows(free):
+    # A boolean occupancy grid as parse_input's map_data
+    return [' '.join('0' if cell else 'X' for cell in row) for row in free]
+
+
+def input_text(free, readings, error_rate):
+    # An input file for a 2D occupancy grid, in the assignment's format
+    return '\n'.join([' '.join(map(str, free.shape)), *map_rows(free), str(len(readings)), *readings,
+                      str(error_rate)]) + '\n'
+
+
+def to_probabilities(trellis, space):
+    # Engine output in `space` as the prob space would give it
+    return trellis if space == 'prob' else np.exp(trellis)
+
+
+def reading_strings(Y, bits):
+    # Y as binary_to_decimal gives it, back to sensor strings
+    return [format(int(y) - 1, f'0{bits}b') for y in Y]
@@ -0,0 +1,22 @@
+import os
+
+import benchmark
+from conftest import INPUTS, TESTCASES, header
+
+# The engine comparison of benchmark.py on the test cases
+
+
+def test_every_test_case_is_compared():
+    results = benchmark.bench_testcases(os.path.join(TESTCASES, 'ip*'), 1)
+    assert [row['name'] for row in results] == [os.path.basename(path) for path in INPUTS]
+    for path, row in zip(INPUTS, results):
+        assert row['match'], row['name']
+        # The dense engines only run on 2D maps
+        assert ('reference' in row['times']) == (len(header(path)) == 2)
+
+
+def test_synthetic_grids():
+    results = benchmark.bench_synthetic([5, 12], 10, 0.25, 50, 1, 0)
+    assert [row['name'] for row in results] == ['5x5', '12x12']
+    assert all(row['match'] for row in results)
+    assert 'reference' in results[0]['times'] and 'reference' not in results[1]['times']
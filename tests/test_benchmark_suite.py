@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+import benchmark_suite
+import viterbi
+
+# Generated scenarios and the benchmark rows built from them
+
+
+@pytest.mark.parametrize('shape', [(12, 9), (5, 4, 3)])
+def test_simulated_walks_follow_the_map(shape):
+    rng = np.random.default_rng(1)
+    index = viterbi.MapIndex.from_free(benchmark_suite.random_occupancy(shape, 0.3, rng))
+    states, Y = benchmark_suite.simulate_walk(index, 300, 0.0, rng)
+    assert np.array_equal(Y - 1, index.signatures[states])
+    # Every step is a move the engines' transitions allow
+    Tm = index.transition_matrix()
+    assert (Tm[states[:-1], states[1:]] > 0).all()
+
+
+@pytest.mark.parametrize('shape', [(4, 4), (1, 6), (3, 1, 1)])
+def test_blocked_maps_keep_two_adjacent_cells(shape):
+    for seed in range(5):
+        free = benchmark_suite.random_occupancy(shape, 1.0, np.random.default_rng(seed))
+        index = viterbi.MapIndex.from_free(free)
+        assert free.sum() == 2 and (index.degree == 1).all()
+        states, _ = benchmark_suite.simulate_walk(index, 10, 0.1, np.random.default_rng(seed))
+        assert len(set(states.tolist())) == 2
+
+
+def test_single_cell_maps_are_rejected():
+    with pytest.raises(ValueError):
+        benchmark_suite.random_occupancy((1, 1), 0.5, np.random.default_rng(0))
+
+
+def test_scenario_rows():
+    rng = np.random.default_rng(0)
+    engines = list(benchmark_suite.ENGINES)
+    rows = benchmark_suite.bench_scenario((10, 10), 0.2, 0.05, 30, engines, 1, rng, 2000)
+    available = [name for name in engines if benchmark_suite.ENGINES[name][1]]
+    assert [row['engine'] for row in rows] == available
+    for row in rows:
+        assert row['seconds'] > 0 and row['peak_bytes'] > 0
+        assert 0 <= row['accuracy'] <= 1
+    # The exact decoders agree on the walk
+    accuracy = {row['engine']: row['accuracy'] for row in rows}
+    assert accuracy['sparse'] == accuracy['grid'] == accuracy['checkpointed']
+
+
+def test_slower_rows_are_reported():
+    rng = np.random.default_rng(0)
+    rows = benchmark_suite.bench_scenario((8, 8), 0.2, 0.1, 10, ['sparse', 'grid'], 1, rng, 2000)
+    baseline = {'results': [dict(row, seconds=row['seconds'] / 2) for row in rows]}
+    assert len(benchmark_suite.compare_with_baseline(rows, baseline, 0.2)) == 2
+    assert benchmark_suite.compare_with_baseline(rows, {'results': rows}, 0.2) == []
@@ -0,0 +1,188 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import benchmark_suite
+import trellis_writer
+import viterbi
+from conftest import (INPUTS, INPUTS_2D, ROOT, TESTCASES, TESTCASES_2D_3D, input_text, load_testcase,
+                      reference_maps)
+
+# viterbi.py as a command, and the output modes it writes
+
+
+def run_viterbi(*args, cwd):
+    return subprocess.run([sys.executable, os.path.join(ROOT, 'viterbi.py'), *map(str, args)], cwd=cwd,
+                          capture_output=True, text=True, check=True)
+
+
+@pytest.mark.parametrize('mode', trellis_writer.OUTPUT_MODES)
+def test_output_modes_round_trip(tmp_path, mode):
+    maps = reference_maps(INPUTS[0])
+    free = load_testcase(INPUTS[0]).free
+    path = tmp_path / 'out.npz'
+    trellis_writer.write_trellis(path, free, list(maps), mode, k=3, threshold=1e-3)
+    loaded = trellis_writer.load_output(path)
+    assert loaded.shape == maps.shape
+    if mode == 'dense':
+        assert np.array_equal(loaded, maps)
+    elif mode == 'states':
+        assert np.allclose(loaded, maps, rtol=1e-6, atol=0)
+    elif mode == 'topk':
+        for step, kept in zip(maps, loaded):
+            assert np.count_nonzero(kept) <= 3
+            assert np.allclose(np.sort(kept.ravel())[-3:], np.sort(step[free])[-3:], rtol=1e-6)
+    else:
+        total = maps.sum(axis=(1, 2), keepdims=True)
+        assert np.allclose(loaded, np.where(maps >= 1e-3 * total, maps, 0.0), rtol=1e-6, atol=0)
+
+
+@pytest.mark.parametrize('space', viterbi.SPACES)
+@pytest.mark.parametrize('engine', ['grid', 'sparse', 'dense'])
+@pytest.mark.parametrize('input_path', TESTCASES_2D_3D, ids=os.path.basename)
+def test_cli_matches_reference(tmp_path, input_path, engine, space):
+    if engine == 'dense' and (space != 'prob' or input_path != TESTCASES_2D_3D[0]):
+        pytest.skip("the dense engine is 2D and prob space only")
+    run_viterbi(input_path, '--engine', engine, '--space', space, cwd=tmp_path)
+    maps = trellis_writer.load_output(tmp_path / 'output.npz')
+    assert np.allclose(maps, reference_maps(input_path), rtol=1e-9, atol=0)
+
+
+@pytest.mark.parametrize('space', viterbi.SPACES)
+@pytest.mark.parametrize('engine', ['grid', 'sparse'])
+@pytest.mark.parametrize('input_path', TESTCASES_2D_3D, ids=os.path.basename)
+def test_cli_normalize(tmp_path, input_path, engine, space):
+    run_viterbi(input_path, '--engine', engine, '--space', space, '--normalize', cwd=tmp_path)
+    maps = reference_maps(input_path)
+    axes = tuple(range(1, maps.ndim))
+    expected = maps / maps.sum(axis=axes, keepdims=True)
+    assert np.allclose(trellis_writer.load_output(tmp_path / 'output.npz'), expected, rtol=1e-9, atol=0)
+
+
+@pytest.mark.parametrize('mode', trellis_writer.OUTPUT_MODES)
+@pytest.mark.parametrize('engine', ['grid', 'sparse'])
+def test_cli_output_modes(tmp_path, engine, mode):
+    run_viterbi(INPUTS[0], '--engine', engine, '--output-mode', mode, '--top-k', 1000, '--threshold', 0,
+                cwd=tmp_path)
+    maps = trellis_writer.load_output(tmp_path / 'output.npz')
+    assert np.allclose(maps, reference_maps(INPUTS[0]), rtol=1e-6, atol=0)
+
+
+def test_cli_threshold_is_relative_to_each_step(tmp_path):
+    # The raw scores of ip5's last steps are far below the threshold
+    input_path = os.path.join(TESTCASES, 'ip5')
+    maps = reference_maps(input_path)
+    run_viterbi(input_path, '--output-mode', 'threshold', '--threshold', 0.01, cwd=tmp_path)
+    loaded = trellis_writer.load_output(tmp_path / 'output.npz')
+    share = maps / maps.sum(axis=(1, 2), keepdims=True)
+    assert np.allclose(loaded, np.where(share >= 0.01, maps, 0.0), rtol=1e-6, atol=0)
+    assert (loaded.reshape(len(loaded), -1).max(axis=1) > 0).all()
+
+
+def test_cli_threads(tmp_path):
+    run_viterbi(TESTCASES_2D_3D[1], '--engine', 'sparse', '--threads', 3, cwd=tmp_path)
+    maps = trellis_writer.load_output(tmp_path / 'output.npz')
+    assert np.allclose(maps, reference_maps(TESTCASES_2D_3D[1]), rtol=1e-9, atol=0)
+
+
+def test_cli_last_step(tmp_path):
+    run_viterbi(TESTCASES_2D_3D[1], '--engine', 'sparse', '--last-step', cwd=tmp_path)
+    maps = trellis_writer.load_output(tmp_path / 'output.npz')
+    assert np.allclose(maps, reference_maps(TESTCASES_2D_3D[1])[-1:], rtol=1e-9, atol=0)
+
+
+def test_cli_unpruned_beam(tmp_path):
+    result = run_viterbi(INPUTS[0], '--engine', 'sparse', '--beam', 10 ** 6, cwd=tmp_path)
+    assert 'error bound 0.0000 (exact)' in result.stderr
+    maps = trellis_writer.load_output(tmp_path / 'output.npz')
+    assert np.allclose(maps, reference_maps(INPUTS[0]), rtol=1e-9, atol=0)
+
+
+def test_cli_motion_model(tmp_path):
+    testcase = load_testcase(INPUTS[0])
+    run_viterbi(INPUTS[0], '--engine', 'sparse', '--stay', 0.2, '--moves', 2, cwd=tmp_path)
+    motion = viterbi.MotionModel(0.2, None, 2).compile(testcase.index)
+    trellis = viterbi.viterbi_forward_sparse(testcase.Y, motion.neighbours, motion.weights,
+                                             testcase.index.state_emission(testcase.error_rate))
+    maps = trellis_writer.load_output(tmp_path / 'output.npz')
+    assert np.allclose(maps, viterbi.maps_from_states(testcase.free, trellis), rtol=1e-9, atol=0)
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'viterbi.py'), INPUTS[0], '--stay', '0.2'],
+                            cwd=tmp_path, capture_output=True, text=True)
+    assert result.returncode == 2
+
+
+@pytest.mark.parametrize('engine', ['grid', 'sparse'])
+def test_cli_path_on_long_input(tmp_path, engine):
+    # In the prob space 2000 readings underflow to zeros; --path must still
+    # decode the most probable path rather than follow direction 0
+    rng = np.random.default_rng(4)
+    free = benchmark_suite.random_occupancy((15, 20), 0.2, rng)
+    index = viterbi.MapIndex.from_free(free)
+    truth, Y = benchmark_suite.simulate_walk(index, 2000, 0.1, rng)
+    (tmp_path / 'long').write_text(input_text(free, [format(y - 1, '04b') for y in Y], 0.1))
+    lines = run_viterbi(tmp_path / 'long', '--engine', engine, '--path', cwd=tmp_path).stdout.splitlines()
+    path = [tuple(int(c) for c in line.split()) for line in lines]
+    localizer = viterbi.Localizer(index, 0.1, space='log')
+    assert path == [tuple(cell) for cell in localizer.decode_path(list(Y))]
+    assert np.mean([cell == tuple(index.coords[s]) for cell, s in zip(path, truth)]) > 0.3
+
+
+@pytest.mark.parametrize('options', [['--engine', 'grid'], [], ['--last-step'], ['--beam', '3']])
+def test_cli_path_without_a_fitting_path(tmp_path, options):
+    (tmp_path / 'stuck').write_text(input_text(np.ones((3, 3), dtype=bool), ['0000'] * 3, 0.0))
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'viterbi.py'), 'stuck', '--path', '--engine',
+                             'sparse', *options],
+                            cwd=tmp_path, capture_output=True, text=True)
+    assert result.returncode == 2
+    assert 'no path fits the readings' in result.stderr
+
+
+@pytest.mark.parametrize('input_path', TESTCASES_2D_3D, ids=os.path.basename)
+def test_cli_path_is_a_walk(tmp_path, input_path):
+    testcase = load_testcase(input_path)
+    free = testcase.free
+    for engine in ['grid', 'sparse']:
+        lines = run_viterbi(input_path, '--engine', engine, '--path', cwd=tmp_path).stdout.splitlines()
+        path = np.array([[int(c) for c in line.split()] for line in lines])
+        assert len(path) == len(testcase.Y)
+        assert free[tuple(path.T)].all()
+        assert (np.abs(np.diff(path, axis=0)).sum(axis=1) == 1).all()
+
+
+@pytest.mark.parametrize('mode', ['filter', 'smooth'])
+@pytest.mark.parametrize('input_path', TESTCASES_2D_3D, ids=os.path.basename)
+def test_cli_posteriors_sum_to_one(tmp_path, input_path, mode):
+    for engine in ['grid', 'sparse']:
+        run_viterbi(input_path, '--engine', engine, '--mode', mode, cwd=tmp_path)
+        maps = trellis_writer.load_output(tmp_path / 'output.npz')
+        assert maps.shape == reference_maps(input_path).shape
+        assert np.allclose(maps.sum(axis=tuple(range(1, maps.ndim))), 1.0)
+
+
+@pytest.mark.parametrize('input_path', TESTCASES_2D_3D, ids=os.path.basename)
+def test_cli_batch_matches_single_runs(tmp_path, input_path):
+    for name in ('a', 'b'):
+        shutil.copy(input_path, tmp_path / name)
+    run_viterbi('a', 'b', '--space', 'log', '--index-cache', tmp_path / 'index', cwd=tmp_path)
+    for name in ('a', 'b'):
+        maps = trellis_writer.load_output(tmp_path / f'output_{name}.npz')
+        assert np.allclose(maps, reference_maps(input_path), rtol=1e-9, atol=0)
+
+
+def test_cli_dense_needs_a_2d_map(tmp_path):
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'viterbi.py'), TESTCASES_2D_3D[1], '--engine',
+                             'dense'], cwd=tmp_path, capture_output=True, text=True)
+    assert result.returncode == 2
+    assert 'only supports 2D maps' in result.stderr
+
+
+def test_cli_batch_needs_one_map(tmp_path):
+    for inputs in ([INPUTS_2D[0], INPUTS_2D[1]], TESTCASES_2D_3D):
+        result = subprocess.run([sys.executable, os.path.join(ROOT, 'viterbi.py'), *inputs], cwd=tmp_path,
+                                capture_output=True, text=True)
+        assert result.returncode == 2
+        assert 'must share the map' in result.stderr
@@ -0,0 +1,394 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import kernels
+import viterbi
+from conftest import BACKENDS, ROOT, map_rows, reading_strings, to_probabilities
+
+# Every Viterbi engine against the reference outputs op*.npz, as (K, T)
+# trellises over the free cells in state order, and against each other
+
+
+def sparse_tables(testcase):
+    index = testcase.index
+    return index.neighbours, index.weights, index.state_emission(testcase.error_rate)
+
+
+def dense_tables(testcase):
+    Tm = viterbi.transmission_matrix(testcase.map_data, testcase.cols)
+    Em = viterbi.emission_matrix(testcase.map_data, testcase.error_rate)
+    return Tm, Em
+
+
+def table_matrix(neighbours, weights):
+    # Dense Tm[from, to] of a neighbour table
+    K = neighbours.shape[0]
+    matrix = np.zeros((K, K))
+    np.add.at(matrix, (neighbours, np.broadcast_to(np.arange(K)[:, None], neighbours.shape)), weights)
+    return matrix
+
+
+def path_log_score(testcase, path):
+    # Log probability of the readings and a path of coordinates
+    ids = [int(testcase.index.ids[tuple(cell)]) for cell in path]
+    neighbours, weights, Em = sparse_tables(testcase)
+    Tm = table_matrix(neighbours, weights)
+    with np.errstate(divide='ignore'):
+        score = -np.log(len(testcase.S)) + np.log(Em[ids, testcase.Y - 1]).sum()
+        return score + np.log(Tm[ids[:-1], ids[1:]]).sum()
+
+
+def test_emission_matrix_is_the_per_state_formula(testcase_2d):
+    _, Em = dense_tables(testcase_2d)
+    e = testcase_2d.error_rate
+    for i, truth in enumerate(viterbi.actual_observation(testcase_2d.map_data)):
+        for o in range(16):
+            reading = [int(bit) for bit in format(o, '04b')]
+            d = viterbi.count_differences(truth, reading)
+            assert Em[i, o] == (1-e)**(4 - d) * e**d
+    assert not Em.flags.writeable
+    assert viterbi.emission_matrix(testcase_2d.map_data, e) is Em
+    assert np.array_equal(testcase_2d.index.state_emission(e), Em)
+
+
+def test_dense_matches_reference(testcase_2d):
+    Tm, Em = dense_tables(testcase_2d)
+    assert np.allclose(viterbi.viterbi_forward(testcase_2d.map_data, testcase_2d.Y, Tm, Em), testcase_2d.expected,
+                       rtol=1e-9, atol=0)
+    assert np.allclose(viterbi.viterbi_forward_vectorized(testcase_2d.Y, Tm, Em), testcase_2d.expected,
+                       rtol=1e-9, atol=0)
+
+
+def test_vectorized_is_the_loop_bit_for_bit(testcase_2d):
+    Tm, Em = dense_tables(testcase_2d)
+    Y = np.random.default_rng(0).integers(1, 17, size=30)
+    assert np.array_equal(viterbi.viterbi_forward_vectorized(Y, Tm, Em),
+                          viterbi.viterbi_forward(testcase_2d.map_data, Y, Tm, Em))
+
+
+def test_sparse_table_is_the_transmission_matrix(testcase_2d):
+    neighbours, weights = viterbi.sparse_transmission(testcase_2d.map_data)
+    Tm, _ = dense_tables(testcase_2d)
+    assert np.allclose(table_matrix(neighbours, weights), Tm, rtol=1e-12, atol=0)
+
+
+def test_neighbour_table_moves_one_cell(testcase):
+    neighbours, weights, _ = sparse_tables(testcase)
+    cells = np.argwhere(testcase.free)
+    offsets = np.array(viterbi.direction_offsets(testcase.free.ndim))
+    valid = weights > 0
+    # Column d holds the neighbour at offset d
+    moved = cells[neighbours] - cells[:, None, :]
+    assert np.array_equal(moved[valid], np.broadcast_to(offsets, moved.shape)[valid])
+    assert np.allclose(table_matrix(neighbours, weights).sum(axis=1)[valid.any(axis=1)], 1.0)
+
+
+@pytest.mark.parametrize('threads', [2, 3])
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_threaded_sparse_is_the_single_thread_run(testcase, backend, threads):
+    tables = sparse_tables(testcase)
+    for space in viterbi.SPACES:
+        trellis, backpointers = viterbi.viterbi_forward_sparse(testcase.Y, *tables, space, True, backend=backend)
+        threaded, threaded_backpointers = viterbi.viterbi_forward_sparse(testcase.Y, *tables, space, True,
+                                                                         backend=backend, threads=threads)
+        assert np.allclose(threaded, trellis, rtol=1e-12, atol=0)
+        assert np.array_equal(threaded_backpointers, backpointers)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('space', viterbi.SPACES)
+def test_last_column_matches_reference(testcase, space, backend):
+    column = viterbi.viterbi_last_column_sparse(testcase.Y, *sparse_tables(testcase), space, backend=backend)
+    assert np.allclose(to_probabilities(column, space), testcase.expected[:, -1], rtol=1e-9, atol=0)
+
+
+def test_unpruned_beam_matches_reference(testcase):
+    neighbours, weights, Em = sparse_tables(testcase)
+    states, scores, directions, stats = viterbi.viterbi_forward_beam(testcase.Y, neighbours, weights, Em,
+                                                                     beam=testcase.index.states)
+    trellis = viterbi.beam_trellis(states, scores, testcase.index.states)
+    assert stats['exact'] and stats['error_bound'] == 0
+    assert np.allclose(np.exp(trellis), testcase.expected, rtol=1e-9, atol=0)
+
+
+@pytest.mark.parametrize('margin, beam', [(2.0, None), (None, 3), (5.0, 8)])
+def test_pruned_beam_is_within_its_bound(testcase, margin, beam):
+    neighbours, weights, Em = sparse_tables(testcase)
+    states, scores, directions, stats = viterbi.viterbi_forward_beam(testcase.Y, neighbours, weights, Em,
+                                                                     margin, beam)
+    exact = viterbi.viterbi_forward_sparse(testcase.Y, neighbours, weights, Em, 'log')[:, -1].max()
+    if beam is not None:
+        assert max(len(step) for step in states) <= beam
+    assert 0 <= stats['pruning_ratio'] < 1
+    assert stats['best'] <= exact + 1e-9
+    assert exact <= stats['best'] + stats['error_bound'] + 1e-9
+    path = [testcase.S[i] for i in viterbi.backtrace_beam(states, scores, directions, neighbours)]
+    assert np.isclose(path_log_score(testcase, path), stats['best'], rtol=1e-9, atol=0)
+    if stats['exact']:
+        assert np.isclose(stats['best'], exact, rtol=1e-9, atol=0)
+
+
+def test_map_index_matches_the_map_builders(testcase):
+    index = testcase.index
+    neighbours, weights = viterbi.neighbour_table(testcase.free)
+    assert index.states == len(testcase.S)
+    assert np.array_equal(index.cells, np.flatnonzero(testcase.free))
+    assert [tuple(cell) for cell in index.coords.tolist()] == testcase.S
+    assert np.array_equal(index.neighbours, neighbours)
+    assert np.array_equal(index.weights, weights)
+    assert np.array_equal(index.signatures, viterbi.signature_grid(testcase.free)[testcase.free])
+    assert np.array_equal(index.ids[testcase.free], np.arange(index.states))
+    assert (index.ids[~testcase.free] == -1).all()
+    assert np.array_equal(index.degree, (weights > 0).sum(axis=1))
+    assert np.array_equal(index.transition_matrix(), table_matrix(neighbours, weights))
+    assert not index.neighbours.flags.writeable
+
+
+def test_map_index_matches_the_string_map_helpers(testcase_2d):
+    assert viterbi.state_space(testcase_2d.map_data) == testcase_2d.S
+    assert viterbi.map_index(testcase_2d.map_data) is viterbi.map_index(testcase_2d.map_data)
+    Tm, _ = dense_tables(testcase_2d)
+    assert np.array_equal(Tm, table_matrix(testcase_2d.index.neighbours, testcase_2d.index.weights))
+
+
+def test_map_index_cache(tmp_path, testcase):
+    index = viterbi.load_map_index(testcase.free, tmp_path)
+    assert os.listdir(tmp_path) == [index.key]
+    cached = viterbi.load_map_index(testcase.free, tmp_path)
+    assert isinstance(cached.neighbours, np.memmap)
+    for name in viterbi.MapIndex.FIELDS:
+        assert np.array_equal(getattr(cached, name), getattr(index, name))
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('space', viterbi.SPACES)
+def test_sparse_matches_reference(testcase, space, backend):
+    trellis = viterbi.viterbi_forward_sparse(testcase.Y, *sparse_tables(testcase), space, backend=backend)
+    assert np.allclose(to_probabilities(trellis, space), testcase.expected, rtol=1e-9, atol=0)
+
+
+def test_grid_emission_is_the_state_emission(testcase):
+    _, _, Em = sparse_tables(testcase)
+    Eg = testcase.index.grid_emission(testcase.error_rate)
+    for o in range(Em.shape[1]):
+        assert np.array_equal(Eg[o][testcase.free], Em[:, o])
+        assert not Eg[o][~testcase.free].any()
+
+
+@pytest.mark.parametrize('space', viterbi.SPACES)
+def test_grid_matches_reference(testcase, space):
+    Eg = testcase.index.grid_emission(testcase.error_rate)
+    result = viterbi.viterbi_forward_grid(testcase.Y, testcase.free, Eg, space)
+    assert np.allclose(to_probabilities(result, space), testcase.reference, rtol=1e-9, atol=0)
+
+
+@pytest.mark.parametrize('space', viterbi.SPACES)
+def test_grid_steps_stream_to_on_step(testcase, space):
+    Eg = testcase.index.grid_emission(testcase.error_rate)
+    trellis, backpointers = viterbi.viterbi_forward_grid(testcase.Y, testcase.free, Eg, space, True)
+    steps = []
+    last, streamed_backpointers = viterbi.viterbi_forward_grid(testcase.Y, testcase.free, Eg, space, True,
+                                                               on_step=lambda step: steps.append(step.copy()))
+    assert np.allclose(np.array(steps), trellis, rtol=1e-12, atol=0)
+    assert np.allclose(last, trellis[-1], rtol=1e-12, atol=0)
+    assert np.array_equal(streamed_backpointers, backpointers)
+
+
+def test_engines_agree_on_random_maps():
+    rng = np.random.default_rng(0)
+    for shape in [(12, 15), (30, 7), (6, 5, 4)]:
+        free = rng.random(shape) >= 0.3
+        index = viterbi.MapIndex.from_free(free)
+        Em = index.state_emission(0.2)
+        Eg = index.grid_emission(0.2)
+        Y = rng.integers(1, 2 ** (2 * free.ndim) + 1, size=30)
+        for space in viterbi.SPACES:
+            grid = viterbi.viterbi_forward_grid(Y, free, Eg, space)
+            sparse = viterbi.viterbi_forward_sparse(Y, *viterbi.neighbour_table(free), Em, space)
+            assert np.allclose(sparse.T, grid[:, free], rtol=1e-9, atol=0)
+            if free.ndim == 2:
+                dense = viterbi.viterbi_forward_sparse(Y, *viterbi.sparse_transmission(map_rows(free)),
+                                                       viterbi.emission_matrix(map_rows(free), 0.2), space)
+                assert np.allclose(dense, sparse, rtol=1e-12, atol=0)
+
+
+def test_log_spaces_do_not_underflow():
+    # 2000 readings underflow the prob space to zeros, not the other two
+    rng = np.random.default_rng(1)
+    free = rng.random((15, 20)) >= 0.2
+    neighbours, weights = viterbi.neighbour_table(free)
+    Em = viterbi.MapIndex.from_free(free).state_emission(0.1)
+    Y = rng.integers(1, 17, size=2000)
+    prob = viterbi.viterbi_forward_sparse(Y, neighbours, weights, Em, 'prob')
+    log = viterbi.viterbi_forward_sparse(Y, neighbours, weights, Em, 'log')
+    scaled = viterbi.viterbi_forward_sparse(Y, neighbours, weights, Em, 'scaled')
+    assert not prob[:, -1].any()
+    assert np.isfinite(log[:, -1].max())
+    assert np.allclose(scaled, log, rtol=1e-9, atol=0)
+
+
+@pytest.mark.parametrize('space', viterbi.SPACES)
+def test_backpointers_leave_the_trellis_alone(testcase, space):
+    neighbours, weights, Em = sparse_tables(testcase)
+    Eg = testcase.index.grid_emission(testcase.error_rate)
+    trellis, _ = viterbi.viterbi_forward_sparse(testcase.Y, neighbours, weights, Em, space, True)
+    assert np.array_equal(trellis, viterbi.viterbi_forward_sparse(testcase.Y, neighbours, weights, Em, space))
+    grid, _ = viterbi.viterbi_forward_grid(testcase.Y, testcase.free, Eg, space, True)
+    assert np.array_equal(grid, viterbi.viterbi_forward_grid(testcase.Y, testcase.free, Eg, space))
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_decoded_paths_are_most_probable(testcase, backend):
+    neighbours, weights, Em = sparse_tables(testcase)
+    Eg = testcase.index.grid_emission(testcase.error_rate)
+    best = viterbi.viterbi_forward_sparse(testcase.Y, neighbours, weights, Em, 'log')[:, -1].max()
+    paths = {
+        'sparse': viterbi.decode_path_sparse(testcase.Y, neighbours, weights, Em, testcase.S, backend=backend),
+        'grid': viterbi.decode_path_grid(testcase.Y, testcase.free, Eg),
+        'sparse checkpointed': viterbi.decode_path_sparse_checkpointed(testcase.Y, neighbours, weights, Em,
+                                                                       testcase.S, 2, backend),
+        'grid checkpointed': viterbi.decode_path_grid_checkpointed(testcase.Y, testcase.free, Eg, 2),
+        'default interval': viterbi.decode_path_sparse_checkpointed(testcase.Y, neighbours, weights, Em,
+                                                                    testcase.S, backend=backend),
+    }
+    for name, path in paths.items():
+        assert len(path) == len(testcase.Y), name
+        assert np.isclose(path_log_score(testcase, path), best, rtol=1e-9, atol=0), name
+
+
+@pytest.mark.parametrize('space', viterbi.SPACES)
+def test_no_path_fits_the_readings(space):
+    # Without sensor errors only the centre of a 3x3 room reads 0000, and
+    # no move leads back to it
+    index = viterbi.MapIndex.from_free(np.ones((3, 3), dtype=bool))
+    Y = [1, 1, 1]
+    Em = index.state_emission(0.0)
+    trellis, backpointers = viterbi.viterbi_forward_sparse(Y, index.neighbours, index.weights, Em, space, True)
+    score_space = 'prob' if space == 'prob' else 'log'
+    with pytest.raises(ValueError):
+        viterbi.backtrace_sparse(trellis[:, -1], backpointers, index.neighbours, space=score_space)
+    grid, backpointers = viterbi.viterbi_forward_grid(Y, index.free, index.grid_emission(0.0), space, True)
+    with pytest.raises(ValueError):
+        viterbi.backtrace_grid(grid[-1], backpointers, space=score_space)
+    with pytest.raises(ValueError):
+        viterbi.decode_path_sparse_checkpointed(Y, index.neighbours, index.weights, Em, index.coords)
+    with pytest.raises(ValueError):
+        viterbi.decode_path_grid_checkpointed(Y, index.free, index.grid_emission(0.0))
+    # Reaching the centre at the last step is fine
+    assert viterbi.decode_path_grid([1, 2, 1], index.free, index.grid_emission(0.0))[-1] == (1, 1)
+
+
+@pytest.mark.parametrize('start', [1, 2])
+def test_start_scores_resume_a_run(testcase, start):
+    neighbours, weights, Em = sparse_tables(testcase)
+    Eg = testcase.index.grid_emission(testcase.error_rate)
+    Y = testcase.Y
+    if len(Y) <= start:
+        pytest.skip("too few readings")
+    for space in viterbi.SPACES:
+        whole = viterbi.viterbi_forward_sparse(Y, neighbours, weights, Em, space)
+        rest = viterbi.viterbi_forward_sparse(Y[start - 1:], neighbours, weights, Em, space,
+                                              start_scores=whole[:, start - 1])
+        assert np.allclose(rest, whole[:, start - 1:], rtol=1e-9, atol=0)
+        grid = viterbi.viterbi_forward_grid(Y, testcase.free, Eg, space)
+        grid_rest = viterbi.viterbi_forward_grid(Y[start - 1:], testcase.free, Eg, space,
+                                                 start_scores=grid[start - 1])
+        assert np.allclose(grid_rest, grid[start - 1:], rtol=1e-9, atol=0)
+
+
+def test_batch_matches_single_runs(testcase):
+    neighbours, weights, Em = sparse_tables(testcase)
+    sequences = [testcase.Y, testcase.Y[::-1], testcase.Y[:1]]
+    for space in viterbi.SPACES:
+        batch = viterbi.viterbi_forward_batch(sequences, neighbours, weights, Em, space)
+        for Y, trellis in zip(sequences, batch):
+            single = viterbi.viterbi_forward_sparse(Y, neighbours, weights, Em, space)
+            assert np.allclose(trellis, single, rtol=1e-12, atol=0)
+
+
+def test_streaming_matches_reference(testcase):
+    localizer = viterbi.StreamingLocalizer(*sparse_tables(testcase), testcase.S)
+    for _ in range(2):
+        localizer.reset()
+        for j, y in enumerate(testcase.Y):
+            column = localizer.step(int(y)) * np.exp(localizer.log_scale)
+            assert np.allclose(column, testcase.expected[:, j], rtol=1e-9, atol=0)
+
+
+def test_streaming_from_map(testcase_2d):
+    localizer = viterbi.StreamingLocalizer.from_map(testcase_2d.map_data, testcase_2d.error_rate)
+    for j, y in enumerate(testcase_2d.Y):
+        localizer.step(int(y))
+        assert np.allclose(localizer.as_map(testcase_2d.rows, testcase_2d.cols) * np.exp(localizer.log_scale),
+                           testcase_2d.reference[j], rtol=1e-9, atol=0)
+
+
+def test_streaming_filter_is_normalized(testcase):
+    localizer = viterbi.StreamingLocalizer(*sparse_tables(testcase), testcase.S, mode='filter')
+    for reading in reading_strings(testcase.Y, 2 * testcase.free.ndim):
+        column = localizer.step(reading)
+        assert np.isclose(column.sum(), 1.0)
+
+
+def test_streaming_smoothed_path_is_most_probable(testcase):
+    T = len(testcase.Y)
+    neighbours, weights, Em = sparse_tables(testcase)
+    localizer = viterbi.StreamingLocalizer(neighbours, weights, Em, testcase.S, lag=T)
+    for y in testcase.Y:
+        localizer.step(int(y))
+    path = localizer.smoothed_path()
+    best = viterbi.viterbi_forward_sparse(testcase.Y, neighbours, weights, Em, 'log')[:, -1].max()
+    assert len(path) == T
+    assert np.isclose(path_log_score(testcase, path), best, rtol=1e-9, atol=0)
+
+
+def test_filter_and_smooth_engines_agree(testcase):
+    neighbours, weights, Em = sparse_tables(testcase)
+    Eg = testcase.index.grid_emission(testcase.error_rate)
+    for smooth in (False, True):
+        sparse = viterbi.forward_backward_sparse(testcase.Y, neighbours, weights, Em, smooth)
+        grid = viterbi.forward_backward_grid(testcase.Y, testcase.free, Eg, smooth)
+        assert np.allclose(viterbi.maps_from_states(testcase.free, sparse), grid, rtol=1e-9, atol=1e-300)
+        assert np.allclose(sparse.sum(axis=0), 1.0)
+
+
+def test_forward_backward_matches_dense_recursion(testcase):
+    neighbours, weights, Em = sparse_tables(testcase)
+    Tm = table_matrix(neighbours, weights)
+    Y = testcase.Y
+    K = Tm.shape[0]
+    alpha = [Em[:, Y[0] - 1] / K]
+    for y in Y[1:]:
+        alpha.append((alpha[-1] @ Tm) * Em[:, y - 1])
+    beta = [np.ones(K)]
+    for y in Y[:0:-1]:
+        beta.insert(0, Tm @ (Em[:, y - 1] * beta[0]))
+    alpha, beta = np.array(alpha).T, np.array(beta).T
+    filtered = alpha / alpha.sum(axis=0)
+    smoothed = alpha * beta / (alpha * beta).sum(axis=0)
+    assert np.allclose(viterbi.forward_backward_sparse(Y, neighbours, weights, Em, False), filtered)
+    assert np.allclose(viterbi.forward_backward_sparse(Y, neighbours, weights, Em, True), smoothed)
+
+
+def test_resolve_backend():
+    assert kernels.resolve_backend('numpy') == 'numpy'
+    assert kernels.resolve_backend('auto') == BACKENDS[-1]
+    with pytest.raises(ValueError):
+        kernels.resolve_backend('fortran')
+
+
+def test_auto_only_loads_numba_for_large_runs():
+    # A fresh process, as this one may have loaded the kernels already
+    script = ("import sys\n"
+              "import kernels, viterbi\n"
+              "small = kernels.resolve_backend('auto', 100)\n"
+              "print(small, 'numba' in sys.modules)\n"
+              "print(kernels.resolve_backend('auto', kernels.AUTO_MIN_WORK), 'numba' in sys.modules)\n")
+    lines = subprocess.run([sys.executable, '-c', script], cwd=ROOT, capture_output=True, text=True,
+                           check=True).stdout.splitlines()
+    assert lines[0] == 'numpy False'
+    assert lines[1] == ('numba True' if kernels.available else 'numpy False')
@@ -0,0 +1,100 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+import localization_server
+import mapfile
+import viterbi
+from conftest import TESTCASES_2D_3D, load_testcase, reading_strings
+
+# The TCP server over localhost, against StreamingLocalizer
+
+
+@pytest.fixture(scope='module')
+def scenario():
+    testcase = load_testcase(TESTCASES_2D_3D[0])
+    testcase.readings = reading_strings(testcase.Y, 2 * testcase.free.ndim)
+    return testcase
+
+
+def exchange(localizers, requests, mode='viterbi'):
+    # Send every request on one connection and return the replies, in order
+    async def run():
+        server = localization_server.LocalizationServer(localizers, mode)
+        port = await server.start()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            for request in requests:
+                line = request if isinstance(request, str) else json.dumps(request)
+                writer.write(line.encode() + b'\n')
+            await writer.drain()
+            replies = [json.loads(await reader.readline()) for _ in requests]
+            writer.close()
+            return replies
+        finally:
+            await server.close()
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('mode', ['viterbi', 'filter'])
+def test_replies_match_streaming(scenario, mode):
+    localizers = {'map': viterbi.Localizer(scenario.index, scenario.error_rate)}
+    # Two robots, the second one reset halfway
+    half = len(scenario.readings) // 2
+    requests = []
+    for reading in scenario.readings:
+        requests.append({'robot': 'a', 'map': 'map', 'reading': reading})
+        requests.append({'robot': 'b', 'map': 'map', 'reading': reading})
+    requests.insert(2 * half, {'robot': 'b', 'map': 'map', 'reset': True})
+    replies = exchange(localizers, requests, mode)
+
+    streams = {robot: viterbi.StreamingLocalizer.from_index(scenario.index, scenario.error_rate, mode)
+               for robot in 'ab'}
+    for request, reply in zip(requests, replies):
+        stream = streams[request['robot']]
+        assert reply['robot'] == request['robot']
+        if request.get('reset'):
+            stream.reset()
+            assert reply == {'robot': 'b', 't': 0}
+            continue
+        column = stream.step(request['reading'])
+        assert reply['t'] == stream.t
+        assert np.isclose(column[stream.S.index(tuple(reply['cell']))], column.max(), rtol=1e-9)
+        if mode == 'filter':
+            assert np.isclose(reply['probability'], column.max(), rtol=1e-9)
+        else:
+            assert np.isclose(reply['log_score'], stream.log_scale, rtol=1e-9)
+
+
+def test_bad_requests_get_error_replies(scenario):
+    localizers = {'map': viterbi.Localizer(scenario.index, scenario.error_rate)}
+    requests = [
+        'not json',
+        {'robot': 'a', 'reading': '0000'},
+        {'robot': 'a', 'map': 'elsewhere', 'reading': '0000'},
+        {'robot': 'a', 'map': 'map', 'reading': '000'},
+        {'robot': ['a'], 'map': 'map', 'reading': '0000'},
+        {'robot': 'a', 'map': 'map', 'reading': scenario.readings[0]},
+    ]
+    replies = exchange(localizers, requests)
+    assert all('error' in reply for reply in replies[:-1])
+    assert replies[-1]['t'] == 1
+
+
+def test_load_test(scenario):
+    localizers = {'map': viterbi.Localizer(scenario.index, scenario.error_rate)}
+    rate, batch = asyncio.run(localization_server.load_test(localizers, robots=6, steps=5, connections=2))
+    assert rate > 0
+    assert batch >= 1
+
+
+def test_load_localizer(tmp_path, scenario):
+    path = str(tmp_path / ('warehouse' + mapfile.SUFFIX))
+    mapfile.save_map(path, scenario.free, scenario.error_rate)
+    for source in (scenario.path, path):
+        localizer = localization_server.load_localizer(source, 0.05)
+        assert localizer.error_rate == 0.05
+        assert np.array_equal(localizer.index.neighbours, scenario.index.neighbours)
+    assert localization_server.map_name(path) == 'warehouse'
@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+import pytest
+
+import viterbi
+from conftest import BACKENDS, INPUTS_2D, TESTCASES_2D_3D, load_testcase, reading_strings
+
+# viterbi.Localizer, the library entry point, against the engines it wraps
+
+
+@pytest.fixture(params=TESTCASES_2D_3D, ids=os.path.basename, scope='module')
+def scenario(request):
+    testcase = load_testcase(request.param)
+    testcase.readings = reading_strings(testcase.Y, 2 * testcase.free.ndim)
+    return testcase
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('space', viterbi.SPACES)
+def test_viterbi_matches_reference(scenario, space, backend):
+    localizer = viterbi.Localizer(scenario.index, scenario.error_rate, space=space, backend=backend)
+    assert np.allclose(localizer.viterbi(scenario.readings), scenario.reference, rtol=1e-9, atol=0)
+    # Indices as binary_to_decimal gives them are readings too
+    assert np.allclose(localizer.viterbi(list(scenario.Y)), scenario.reference, rtol=1e-9, atol=0)
+    threaded = viterbi.Localizer(scenario.index, scenario.error_rate, space=space, backend=backend, threads=2)
+    assert np.allclose(threaded.viterbi(scenario.readings), scenario.reference, rtol=1e-9, atol=0)
+
+
+def test_constructors(tmp_path, scenario):
+    localizer = viterbi.Localizer.from_free(scenario.free, scenario.error_rate, cache_dir=tmp_path)
+    assert localizer.shape == scenario.free.shape
+    assert localizer.S == scenario.S
+    assert os.listdir(tmp_path) == [localizer.index.key]
+    normalized = localizer.viterbi(scenario.readings, normalize=True)
+    assert np.allclose(normalized.sum(axis=tuple(range(1, normalized.ndim))), 1.0)
+
+
+def test_from_map():
+    _, _, map_data, _, _, error_rate = viterbi.parse_input(viterbi.read_input_from_file(INPUTS_2D[0]))
+    testcase = load_testcase(INPUTS_2D[0])
+    localizer = viterbi.Localizer.from_map(map_data, error_rate)
+    assert np.allclose(localizer.viterbi(list(testcase.Y)), testcase.reference, rtol=1e-9, atol=0)
+
+
+@pytest.mark.parametrize('space', viterbi.SPACES)
+def test_missed_readings_take_the_gaps_engine(scenario, space):
+    if len(scenario.Y) < 3:
+        pytest.skip("too few readings")
+    readings = list(scenario.readings)
+    readings[1] = None
+    present = [0] + list(range(2, len(readings)))
+    Y = scenario.Y[present]
+    gaps = np.diff(present, prepend=-1)
+    motion = viterbi.MotionModel().compile(scenario.index)
+    Em = scenario.index.state_emission(scenario.error_rate)
+    expected = viterbi.viterbi_forward_gaps(Y, gaps, motion, Em, 'log', backend='numpy')
+    filtered = viterbi.forward_backward_gaps(Y, gaps, motion, Em, smooth=False)
+    for threads in (1, 2):
+        localizer = viterbi.Localizer(scenario.index, scenario.error_rate, space=space, backend='numpy',
+                                      threads=threads)
+        maps = localizer.viterbi(readings)
+        assert maps.shape == (len(Y), *scenario.free.shape)
+        assert np.allclose(maps, viterbi.maps_from_states(scenario.free, np.exp(expected)), rtol=1e-9, atol=0)
+        path = localizer.decode_path(readings)
+        assert len(path) == len(Y)
+        assert all(scenario.free[cell] for cell in path)
+        assert np.allclose(localizer.filter(readings), viterbi.maps_from_states(scenario.free, filtered))
+
+
+def test_filter_matches_forward_backward(scenario):
+    localizer = viterbi.Localizer(scenario.index, scenario.error_rate)
+    Em = scenario.index.state_emission(scenario.error_rate)
+    for smooth in (False, True):
+        trellis = viterbi.forward_backward_sparse(scenario.Y, scenario.index.neighbours, scenario.index.weights, Em,
+                                                  smooth)
+        assert np.allclose(localizer.filter(scenario.readings, smooth), viterbi.maps_from_states(scenario.free,
+                                                                                                  trellis))
+
+
+def test_decode_path_matches_the_sparse_engine(scenario):
+    localizer = viterbi.Localizer(scenario.index, scenario.error_rate, backend='numpy')
+    Em = scenario.index.state_emission(scenario.error_rate)
+    expected = viterbi.decode_path_sparse(scenario.Y, scenario.index.neighbours, scenario.index.weights, Em,
+                                          localizer.S, backend='numpy')
+    assert localizer.decode_path(scenario.readings) == expected
+
+
+@pytest.mark.parametrize('mode', ['viterbi', 'filter'])
+def test_step_batch_matches_streaming(scenario, mode):
+    localizer = viterbi.Localizer(scenario.index, scenario.error_rate)
+    streams = [viterbi.StreamingLocalizer.from_index(scenario.index, scenario.error_rate, mode) for _ in range(3)]
+    # Robot n starts n readings late, so the batch mixes first and later steps
+    columns = np.zeros((3, scenario.index.states))
+    steps = np.zeros(3, dtype=np.int64)
+    for t in range(len(scenario.Y) + 2):
+        robots = [n for n in range(3) if 0 <= t - n < len(scenario.Y)]
+        readings = [scenario.readings[t - n] for n in robots]
+        updated, _ = localizer.step_batch(columns[robots], readings, steps[robots] == 0, mode)
+        columns[robots] = updated
+        steps[robots] += 1
+        for n, reading in zip(robots, readings):
+            assert np.allclose(columns[n], streams[n].step(reading), rtol=1e-9, atol=1e-300)
+
+
+def test_bad_readings_are_rejected(scenario):
+    localizer = viterbi.Localizer(scenario.index, scenario.error_rate)
+    bits = 2 * scenario.free.ndim
+    for readings in ([], ['1' * (bits + 1)], [0], [2 ** bits + 1]):
+        with pytest.raises(ValueError):
+            localizer.observations(readings)
+
+
+def test_bad_options_are_rejected(scenario):
+    with pytest.raises(ValueError):
+        viterbi.Localizer(scenario.index, scenario.error_rate, space='linear')
+    with pytest.raises(ValueError):
+        viterbi.Localizer(scenario.index, scenario.error_rate, backend='fortran')
+    with pytest.raises(ValueError):
+        viterbi.Localizer(scenario.index, scenario.error_rate).step_batch(np.zeros((1, scenario.index.states)),
+                                                                         [scenario.readings[0]], mode='smooth')
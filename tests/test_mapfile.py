@@ -0,0 +1,87 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import mapfile
+import run_corpus
+import viterbi
+from conftest import INPUTS, ROOT, TESTCASES_2D_3D, load_testcase
+
+# Binary map files against the text inputs they were made from
+
+
+@pytest.mark.parametrize('input_path', TESTCASES_2D_3D, ids=os.path.basename)
+def test_map_round_trip(tmp_path, input_path):
+    testcase = load_testcase(input_path)
+    _, observations, _ = viterbi.parse_input_arrays(viterbi.read_input_from_file(input_path))
+    path = str(tmp_path / ('map' + mapfile.SUFFIX))
+    mapfile.save_map(path, testcase.free, testcase.error_rate, observations)
+    map_file = mapfile.load_map(path)
+    neighbours, weights = viterbi.neighbour_table(testcase.free)
+    assert map_file.shape == testcase.free.shape
+    assert map_file.states == len(testcase.S)
+    assert map_file.error_rate == testcase.error_rate
+    assert np.array_equal(map_file.free, testcase.free)
+    assert np.array_equal(map_file.cells, np.flatnonzero(testcase.free))
+    assert np.array_equal(map_file.neighbours, neighbours)
+    assert np.array_equal(map_file.weights, weights)
+    assert np.array_equal(map_file.signatures, viterbi.signature_grid(testcase.free)[testcase.free])
+    assert np.array_equal(map_file.observations, observations)
+    assert np.array_equal(map_file.state_emission(), testcase.index.state_emission(testcase.error_rate))
+    for name in viterbi.MapIndex.FIELDS:
+        assert np.array_equal(getattr(map_file.index(), name), getattr(testcase.index, name))
+
+    free, loaded, error_rate = mapfile.load_scenario(path)
+    assert np.array_equal(free, testcase.free)
+    assert np.array_equal(loaded, observations)
+    assert error_rate == testcase.error_rate
+
+
+def test_map_file_tables_give_the_same_results(tmp_path, testcase):
+    path = str(tmp_path / ('map' + mapfile.SUFFIX))
+    mapfile.save_map(path, testcase.free, testcase.error_rate)
+    map_file = mapfile.load_map(path)
+    trellis = viterbi.viterbi_forward_sparse(testcase.Y, map_file.neighbours, map_file.weights,
+                                             map_file.state_emission())
+    assert np.allclose(trellis, testcase.expected, rtol=1e-9, atol=0)
+
+
+def test_map_only_file_is_not_a_scenario(tmp_path):
+    testcase = load_testcase(INPUTS[0])
+    path = str(tmp_path / ('map' + mapfile.SUFFIX))
+    mapfile.save_map(path, testcase.free)
+    assert mapfile.load_map(path).observations is None
+    with pytest.raises(ValueError):
+        mapfile.load_scenario(path)
+
+
+def test_bad_magic_is_rejected(tmp_path):
+    path = tmp_path / ('map' + mapfile.SUFFIX)
+    path.write_bytes(b'not a map file at all')
+    with pytest.raises(ValueError):
+        mapfile.load_map(str(path))
+
+
+@pytest.mark.parametrize('engine', ['grid', 'sparse'])
+def test_corpus_of_map_files(tmp_path, engine):
+    # Converted inputs next to their references, as run_corpus finds them
+    for path in TESTCASES_2D_3D:
+        name = os.path.basename(path)
+        subprocess.run([sys.executable, os.path.join(ROOT, 'mapfile.py'), 'convert', path,
+                        tmp_path / (name + mapfile.SUFFIX)], check=True)
+        os.symlink(os.path.join(os.path.dirname(path), 'op' + name[2:] + '.npz'), tmp_path / ('op' + name[2:] + '.npz'))
+    paths = run_corpus.expand_inputs([str(tmp_path)])
+    assert len(paths) == len(TESTCASES_2D_3D)
+    rows = list(run_corpus.run_corpus(paths, tmp_path / 'out', engine=engine, workers=1))
+    assert all(row['status'] == 'match' for row in rows), rows
+
+
+def test_mapfile_info(tmp_path):
+    path = str(tmp_path / ('map' + mapfile.SUFFIX))
+    script = os.path.join(ROOT, 'mapfile.py')
+    subprocess.run([sys.executable, script, 'convert', '--map-only', INPUTS[0], path], check=True)
+    output = subprocess.run([sys.executable, script, 'info', path], capture_output=True, text=True, check=True).stdout
+    assert 'readings: none' in output
@@ -0,0 +1,181 @@
+import numpy as np
+import pytest
+
+import viterbi
+from conftest import BACKENDS
+
+# MotionModel tables and the engines over readings with gaps, against
+# dense K x K recursions
+
+GAPS = np.array([1, 1, 3, 1, 1, 2, 2, 1, 4, 1, 1, 1, 5, 1])
+MODELS = {
+    'default': viterbi.MotionModel(),
+    'stay and bias': viterbi.MotionModel(0.3, (2, 1, 1, 0.5)),
+    'two moves': viterbi.MotionModel(0.1, None, 2),
+}
+
+
+@pytest.fixture(scope='module')
+def index():
+    free = np.random.default_rng(3).random((8, 10)) >= 0.25
+    return viterbi.MapIndex.from_free(free)
+
+
+def max_product_power(P, k):
+    # P^k with max instead of sum: the likeliest path of k moves
+    result = P
+    for _ in range(k - 1):
+        result = (result[:, :, None] * P[None, :, :]).max(axis=1)
+    return result
+
+
+def dense_viterbi(Y, gaps, P, Em):
+    # (K, T) max-product trellis and best path over gaps, best moves taken
+    # through the missed readings
+    K = P.shape[0]
+    columns, backpointers = [Em[:, Y[0] - 1] / K], [None]
+    for j in range(1, len(Y)):
+        candidates = columns[-1][:, None] * max_product_power(P, gaps[j])
+        backpointers.append(candidates.argmax(axis=0))
+        columns.append(candidates.max(axis=0) * Em[:, Y[j] - 1])
+    path = [int(columns[-1].argmax())]
+    for j in range(len(Y) - 1, 0, -1):
+        path.append(int(backpointers[j][path[-1]]))
+    return np.array(columns).T, path[::-1]
+
+
+def path_score(Y, gaps, P, Em, path):
+    # Max-product score of the readings along `path`
+    score = Em[path[0], Y[0] - 1] / P.shape[0]
+    for j in range(1, len(Y)):
+        score *= max_product_power(P, gaps[j])[path[j-1], path[j]] * Em[path[j], Y[j] - 1]
+    return score
+
+
+def dense_forward_backward(Y, gaps, P, Em):
+    # Filtered and smoothed posteriors, summed over the missed readings
+    K = P.shape[0]
+    alpha = [Em[:, Y[0] - 1] / K]
+    for j in range(1, len(Y)):
+        alpha.append((alpha[-1] @ np.linalg.matrix_power(P, gaps[j])) * Em[:, Y[j] - 1])
+    beta = [np.ones(K)]
+    for j in range(len(Y) - 1, 0, -1):
+        beta.insert(0, np.linalg.matrix_power(P, gaps[j]) @ (Em[:, Y[j] - 1] * beta[0]))
+    alpha, beta = np.array(alpha).T, np.array(beta).T
+    return alpha / alpha.sum(axis=0), alpha * beta / (alpha * beta).sum(axis=0)
+
+
+def table_matrix(neighbours, weights):
+    # Dense Tm[from, to] of a neighbour table
+    K = neighbours.shape[0]
+    matrix = np.zeros((K, K))
+    np.add.at(matrix, (neighbours, np.broadcast_to(np.arange(K)[:, None], neighbours.shape)), weights)
+    return matrix
+
+
+def test_default_model_is_the_transmission_model(index):
+    motion = viterbi.MotionModel().compile(index)
+    assert np.array_equal(motion.neighbours, index.neighbours)
+    assert np.array_equal(motion.weights, index.weights)
+    assert np.array_equal(motion.transition_matrix(), index.transition_matrix())
+
+
+def test_stay_and_bias(index):
+    P = viterbi.MotionModel(0.3, (2, 1, 1, 1)).compile(index).transition_matrix()
+    assert np.allclose(np.diag(P), 0.3)
+    moving = index.degree > 0
+    assert np.allclose(P.sum(axis=1)[moving], 1.0)
+    # The north move has twice the weight of each other one
+    i = int(np.flatnonzero(index.degree == 4)[0])
+    north = int(index.ids[tuple(index.coords[i] + (-1, 0))])
+    east = int(index.ids[tuple(index.coords[i] + (0, 1))])
+    assert np.isclose(P[i, north], 2 * P[i, east])
+
+
+@pytest.mark.parametrize('bad', [dict(stay=1.5), dict(bias=(0, 0, 0, 0)), dict(bias=(-1, 1, 1, 1)),
+                                 dict(moves=0), dict(moves=1.5)])
+def test_bad_models_are_rejected(bad):
+    with pytest.raises(ValueError):
+        viterbi.MotionModel(**bad)
+
+
+@pytest.mark.parametrize('name', MODELS)
+def test_powers_match_dense_powers(index, name):
+    motion = MODELS[name].compile(index)
+    P = motion.transition_matrix()
+    for k in (2, 3, 5):
+        assert np.allclose(motion.transition_matrix(k), np.linalg.matrix_power(P, k))
+        for reduce, expected in [('sum', np.linalg.matrix_power(P, k)), ('max', max_product_power(P, k))]:
+            assert np.allclose(table_matrix(*motion.power(k, reduce)), expected, rtol=1e-12, atol=0)
+        assert np.allclose(table_matrix(*motion.transposed(k)).T, np.linalg.matrix_power(P, k))
+
+
+def test_multi_move_table_matches_single_moves(index):
+    single = viterbi.MotionModel(0.1).compile(index).transition_matrix()
+    motion = viterbi.MotionModel(0.1, None, 3).compile(index)
+    assert np.allclose(motion.transition_matrix(), np.linalg.matrix_power(single, 3))
+
+
+def test_large_powers_are_not_built():
+    index = viterbi.MapIndex.from_free(np.ones((40, 40), dtype=bool))
+    motion = viterbi.MotionModel(0.1, None, 10).compile(index)
+    # Ten moves reach up to 221 cells, twenty up to 841
+    motion.MAX_ENTRIES = 300 * index.states
+    assert motion.power(5) is None
+    assert motion.power(5, 'max') is None
+    assert motion.transposed(5) is None
+
+
+def test_power_cache_is_bounded(index):
+    motion = MODELS['default'].compile(index)
+    for k in range(2, 3 * motion.CACHE_SIZE):
+        motion.power(k)
+    assert len(motion.cache) <= motion.CACHE_SIZE
+    assert motion.power(2) is motion.power(2)
+
+
+def test_direction_dtype_holds_every_column():
+    for width, dtype in [(4, np.int8), (128, np.int8), (129, np.int16), (40000, np.int32)]:
+        assert viterbi.direction_dtype(np.zeros((1, width))) == dtype
+
+
+@pytest.mark.parametrize('one_step', [False, True], ids=['powers', 'one-step'])
+@pytest.mark.parametrize('name', MODELS)
+def test_gaps_match_dense_recursions(index, name, one_step):
+    motion = MODELS[name].compile(index)
+    if one_step:
+        # No power fits, so every gap takes one-step updates
+        motion.MAX_ENTRIES = 0
+    Em = index.state_emission(0.15)
+    Y = np.random.default_rng(5).integers(1, 17, size=len(GAPS))
+    P = motion.transition_matrix()
+    expected, _ = dense_viterbi(Y, GAPS, P, Em)
+    best = expected[:, -1].max()
+    assert best > 0
+    for backend in BACKENDS:
+        for threads in (1, 2):
+            for space in viterbi.SPACES:
+                trellis, backpointers = viterbi.viterbi_forward_gaps(Y, GAPS, motion, Em, space, True, backend,
+                                                                     threads)
+                probabilities = trellis if space == 'prob' else np.exp(trellis)
+                assert np.allclose(probabilities, expected, rtol=1e-9, atol=0)
+                # Paths may differ where moves tie, so compare their scores
+                path = viterbi.backtrace_gaps(trellis, backpointers, GAPS, motion, space, backend)
+                assert np.isclose(path_score(Y, GAPS, P, Em, path), best, rtol=1e-9, atol=0)
+
+    filtered, smoothed = dense_forward_backward(Y, GAPS, P, Em)
+    assert np.allclose(viterbi.forward_backward_gaps(Y, GAPS, motion, Em, smooth=False), filtered)
+    assert np.allclose(viterbi.forward_backward_gaps(Y, GAPS, motion, Em, smooth=True), smoothed)
+
+
+def test_gaps_of_one_are_the_sparse_engines(index):
+    motion = MODELS['stay and bias'].compile(index)
+    Em = index.state_emission(0.15)
+    Y = np.random.default_rng(6).integers(1, 17, size=20)
+    ones = np.ones(len(Y), dtype=np.int64)
+    for space in viterbi.SPACES:
+        assert np.allclose(viterbi.viterbi_forward_gaps(Y, ones, motion, Em, space, backend='numpy'),
+                           viterbi.viterbi_forward_sparse(Y, motion.neighbours, motion.weights, Em, space,
+                                                          backend='numpy'), rtol=1e-12, atol=0)
+    assert np.allclose(viterbi.forward_backward_gaps(Y, ones, motion, Em),
+                       viterbi.forward_backward_sparse(Y, motion.neighbours, motion.weights, Em))
@@ -0,0 +1,73 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+
+import mapfile
+import viterbi
+from conftest import TESTCASES, header, input_text, map_rows
+
+# parse_input_arrays against parse_input, and the inputs it rejects
+
+
+def test_matches_parse_input(testcase_2d):
+    _, _, map_data, _, observation_list, error_rate = viterbi.parse_input(
+        viterbi.read_input_from_file(testcase_2d.path))
+    assert np.array_equal(testcase_2d.free, viterbi.free_grid(map_data))
+    assert testcase_2d.Y.tolist() == viterbi.binary_to_decimal(observation_list)
+    assert testcase_2d.error_rate == float(error_rate)
+
+
+def test_multi_digit_sizes():
+    free = np.random.default_rng(0).random((12, 31)) >= 0.3
+    text = input_text(free, ['1010', '0001'], 0.25)
+    rows, columns, map_data, _, observation_list, error_rate = viterbi.parse_input(text)
+    assert (rows, columns) == (12, 31)
+    assert map_data == map_rows(free)
+    parsed, observations, _ = viterbi.parse_input_arrays(text)
+    assert np.array_equal(parsed, free)
+    assert observations.tolist() == [10, 1]
+
+
+def test_line_breaks_after_the_header_are_not_significant():
+    free = np.random.default_rng(1).random((4, 5)) >= 0.3
+    text = input_text(free, ['1010', '0001'], 0.25)
+    first, rest = text.split('\n', 1)
+    for parsed, expected in zip(viterbi.parse_input_arrays(first + '\n' + ' '.join(rest.split())),
+                                viterbi.parse_input_arrays(text)):
+        assert np.array_equal(parsed, expected)
+
+
+def test_three_dimensional_inputs():
+    for path in sorted(glob.glob(os.path.join(TESTCASES, 'ip*'))):
+        if len(header(path)) == 3:
+            free, observations, _ = viterbi.parse_input_arrays(viterbi.read_input_from_file(path))
+            assert free.shape == tuple(int(n) for n in header(path))
+            assert observations.max() < 64
+
+
+@pytest.mark.parametrize('text', [
+    'x 3\n',
+    '2 2\n0 0\n0 Y\n1\n1111\n0.1\n',
+    '2 2\n0 0\n0\n1\n1111\n0.1\n',
+    '2 2\n0 0\n0 0\n2\n1111\n0.1\n',
+    '2 2\n0 0\n0 0\n1\n111\n0.1\n',
+    '2 2\n0 0\n0 0\n1\n1121\n0.1\n',
+    '2 2\n0 0\n0 0\n1\n1111\n1.5\n',
+])
+def test_bad_inputs_are_rejected(text):
+    with pytest.raises(ValueError):
+        viterbi.parse_input_arrays(text)
+
+
+def test_five_dimensional_readings(tmp_path):
+    # 10-bit readings do not fit the uint8 codes of maps up to 4D
+    shape = (2, 2, 2, 2, 2)
+    text = ' '.join(map(str, shape)) + '\n' + ' '.join(['0'] * 32) + '\n2\n1111111111\n0000000001\n0.1\n'
+    free, observations, error_rate = viterbi.parse_input_arrays(text)
+    assert free.shape == shape and free.all()
+    assert observations.tolist() == [1023, 1]
+    path = tmp_path / ('map5d' + mapfile.SUFFIX)
+    mapfile.save_map(path, free, error_rate, observations)
+    assert mapfile.load_scenario(str(path))[1].tolist() == [1023, 1]
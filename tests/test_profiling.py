@@ -0,0 +1,74 @@
+import io
+
+import numpy as np
+import pytest
+
+import profiling
+import viterbi
+from conftest import INPUTS
+from test_cli import run_viterbi
+
+# Stage records from the profiling hooks
+
+
+@pytest.fixture
+def records():
+    collected = []
+    profiling.subscribe(collected.append)
+    yield collected
+    profiling.unsubscribe(collected.append)
+
+
+def test_stages_are_recorded(testcase, records):
+    index = testcase.index
+    Em = index.state_emission(testcase.error_rate)
+    records.clear()
+    viterbi.decode_path_sparse_checkpointed(testcase.Y, index.neighbours, index.weights, Em, testcase.S, 2)
+    stages = [(record['stage'], record['depth']) for record in records]
+    assert ('decode', 0) in stages and ('forward', 1) in stages and ('backtrace', 1) in stages
+    # Nested stages finish first
+    assert stages[-1] == ('decode', 0)
+    decode = records[-1]
+    assert decode['states'] == index.states and decode['steps'] == len(testcase.Y)
+    assert decode['allocated'] is None
+    assert decode['seconds'] >= sum(record['seconds'] for record in records if record['depth'] == 1)
+
+
+def test_nothing_is_recorded_without_subscribers(testcase):
+    collected = []
+    profiling.subscribe(collected.append)
+    profiling.unsubscribe(collected.append)
+    assert profiling.stage('forward') is profiling.NO_STAGE
+    viterbi.viterbi_forward_sparse(testcase.Y, testcase.index.neighbours, testcase.index.weights,
+                                   testcase.index.state_emission(testcase.error_rate))
+    assert collected == []
+
+
+def test_memory_records():
+    report = profiling.ProfileReport()
+    profiling.subscribe(report, memory=True)
+    try:
+        with profiling.stage('outer'):
+            with profiling.stage('inner', states=3):
+                block = np.ones(10 ** 6)
+            del block
+    finally:
+        profiling.unsubscribe(report)
+    inner, outer = report.records
+    assert inner['peak'] >= 8 * 10 ** 6 and inner['allocated'] >= 8 * 10 ** 6
+    assert outer['peak'] >= inner['peak'] and outer['allocated'] < inner['allocated']
+    rows = report.summary()
+    assert [(row['stage'], row['depth'], row['states']) for row in rows] == [('outer', 0, None), ('inner', 1, 3)]
+    out = io.StringIO()
+    report.print_report(out)
+    assert out.getvalue().splitlines()[-1].startswith('total')
+
+
+@pytest.mark.parametrize('engine', ['grid', 'sparse'])
+def test_cli_profile(tmp_path, engine):
+    report = run_viterbi(INPUTS[0], '--engine', engine, '--profile', cwd=tmp_path).stderr
+    stages = [line.split()[0] for line in report.splitlines()[1:]]
+    assert {'read', 'parse', 'forward', 'write', 'total'} <= set(stages)
+    if engine == 'grid':
+        # Steps are written as the forward pass makes them
+        assert '  write' in report and '\nwrite' in report
@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+import pytest
+
+import run_corpus
+from conftest import INPUTS, TESTCASES, reference_maps
+
+# The process-pool corpus runner
+
+
+@pytest.mark.parametrize('index_cache', [False, True])
+@pytest.mark.parametrize('engine', ['grid', 'sparse'])
+def test_corpus_matches_references(tmp_path, engine, index_cache):
+    cache_dir = str(tmp_path / 'index') if index_cache else None
+    rows = list(run_corpus.run_corpus(INPUTS, tmp_path, engine=engine, space='log', workers=2,
+                                      index_cache=cache_dir))
+    assert sorted(row['name'] for row in rows) == sorted(map(os.path.basename, INPUTS))
+    assert all(row['status'] == 'match' for row in rows), rows
+    for path in INPUTS:
+        with np.load(tmp_path / run_corpus.output_name(path)) as data:
+            assert len(data.files) == len(reference_maps(path))
+
+
+def test_mismatches_and_errors_are_reported(tmp_path):
+    references = tmp_path / 'references'
+    references.mkdir()
+    maps = reference_maps(INPUTS[0])
+    np.savez(references / run_corpus.output_name(INPUTS[0]), *(maps * 2))
+    broken = tmp_path / 'ip_broken'
+    broken.write_text("not an input\n")
+    rows = {row['name']: row for row in run_corpus.run_corpus([INPUTS[0], str(broken)], tmp_path / 'out',
+                                                              str(references), workers=1)}
+    assert rows[os.path.basename(INPUTS[0])]['status'] == 'MISMATCH'
+    assert rows['ip_broken']['status'].startswith('error')
+
+
+def test_expand_inputs():
+    assert run_corpus.expand_inputs([TESTCASES]) == sorted(
+        path for path in run_corpus.expand_inputs([os.path.join(TESTCASES, 'ip*')]))
+    assert run_corpus.output_name('/data/ip42') == 'op42.npz'
+    assert run_corpus.output_name('walk') == 'walk.npz'
@@ -0,0 +1,155 @@
+import zipfile
+
+import numpy as np
+
+from profiling import profiled
+
+# Output modes for trellis files. All of them are .npz archives that
+# np.load can open; load_output turns any of them back into dense maps.
+#   dense     - arr_0 .. arr_{T-1}, one map per step, as output.npz has always been
+#   states    - trellis (T, K) float32 over the free cells, plus cells/shape
+#   topk      - the k most probable cells of every step: cells/values (T, k)
+#   threshold - cells holding at least `threshold` of their step's total
+#               probability, CSR style: offsets (T + 1,), cells and
+#               values (nnz,)
+# cells are flat C-order indices into a map of the stored shape.
+OUTPUT_MODES = ['dense', 'states', 'topk', 'threshold']
+
+
+class NpzStreamWriter:
+    # Writes an .npz archive member by member. Arrays of known shape can
+    # be streamed a row at a time, so nothing larger than a row has to be
+    # held in memory.
+
+    def __init__(self, path, compress=False):
+        compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        self.archive = zipfile.ZipFile(path, 'w', compression=compression, allowZip64=True)
+        self.member = None
+
+    def add_array(self, name, array):
+        self.begin_array(name, array.shape, array.dtype)
+        self.write_rows(array)
+        self.end_array()
+
+    def begin_array(self, name, shape, dtype):
+        self.end_array()
+        self.member = self.archive.open(name + '.npy', 'w', force_zip64=True)
+        header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False,
+                  'shape': tuple(shape)}
+        np.lib.format.write_array_header_1_0(self.member, header)
+        self.dtype = np.dtype(dtype)
+
+    def write_rows(self, rows):
+        self.member.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+
+    def end_array(self):
+        if self.member is not None:
+            self.member.close()
+            self.member = None
+
+    def close(self):
+        self.end_array()
+        self.archive.close()
+
+
+class TrellisWriter:
+    # Streams one trellis step at a time to an .npz in one of OUTPUT_MODES.
+    # free is the occupancy grid; write_step takes either a map-shaped
+    # array or a (K,) column over the free cells in C order.
+
+    def __init__(self, path, free, T, mode='dense', k=10, threshold=1e-6, compress=None):
+        if mode not in OUTPUT_MODES:
+            raise ValueError(f"unknown output mode {mode!r}")
+        self.free = free
+        self.mode = mode
+        self.k = min(k, int(np.count_nonzero(free)))
+        self.threshold = threshold
+        self.t = 0
+        # Only the dense mode is left uncompressed by default, like np.savez
+        self.writer = NpzStreamWriter(path, mode != 'dense' if compress is None else compress)
+        self.cells = np.flatnonzero(free)
+
+        if mode != 'dense':
+            self.writer.add_array('shape', np.array(free.shape, dtype=np.int64))
+        if mode == 'states':
+            self.writer.add_array('cells', self.cells)
+            self.writer.begin_array('trellis', (T, len(self.cells)), np.float32)
+        elif mode == 'topk':
+            self.values = []
+            self.writer.begin_array('cells', (T, self.k), np.int64)
+        elif mode == 'threshold':
+            self.offsets = [0]
+            self.kept_cells = []
+            self.kept_values = []
+
+    def write_step(self, step):
+        step = np.asarray(step)
+        column = step[self.free] if step.shape == self.free.shape else step
+        if self.mode == 'dense':
+            result = np.zeros(self.free.shape)
+            result[self.free] = column
+            self.writer.add_array(f'arr_{self.t}', result)
+        elif self.mode == 'states':
+            self.writer.write_rows(column)
+        elif self.mode == 'topk':
+            top = np.argpartition(column, len(column) - self.k)[len(column) - self.k:]
+            top = top[np.argsort(column[top])[::-1]]
+            self.writer.write_rows(self.cells[top])
+            self.values.append(column[top].astype(np.float32))
+        else:
+            # Relative to the step's sum, so raw Viterbi scores (which
+            # shrink every step) keep as many cells as normalized ones
+            kept = np.flatnonzero((column > 0) & (column >= self.threshold * column.sum()))
+            self.kept_cells.append(self.cells[kept])
+            self.kept_values.append(column[kept].astype(np.float32))
+            self.offsets.append(self.offsets[-1] + len(kept))
+        self.t += 1
+
+    def close(self):
+        # topk values are T x k, small next to the map; threshold output is
+        # only as large as the cells it kept
+        if self.mode == 'topk':
+            self.writer.add_array('values', np.array(self.values, dtype=np.float32).reshape(-1, self.k))
+        elif self.mode == 'threshold':
+            self.writer.add_array('offsets', np.array(self.offsets, dtype=np.int64))
+            self.writer.add_array('cells', np.concatenate(self.kept_cells or [np.zeros(0, np.int64)]))
+            self.writer.add_array('values', np.concatenate(self.kept_values or [np.zeros(0, np.float32)]))
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@profiled('write', lambda result, path, free, steps, *args, **kwargs: {'states': int(np.count_nonzero(free)),
+                                                                       'steps': len(steps)})
+def write_trellis(path, free, steps, mode='dense', **kwargs):
+    # Write an iterable of steps (a (T, *map shape) array, or a list of
+    # columns) with a TrellisWriter
+    with TrellisWriter(path, free, len(steps), mode, **kwargs) as writer:
+        for step in steps:
+            writer.write_step(step)
+
+
+def load_output(path):
+    # Dense (T, *map shape) maps from a file in any of OUTPUT_MODES
+    with np.load(path) as data:
+        if 'shape' not in data:
+            return np.array([data[f'arr_{t}'] for t in range(len(data.files))])
+        shape = tuple(data['shape'])
+        if 'trellis' in data:
+            trellis = data['trellis']
+            maps = np.zeros((trellis.shape[0], int(np.prod(shape))))
+            maps[:, data['cells']] = trellis
+        elif 'offsets' in data:
+            offsets = data['offsets']
+            maps = np.zeros((len(offsets) - 1, int(np.prod(shape))))
+            steps = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+            maps[steps, data['cells']] = data['values']
+        else:
+            cells = data['cells']
+            maps = np.zeros((cells.shape[0], int(np.prod(shape))))
+            np.put_along_axis(maps, cells, data['values'], axis=1)
+    return maps.reshape((-1,) + shape)
@@ -1,21 +1,149 @@
-import numpy as np
+import argparse
+import collections
+import functools
+import hashlib
+import os
+import shutil
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import kernels
+import profiling
+import trellis_writer
+from profiling import profiled
+
+
+# Stage counts for profiling.profiled, from the stages' results and arguments
+def parse_counts(result, *args, **kwargs):
+    if isinstance(result[0], np.ndarray):
+        return {'states': int(np.count_nonzero(result[0])), 'steps': len(result[1])}
+    return {'states': sum(row.split().count('0') for row in result[2]), 'steps': len(result[4])}
+
+
+def row_counts(result, *args, **kwargs):
+    # K x K transition and K x 2^bits emission matrices
+    return {'states': result.shape[0]}
+
+
+def index_counts(result, *args, **kwargs):
+    return {'states': result.states}
+
+
+def trellis_counts(result, *args, **kwargs):
+    return {'states': result.shape[0], 'steps': result.shape[1]}
+
+
+def sparse_counts(result, Y, neighbours, *args, **kwargs):
+    return {'states': neighbours.shape[0], 'steps': len(Y)}
+
+
+def gap_counts(result, Y, gaps, motion, *args, **kwargs):
+    return {'states': motion.neighbours.shape[0], 'steps': len(Y)}
+
+
+def grid_counts(result, Y, free, *args, **kwargs):
+    return {'states': int(np.count_nonzero(free)), 'steps': len(Y)}
 
+
+def batch_counts(result, sequences, neighbours, *args, **kwargs):
+    return {'states': neighbours.shape[0], 'steps': sum(len(Y) for Y in sequences)}
+
+
+def path_counts(result, *args, **kwargs):
+    return {'steps': len(result)}
+
+
+def output_counts(result, *args, **kwargs):
+    # prepare_output and maps_from_states, whose last argument is the trellis
+    return trellis_counts(args[-1])
+
+
+@profiled('parse', parse_counts)
 def parse_input(input_str):
-    lines = input_str.split('\n')
-    rows = int(lines[0][0])
-    columns = int(lines[0][-1])
+    lines = input_str.strip().split('\n')
+    header = lines[0].split()
+    rows = int(header[0])
+    columns = int(header[1])
     map_data = []
     for i in range(1,rows+1):
-        map_data.append(lines[i].strip(' '))
-    no_of_observations = lines[rows+1]
-    observation_list = lines[rows+2:-1]
-    error_rate = lines[-1]
+        map_data.append(lines[i].strip())
+    no_of_observations = lines[rows+1].strip()
+    observation_list = [line.strip() for line in lines[rows+2:-1]]
+    error_rate = lines[-1].strip()
 
     return rows, columns, map_data, no_of_observations, observation_list, error_rate
     # print(rows, '|', columns,'|', map_data,'|', no_of_observations, '|',observation_list,'|', error_rate)
 
 
+def parse_map_shape(input_str):
+    # The map shape from the header line of an input
+    header, _, _ = input_str.lstrip().partition('\n')
+    try:
+        shape = tuple(int(v) for v in header.split())
+    except ValueError:
+        raise ValueError(f"bad map size line {header!r}") from None
+    if not shape or any(v <= 0 for v in shape):
+        raise ValueError(f"bad map size line {header!r}")
+    return shape
+
+
+@profiled('parse', parse_counts)
+def parse_input_arrays(input_str):
+    # Tokenizing parser that goes straight to NumPy. The header holds the
+    # map shape (rows cols, or rows cols layers, ...); the map follows as
+    # prod(shape) 'X'/'0' tokens, then the number of readings, the readings
+    # (2 bits per map dimension) and the error rate. Line breaks are not
+    # significant. Each map row lists layer 0 of all columns, then layer 1,
+    # and so on. Returns (free, observations, error_rate): a boolean
+    # occupancy grid of that shape, True on traversable cells, the readings
+    # as codes (binary_to_decimal minus one; uint8 up to 4D, wider above)
+    # and the error rate.
+    shape = parse_map_shape(input_str)
+    tokens = input_str.split()
+    D = len(shape)
+    cells = int(np.prod(shape))
+
+    map_tokens = tokens[D:D + cells]
+    cell_chars = ''.join(map_tokens)
+    if len(map_tokens) != cells or len(cell_chars) != cells:
+        raise ValueError(f"expected {cells} single-character map cells")
+    cell_codes = np.frombuffer(cell_chars.encode('ascii', 'replace'), dtype=np.uint8)
+    free = (cell_codes == ord('0')) | (cell_codes == ord('O'))
+    if not np.all(free | (cell_codes == ord('X'))):
+        raise ValueError("map cells must be 'X', '0' or 'O'")
+
+    position = D + cells
+    try:
+        n = int(tokens[position])
+    except (IndexError, ValueError):
+        raise ValueError("missing number of observations after the map") from None
+    readings = tokens[position + 1:position + 1 + n]
+    if len(readings) != n or len(tokens) != position + n + 2:
+        raise ValueError(f"expected {n} observations followed by the error rate")
+    error_rate = float(tokens[-1])
+    if not 0 <= error_rate <= 1:
+        raise ValueError(f"error rate {error_rate} is not a probability")
+
+    bits = 2 * D
+    reading_chars = ''.join(readings)
+    if len(reading_chars) != n * bits or any(len(r) != bits for r in readings):
+        raise ValueError(f"observations must be {bits}-bit strings")
+    reading_bits = np.frombuffer(reading_chars.encode('ascii', 'replace'), dtype=np.uint8) - ord('0')
+    if np.any(reading_bits > 1):
+        raise ValueError("observations must only contain '0' and '1'")
+    code_dtype = np.min_scalar_type(2 ** bits - 1)
+    place_values = 1 << np.arange(bits - 1, -1, -1, dtype=code_dtype)
+    observations = (reading_bits.reshape(n, bits) * place_values).sum(axis=1, dtype=code_dtype)
+
+    # Within a row the column index varies fastest, then the layers
+    free = free.reshape(shape[:1] + shape[:0:-1]).transpose((0,) + tuple(range(D - 1, 0, -1)))
+    return np.ascontiguousarray(free), observations, error_rate
+
+
 def binary_to_decimal(given_list):
     decimal_numbers = [int(binary_str, 2) + 1 for binary_str in given_list]
     return decimal_numbers
@@ -41,43 +169,472 @@ def observation_space_to_list(observation_space_binary_strings):
 
 
 def state_space(map_data):
-    state_space_list = []
-    for x, line in enumerate(map_data):
-        index_list = line.split(' ')
-        for y, index in enumerate(index_list):
-            if index == '0':
-                state_space_list.append((x,y))
-    return state_space_list
+    # Coordinates of the '0's in the map, in state id order
+    return [tuple(coord) for coord in map_index(map_data).coords.tolist()]
 
 
+@profiled('transmission', row_counts)
 def transmission_matrix(map_data, cols):
-    # S is the coordinates of the 'O's in the map
-    S = state_space(map_data)
-    K = len(S)
-    # print('K', K)
-    # print('S', S)
-    rows = len(map_data)
-    map_data = [row.split() for row in map_data]
+    # Tm[i, j] = 1/deg(i) for every neighbour j of state i, see
+    # MapIndex.transition_matrix; the map rows give the column count.
+    # MotionOperator.transition_matrix gives it for other MotionModels.
+    return map_index(map_data).transition_matrix()
+
+
+def direction_offsets(D):
+    # Unit moves of a D-dimensional map in sensor bit order: North, South,
+    # West, East along the first two axes (-1 then +1), then up (+1) and
+    # down (-1) along every further axis. This is the NSWEUD order of the
+    # 6-bit readings in the 3D test cases.
+    offsets = []
+    for axis in range(D):
+        for step in ((-1, 1) if axis < 2 else (1, -1)):
+            offset = [0] * D
+            offset[axis] = step
+            offsets.append(tuple(offset))
+    return offsets
+
+
+def free_grid(map_data):
+    # (rows, cols) boolean array, True on traversable cells
+    return np.array([row.split() for row in map_data]) == '0'
+
+
+def sparse_transmission(map_data):
+    # Sparse form of transmission_matrix: for every state i, the (at most 4)
+    # states k it can be reached from, and Tm[k, i] = 1/deg(k).
+    # Returns (neighbours, weights), both (K, 4). Missing neighbours point
+    # back at i with weight 0, so a gather-multiply-max needs no masking.
+    index = map_index(map_data)
+    return index.neighbours, index.weights
+
+
+def neighbour_table(free):
+    # sparse_transmission for an occupancy grid of any dimension D; the
+    # tables are (K, 2*D), columns in direction_offsets order, and states
+    # are numbered in C order like state_space
+    cells = np.nonzero(free)
+    K = len(cells[0])
+
+    # State id of every cell, with a border of -1 so edges need no checks
+    ids = np.full(tuple(n + 2 for n in free.shape), -1, dtype=np.int64)
+    ids[interior(free.ndim)][free] = np.arange(K)
+
+    offsets = direction_offsets(free.ndim)
+    neighbours = np.empty((K, len(offsets)), dtype=np.int64)
+    for d, offset in enumerate(offsets):
+        neighbours[:, d] = ids[tuple(c + 1 + o for c, o in zip(cells, offset))]
+
+    valid = neighbours >= 0
+    degree = valid.sum(axis=1)
+    neighbours = np.where(valid, neighbours, np.arange(K)[:, None])
+    weights = np.where(valid, 1 / np.maximum(degree[neighbours], 1), 0.0)
+
+    return neighbours, weights
+
+
+def interior(D):
+    # Index of the unpadded map inside an array padded by 1 on every side
+    return (slice(1, -1),) * D
+
+
+def neighbour_view(padded, offset):
+    # View of a padded array such that view[c] == padded[interior][c + offset]
+    return padded[tuple(slice(1 + o, n - 1 + o) for o, n in zip(offset, padded.shape))]
+
+
+def shifted(grid, offset, fill):
+    # shifted(grid, offset, fill)[c] == grid[c + offset], with `fill`
+    # for positions that fall off the map
+    padded = np.full(tuple(n + 2 for n in grid.shape), fill, dtype=grid.dtype)
+    padded[interior(grid.ndim)] = grid
+    return neighbour_view(padded, offset)
+
+
+def inverse_degree_grid(free):
+    # 1/deg of every free cell, 0 on obstacles and cells with no free neighbour
+    degree = sum(shifted(free, offset, False).astype(np.int64) for offset in direction_offsets(free.ndim))
+    return np.where(free & (degree > 0), 1 / np.maximum(degree, 1), 0.0)
+
+
+def signature_grid(free):
+    # True reading of every cell packed with the first direction in the
+    # highest bit, e.g. N*8 + S*4 + W*2 + E in 2D, i.e. the index
+    # binary_to_decimal gives the same reading, minus one. The map
+    # boundary counts as an obstacle.
+    offsets = direction_offsets(free.ndim)
+    bits = len(offsets)
+    signature = np.zeros(free.shape, dtype=np.min_scalar_type(2 ** bits))
+    for d, offset in enumerate(offsets):
+        wall = ~shifted(free, offset, False)
+        signature |= wall.astype(signature.dtype) << (bits - 1 - d)
+    return signature
+
+
+@functools.lru_cache(maxsize=64)
+def emission_table(error_rate, bits=4):
+    # table[s, o] = P(reading o+1 | true signature s) for all 2^bits x 2^bits
+    # pairs, from the Hamming distance popcount(s ^ o). Read-only, as it is shared.
+    N = 2 ** bits
+    popcount = np.array([bin(v).count('1') for v in range(N)])
+    # (1-e)^(bits-d) * e^d written as the original per-state loop had it
+    by_errors = np.array([(1-error_rate)**(bits - count) * error_rate**count for count in range(bits + 1)])
+    table = by_errors[popcount[np.arange(N)[:, None] ^ np.arange(N)]]
+    table.setflags(write=False)
+    return table
+
+
+class GridEmission:
+    # Em laid out on the map: MapIndex.grid_emission(...)[o] is the
+    # probability of reading o+1 at every cell, 0 on obstacles. Each step's
+    # map is gathered from one column of emission_table by the cells'
+    # signatures, instead of keeping 2^(2D) full maps around.
+
+    def __init__(self, signature, columns):
+        self.signature = signature
+        self.columns = columns
+
+    def __getitem__(self, o):
+        return self.columns[o][self.signature]
+
+    def log(self):
+        return GridEmission(self.signature, safe_log(self.columns))
+
+
+class MapIndex:
+    # Everything the stages need to know about one map, built once with
+    # vectorized NumPy and shared by all of them:
+    #   free        occupancy grid, True on traversable cells
+    #   cells       (K,) flat C-order index of every state; state ids are
+    #               numbered in C order, like state_space
+    #   neighbours, weights   (K, 2*D) neighbour_table
+    #   signatures  (K,) true reading of every state, as signature_grid
+    # coords (K, D), ids (the grid of state ids, -1 on obstacles) and
+    # degree (K,) are derived on first use. The arrays are read-only.
+
+    FIELDS = ['free', 'cells', 'neighbours', 'weights', 'signatures']
+
+    def __init__(self, free, cells, neighbours, weights, signatures):
+        self.free = free
+        self.cells = cells
+        self.neighbours = neighbours
+        self.weights = weights
+        self.signatures = signatures
+        for name in self.FIELDS:
+            getattr(self, name).setflags(write=False)
+
+    @classmethod
+    @profiled('index', index_counts)
+    def from_free(cls, free):
+        free = np.array(free, dtype=bool)
+        neighbours, weights = neighbour_table(free)
+        return cls(free, np.flatnonzero(free), neighbours, weights, signature_grid(free)[free])
+
+    @property
+    def states(self):
+        return self.cells.shape[0]
+
+    @functools.cached_property
+    def coords(self):
+        return np.stack(np.unravel_index(self.cells, self.free.shape), axis=1)
+
+    @functools.cached_property
+    def ids(self):
+        ids = np.full(self.free.shape, -1, dtype=np.int64)
+        ids.flat[self.cells] = np.arange(self.states)
+        return ids
 
-    transition_matrix = np.zeros((K, K))
+    @functools.cached_property
+    def degree(self):
+        return (self.neighbours != np.arange(self.states)[:, None]).sum(axis=1)
 
-    def get_valid_neighbors(x, y):
-        potential_neighbors = [(x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)]
-        return [
-            (nx, ny) for nx, ny in potential_neighbors
-            if 0 <= nx < rows and 0 <= ny < cols and map_data[nx][ny] == '0'
-        ]
+    @functools.cached_property
+    def key(self):
+        return content_hash(self.free)
 
-    for i, (x, y) in enumerate(S):
-        valid_neighbors = get_valid_neighbors(x, y)
-        num_valid_neighbors = len(valid_neighbors)
-        for nx, ny in valid_neighbors:
-            j = S.index((nx, ny))
-            transition_matrix[i, j] = 1 / num_valid_neighbors
-    
-    return transition_matrix
+    def transition_matrix(self):
+        # Dense K x K transmission_matrix. The neighbour table already holds
+        # Tm[k, i] for the neighbours k of every state i, so this only
+        # scatters it; missing neighbours point at the state itself with
+        # weight 0.
+        K = self.states
+        transition_matrix = np.zeros((K, K))
+        transition_matrix[self.neighbours, np.arange(K)[:, None]] = self.weights
+        return transition_matrix
 
-    # print("Transition matrix:", transition_matrix)
+    @profiled('emission', row_counts)
+    def state_emission(self, error_rate):
+        # emission_matrix for an occupancy grid of any dimension: (K, 2^(2D))
+        return emission_table(float(error_rate), 2 * self.free.ndim)[self.signatures]
+
+    @profiled('emission', lambda result, index, *args, **kwargs: {'states': index.states})
+    def grid_emission(self, error_rate):
+        bits = 2 * self.free.ndim
+        # Obstacles get signature 2^bits, which every column maps to 0
+        signature = np.full(self.free.shape, 2 ** bits, dtype=np.min_scalar_type(2 ** bits))
+        signature.flat[self.cells] = self.signatures
+        columns = np.zeros((2 ** bits, 2 ** bits + 1))
+        columns[:, :-1] = emission_table(float(error_rate), bits).T
+        return GridEmission(signature, columns)
+
+    def save(self, directory):
+        # One .npy per field, written to a scratch directory and renamed into
+        # place, so a concurrent run never loads a half-written index
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        scratch = tempfile.mkdtemp(dir=parent)
+        for name in self.FIELDS:
+            np.save(os.path.join(scratch, name + '.npy'), getattr(self, name))
+        try:
+            os.rename(scratch, directory)
+        except OSError:
+            # Another run saved the same map first
+            shutil.rmtree(scratch)
+
+    @classmethod
+    @profiled('index load', index_counts)
+    def load(cls, directory):
+        # Fields are memory-mapped, so runs on the same map share the pages
+        return cls(*(np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in cls.FIELDS))
+
+
+def content_hash(free):
+    # Key of an occupancy grid for the on-disk index cache
+    digest = hashlib.sha256(f"MapIndex 1 {tuple(free.shape)}".encode())
+    digest.update(np.packbits(np.asarray(free, dtype=bool).ravel()).tobytes())
+    return digest.hexdigest()
+
+
+def load_map_index(free, cache_dir=None):
+    # MapIndex of an occupancy grid. With cache_dir it is kept under
+    # cache_dir/<content hash>, and later runs on the same map load it
+    # from there instead of building it again.
+    if cache_dir is None:
+        return MapIndex.from_free(free)
+    path = os.path.join(cache_dir, content_hash(free))
+    if os.path.isdir(path):
+        try:
+            return MapIndex.load(path)
+        except (OSError, ValueError):
+            pass
+    index = MapIndex.from_free(free)
+    index.save(path)
+    return index
+
+
+def map_index(map_data):
+    # MapIndex of a map in parse_input form, built once per map
+    return cached_map_index(tuple(map_data))
+
+
+@functools.lru_cache(maxsize=16)
+def cached_map_index(map_data):
+    return MapIndex.from_free(free_grid(map_data))
+
+
+class MotionModel:
+    # How the robot moves from one reading to the next:
+    #   stay   probability of standing still; otherwise it moves to a free
+    #          neighbouring cell
+    #   bias   relative weight of every move direction, in
+    #          direction_offsets order (default: all equal). A move picks
+    #          among the cell's free neighbours in proportion to the
+    #          weights of their directions.
+    #   moves  number of such steps the robot takes between two readings
+    # MotionModel() is the model transmission_matrix has always used. On a
+    # cell with no free neighbour the robot can only stay; the probability
+    # of moving is lost there, as in transmission_matrix.
+
+    def __init__(self, stay=0.0, bias=None, moves=1):
+        if not 0 <= stay <= 1:
+            raise ValueError(f"stay probability {stay} is not a probability")
+        if bias is not None and (len(bias) == 0 or min(bias) < 0 or max(bias) <= 0):
+            raise ValueError("direction bias must be non-negative and not all zero")
+        if moves < 1 or int(moves) != moves:
+            raise ValueError(f"moves must be a positive integer, not {moves}")
+        self.stay = float(stay)
+        self.bias = None if bias is None else tuple(float(b) for b in bias)
+        self.moves = int(moves)
+
+    def compile(self, index):
+        return MotionOperator(index, self)
+
+
+class MotionOperator:
+    # A MotionModel compiled for one map into the (K, M) neighbour table
+    # the sparse engines take: weights[i, m] is the probability of moving
+    # from state neighbours[i, m] to state i from one reading to the next,
+    # and unused entries point at i with weight 0. power(k) is the table
+    # for k readings apart, so a gap in the readings is one step. Powers
+    # are built by repeated squaring and the last few asked for are kept;
+    # they are computed outside the lock, so threads can share an operator
+    # (two threads asking for the same new power may both build it).
+
+    CACHE_SIZE = 8
+    # Entries (rows x width) a power may hold: 64 MiB of neighbours and
+    # weights, so the cache stays within half a GiB
+    MAX_ENTRIES = 2 ** 22
+
+    def __init__(self, index, model):
+        self.index = index
+        self.model = model
+        self.lock = threading.Lock()
+        # (k, reduce) or ('transposed', k) -> table, most recently used last
+        self.cache = collections.OrderedDict()
+        self.neighbours, self.weights = table_power(motion_table(index, model.stay, model.bias), model.moves)
+
+    def power(self, k, reduce='sum'):
+        # (neighbours, weights) for readings k steps apart. reduce='sum'
+        # sums over where the robot was at the k - 1 readings in between,
+        # as the HMM does; 'max' keeps only the likeliest of those moves,
+        # as Viterbi does. None when the table would hold more than
+        # MAX_ENTRIES entries; the callers then take k one-step updates.
+        if k == 1:
+            return self.neighbours, self.weights
+        max_width = max(1, self.MAX_ENTRIES // self.neighbours.shape[0])
+        return self.cached((k, reduce), lambda: table_power((self.neighbours, self.weights), k, reduce,
+                                                            max_width))
+
+    def transposed(self, k):
+        # power(k) with the direction of motion reversed: the states every
+        # state can move to, and the probabilities, for backward passes
+        def build():
+            table = self.power(k)
+            return None if table is None else transpose_table(*table)
+        return self.cached(('transposed', k), build)
+
+    def cached(self, key, build):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        table = build()
+        with self.lock:
+            self.cache[key] = table
+            while len(self.cache) > self.CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return table
+
+    def transition_matrix(self, k=1):
+        # Dense K x K Tm[from, to] of power(k), like MapIndex.transition_matrix
+        K = self.neighbours.shape[0]
+        transition_matrix = np.zeros((K, K))
+        np.add.at(transition_matrix, (self.neighbours, np.broadcast_to(np.arange(K)[:, None],
+                                                                       self.neighbours.shape)), self.weights)
+        return np.linalg.matrix_power(transition_matrix, k)
+
+
+@profiled('transmission', lambda result, index, *args, **kwargs: {'states': index.states})
+def motion_table(index, stay=0.0, bias=None):
+    # Neighbour table of a single MotionModel step. Without stay and bias
+    # it has the same columns and weights as MapIndex.neighbours/weights;
+    # stay > 0 adds a column pointing every state at itself.
+    K, M = index.neighbours.shape
+    bias = np.ones(M) if bias is None else np.asarray(bias, dtype=float)
+    if bias.shape != (M,):
+        raise ValueError(f"direction bias needs {M} weights for a {M // 2}D map")
+    valid = index.neighbours != np.arange(K)[:, None]
+    # Total bias of the moves every state can make; the robot at
+    # neighbours[i, d] reaches i by the opposite move, column d ^ 1
+    total = (valid * bias).sum(axis=1)
+    total = np.where(total > 0, total, 1.0)[index.neighbours]
+    weights = np.where(valid, (1 - stay) * (bias[np.arange(M) ^ 1] / total), 0.0)
+    neighbours = index.neighbours
+    if stay > 0:
+        neighbours = np.hstack([neighbours, np.arange(K)[:, None]])
+        weights = np.hstack([weights, np.full((K, 1), stay)])
+    neighbours.setflags(write=False)
+    weights.setflags(write=False)
+    return neighbours, weights
+
+
+def neighbour_table_from_entries(K, targets, sources, weights, reduce='sum'):
+    # Neighbour table holding weight w for every entry (target, source, w),
+    # duplicates summed (or their maximum kept, for reduce='max') and zero
+    # weights dropped; rows are padded to the longest with weight 0
+    # entries pointing at the row's own state
+    return table_from_entries(K, *reduce_entries(K, targets, sources, weights, reduce))
+
+
+def reduce_entries(K, targets, sources, weights, reduce='sum'):
+    # The distinct (target, source) pairs among the entries with a positive
+    # weight, sorted, and their summed or largest weights
+    keep = weights > 0
+    keys = targets[keep] * K + sources[keep]
+    order = np.argsort(keys, kind='stable')
+    keys, weights = keys[order], weights[keep][order]
+    if len(keys) == 0:
+        return keys, keys, weights
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    totals = (np.add if reduce == 'sum' else np.maximum).reduceat(weights, starts)
+    keys = keys[starts]
+    return keys // K, keys % K, totals
+
+
+def table_from_entries(K, targets, sources, weights):
+    # neighbour_table_from_entries for entries that are already distinct
+    # and sorted by target
+    counts = np.bincount(targets, minlength=K)
+    position = np.arange(len(targets)) - np.repeat(np.cumsum(counts) - counts, counts)
+    table = np.repeat(np.arange(K)[:, None], max(counts.max(initial=0), 1), axis=1)
+    table_weights = np.zeros(table.shape)
+    table[targets, position] = sources
+    table_weights[targets, position] = weights
+    table.setflags(write=False)
+    table_weights.setflags(write=False)
+    return table, table_weights
+
+
+@profiled('transmission', lambda result, first, *args, **kwargs: {'states': first[0].shape[0]})
+def compose_tables(first, second, reduce='sum', max_width=None):
+    # Neighbour table of one step with `first` followed by one with
+    # `second`: the robot reaches i from neighbours1[k, a] through
+    # k = neighbours2[i, b], with probability weights2[i, b] * weights1[k, a]
+    # (summed over k, or the largest kept, see neighbour_table_from_entries).
+    # Rows are combined a block at a time, so the (rows, M2, M1) products
+    # stay small however wide the tables are. None as soon as a row needs
+    # more than max_width entries.
+    neighbours1, weights1 = first
+    neighbours2, weights2 = second
+    K = neighbours2.shape[0]
+    block = max(1, 2 ** 20 // (neighbours1.shape[1] * neighbours2.shape[1]))
+    parts = []
+    for lo in range(0, K, block):
+        hi = min(lo + block, K)
+        sources = neighbours1[neighbours2[lo:hi]]
+        weights = weights2[lo:hi, :, None] * weights1[neighbours2[lo:hi]]
+        targets = np.broadcast_to(np.arange(lo, hi)[:, None, None], sources.shape)
+        part = reduce_entries(K, targets.ravel(), sources.ravel(), weights.ravel(), reduce)
+        if max_width is not None and np.bincount(part[0] - lo).max(initial=0) > max_width:
+            return None
+        parts.append(part)
+    return table_from_entries(K, *(np.concatenate(column) for column in zip(*parts)))
+
+
+def table_power(table, n, reduce='sum', max_width=None):
+    # `table` composed with itself n times, by repeated squaring. With
+    # max_width, None as soon as a table on the way is wider than that (see
+    # compose_tables).
+    result = None
+    while True:
+        if n & 1:
+            result = table if result is None else compose_tables(result, table, reduce, max_width)
+            if result is None:
+                return None
+        n >>= 1
+        if n == 0:
+            return result
+        table = compose_tables(table, table, reduce, max_width)
+        if table is None:
+            return None
+
+
+def transpose_table(neighbours, weights):
+    # Neighbour table of the reverse moves: for every state, the states it
+    # moves to and the probability of each move
+    K = neighbours.shape[0]
+    targets = np.broadcast_to(np.arange(K)[:, None], neighbours.shape)
+    return neighbour_table_from_entries(K, neighbours.ravel(), targets.ravel(), weights.ravel())
 
 
 def actual_observation(map_data):
@@ -111,41 +668,24 @@ def count_differences(list1, list2):
     return count
 
 
+@profiled('emission', row_counts)
 def emission_matrix(map_data,error_rate):
+    # Em[i, o] = P(reading o+1 | state i). Each state's row is looked up
+    # by its true signature in emission_table; the result is memoized per
+    # (map, error rate), so treat it as read-only.
+    return cached_emission_matrix(tuple(map_data), float(error_rate))
 
-    # S is the coordinates of the 'O's in the map
-    S = state_space(map_data)
-    # K is the number of 'O's in the map
-    K = len(S)
-    # print('K', K)
-    # print('S', S)
-    # since we have only 4 observations, therefore 2**4 = 16
-    N = 16 
-    Em = np.zeros((K, N))
-
-    for i in range(1, K+1):
-        actual_obs = actual_observation(map_data) # [N, S, W, E]
-        # print("actual observations: ", actual_obs)
-        observation_list = observation_space_to_list(observation_space(4))
-        # print('O', observation_list)
-        
-        for j in range(1, N+1):
-            observation = observation_list[j-1] #[N, S, W, E]
-            count = count_differences(actual_obs[i-1], observation[j-1])
-            # print("actual observations: ", actual_obs[i-1])
-            # print("Obserbation", observation)
-            # print("count", count)
-            Em[i-1][j-1] = (1-error_rate)**(4 - count) * error_rate**count
-    return Em
-
-    # print("EMIssion matrix:", Em)
-    # print('End')
 
+@functools.lru_cache(maxsize=16)
+def cached_emission_matrix(map_data, error_rate):
+    Em = map_index(map_data).state_emission(error_rate)
+    Em.setflags(write=False)
+    return Em
 
 
+@profiled('forward', trellis_counts)
 def viterbi_forward(map_data, Y, Tm, Em):
-    S = state_space(map_data)
-    K = len(S)
+    K = map_index(map_data).states
     T = len(Y)
     initial_probability = [1/K] * K 
 
@@ -162,53 +702,1410 @@ def viterbi_forward(map_data, Y, Tm, Em):
     return trellis
 
 
+@profiled('forward', trellis_counts)
+def viterbi_forward_vectorized(Y, Tm, Em):
+    # Same recursion as viterbi_forward, but each time step is one broadcast
+    # max over the previous column and the transition matrix:
+    #   trellis[:, j] = max_k(trellis[k, j-1] * Tm[k, :]) * Em[:, Y[j]-1]
+    # Em is positive, so taking the max before multiplying by it gives
+    # bit-for-bit the same trellis as the per-state loop.
+    K = Tm.shape[0]
+    T = len(Y)
+    obs = np.asarray(Y) - 1
+
+    trellis = np.zeros((K, T))
+    trellis[:, 0] = (1 / K) * Em[:, obs[0]]
+
+    for j in range(1, T):
+        trellis[:, j] = (trellis[:, j-1, None] * Tm).max(axis=0) * Em[:, obs[j]]
+
+    return trellis
+
+
+# Trellis spaces supported by the sparse and grid engines:
+#   prob   - raw max-product probabilities, as viterbi_forward produces;
+#            these underflow to 0 after a few hundred readings
+#   log    - max-sum over log probabilities, returns log scores
+#   scaled - max-product, but every step is divided by its maximum and the
+#            scale factors are kept; also returns log scores
+SPACES = ['prob', 'log', 'scaled']
+
+
+def safe_log(x):
+    # log that maps 0 to -inf without a divide-by-zero warning
+    with np.errstate(divide='ignore'):
+        return np.log(x)
+
+
+def direction_dtype(neighbours):
+    # Backpointers hold a column of the neighbour table: the smallest
+    # signed type that does, int8 unless the table is wider than 128
+    # columns (motion tables over many moves)
+    return np.min_scalar_type(-neighbours.shape[1])
+
+
+def rescale_step(column, log_scale, j):
+    # Divide column j by its maximum in place and record log(maximum),
+    # cumulated over the previous steps
+    peak = column.max()
+    previous = log_scale[j-1] if j > 0 else 0.0
+    if peak > 0:
+        column /= peak
+        log_scale[j] = previous + np.log(peak)
+    else:
+        log_scale[j] = previous
+
+
+def set_start_scores(column, start_scores, space, log_scale):
+    # Seed the first trellis column from a column returned in `space`;
+    # log and scaled engines return log scores
+    if space == 'scaled':
+        peak = start_scores.max()
+        log_scale[0] = peak if np.isfinite(peak) else 0.0
+        column[...] = np.exp(start_scores - log_scale[0])
+    else:
+        column[...] = start_scores
+
+
+@profiled('forward', sparse_counts)
+def viterbi_forward_sparse(Y, neighbours, weights, Em, space='prob', return_backpointers=False,
+                           start_scores=None, backend='auto', threads=1):
+    # viterbi_forward_vectorized over the (K, 4) table from
+    # sparse_transmission: memory and time per step are O(K), not O(K^2).
+    # With return_backpointers, also returns a (K, T) int8 array (see
+    # direction_dtype) holding, for every state and step, the column of
+    # `neighbours` the best predecessor came from (see backtrace_sparse).
+    # start_scores replaces the first column (uniform prior times the first
+    # emission) to resume from a column an earlier call returned; Y[0] is
+    # then only used for that column's place in the sequence.
+    # backend picks the NumPy steps below or kernels.sparse_forward (see
+    # kernels.resolve_backend); both give the same trellis. threads > 1
+    # (or None for one per core) splits every step over a thread pool, see
+    # sparse_forward_threaded.
+    K = neighbours.shape[0]
+    T = len(Y)
+    obs = np.asarray(Y) - 1
+    if threads != 1:
+        return sparse_forward_threaded(obs, neighbours, weights, Em, space, return_backpointers, start_scores,
+                                       backend, threads)
+    if kernels.resolve_backend(backend, K * T) == 'numba':
+        return sparse_forward_compiled(obs, neighbours, weights, Em, space, return_backpointers, start_scores)
+
+    if space == 'log':
+        combine = np.add
+        weights, Em = safe_log(weights), safe_log(Em)
+        uniform = -np.log(K)
+    else:
+        combine = np.multiply
+        uniform = 1 / K
+    log_scale = np.zeros(T)
+
+    trellis = np.zeros((K, T))
+    if start_scores is None:
+        trellis[:, 0] = combine(uniform, Em[:, obs[0]])
+        if space == 'scaled':
+            rescale_step(trellis[:, 0], log_scale, 0)
+    else:
+        set_start_scores(trellis[:, 0], start_scores, space, log_scale)
+
+    if return_backpointers:
+        backpointers = np.zeros((K, T), dtype=direction_dtype(neighbours))
+        states = np.arange(K)
+
+    for j in range(1, T):
+        prev = trellis[:, j-1]
+        candidates = combine(prev[neighbours], weights)
+        if return_backpointers:
+            backpointers[:, j] = direction = candidates.argmax(axis=1)
+            best = candidates[states, direction]
+        else:
+            best = candidates.max(axis=1)
+        trellis[:, j] = combine(best, Em[:, obs[j]])
+        if space == 'scaled':
+            rescale_step(trellis[:, j], log_scale, j)
+
+    if space == 'scaled':
+        trellis = safe_log(trellis) + log_scale
+    if return_backpointers:
+        return trellis, backpointers
+    return trellis
+
+
+def sparse_forward_compiled(obs, neighbours, weights, Em, space, return_backpointers, start_scores):
+    # viterbi_forward_sparse on the compiled kernel. The trellis is built
+    # as (T, K) rows, so every step reads and writes contiguous memory, and
+    # returned as its (K, T) transpose.
+    K = neighbours.shape[0]
+    T = len(obs)
+    if space == 'log':
+        weights, Em = safe_log(weights), safe_log(Em)
+    log_scale = np.zeros(T)
+    rows = np.zeros((T, K))
+    first_sparse_row(rows[0], obs[0], Em, space, start_scores, log_scale)
+
+    backpointers = np.zeros((T, K) if return_backpointers else (0, 0), dtype=direction_dtype(neighbours))
+    peaks = np.ones(T if space == 'scaled' else 0)
+    kernels.sparse_forward(obs, neighbours, np.ascontiguousarray(weights), np.ascontiguousarray(Em), rows,
+                           backpointers, space == 'log', peaks)
+
+    trellis = rows.T
+    if space == 'scaled':
+        # Same running sum rescale_step keeps, one step at a time
+        log_scale[1:] = np.log(peaks[1:])
+        trellis = safe_log(trellis) + np.cumsum(log_scale)[None, :]
+    if return_backpointers:
+        return trellis, backpointers.T
+    return trellis
+
+
+def first_sparse_row(row, o, Em, space, start_scores, log_scale):
+    # First trellis column of viterbi_forward_sparse; Em is already in log
+    # space for space='log'
+    K = row.shape[0]
+    if start_scores is None:
+        row[...] = -np.log(K) + Em[:, o] if space == 'log' else (1 / K) * Em[:, o]
+        if space == 'scaled':
+            rescale_step(row, log_scale, 0)
+    else:
+        set_start_scores(row, start_scores, space, log_scale)
+
+
+def sparse_forward_threaded(obs, neighbours, weights, Em, space, return_backpointers, start_scores,
+                            backend='auto', threads=None):
+    # viterbi_forward_sparse with the states split into one contiguous
+    # range per thread. Every thread writes its range of the next row of a
+    # preallocated (T, K) trellis and waits at a barrier before the next
+    # step, which reads the whole row; the scaled space adds a second
+    # barrier so every range is divided by the same maximum. The numba
+    # kernel and the NumPy calls used here (take, ufuncs with out=,
+    # argmax) release the GIL, so the ranges run on all cores. Same trellis
+    # as the single-threaded engines.
+    K = neighbours.shape[0]
+    T = len(obs)
+    threads = max(1, min(threads or os.cpu_count() or 1, K))
+    compiled = kernels.resolve_backend(backend, K * T) == 'numba'
+    log_space = space == 'log'
+    combine = np.add if log_space else np.multiply
+    if log_space:
+        weights, Em = safe_log(weights), safe_log(Em)
+    weights, Em = np.ascontiguousarray(weights), np.ascontiguousarray(Em)
+    log_scale = np.zeros(T)
+    rows = np.zeros((T, K))
+    first_sparse_row(rows[0], obs[0], Em, space, start_scores, log_scale)
+
+    backpointers = np.zeros((T, K) if return_backpointers else (0, 0), dtype=direction_dtype(neighbours))
+    no_backpointers = np.empty(0, dtype=backpointers.dtype)
+    bounds = np.linspace(0, K, threads + 1).astype(np.int64)
+    range_peaks = np.zeros(threads)
+    barrier = threading.Barrier(threads)
+
+    def run_range(part):
+        lo, hi = int(bounds[part]), int(bounds[part + 1])
+        candidates = np.empty((hi - lo, neighbours.shape[1]))
+        states = np.arange(hi - lo)
+        try:
+            for j in range(1, T):
+                out = rows[j, lo:hi]
+                if compiled:
+                    step_backpointers = backpointers[j] if return_backpointers else no_backpointers
+                    range_peaks[part] = kernels.sparse_step(rows[j-1], rows[j], step_backpointers, neighbours,
+                                                            weights, Em, obs[j], lo, hi, log_space)
+                else:
+                    np.take(rows[j-1], neighbours[lo:hi], out=candidates)
+                    combine(candidates, weights[lo:hi], out=candidates)
+                    if return_backpointers:
+                        backpointers[j, lo:hi] = direction = candidates.argmax(axis=1)
+                        best = candidates[states, direction]
+                    else:
+                        best = candidates.max(axis=1, out=out)
+                    combine(best, Em[lo:hi, obs[j]], out=out)
+                    if space == 'scaled':
+                        range_peaks[part] = out.max(initial=0.0)
+                barrier.wait()
+                if space == 'scaled':
+                    peak = range_peaks.max()
+                    if peak > 0:
+                        out /= peak
+                    if part == 0:
+                        log_scale[j] = log_scale[j-1] + np.log(peak) if peak > 0 else log_scale[j-1]
+                    barrier.wait()
+        except BaseException:
+            # Release the other threads instead of leaving them at the barrier
+            barrier.abort()
+            raise
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = [pool.submit(run_range, part) for part in range(threads)]
+    errors = [f.exception() for f in futures if f.exception() is not None]
+    for error in errors:
+        if not isinstance(error, threading.BrokenBarrierError):
+            raise error
+    if errors:
+        raise errors[0]
+
+    trellis = rows.T
+    if space == 'scaled':
+        trellis = safe_log(trellis) + log_scale
+    if return_backpointers:
+        return trellis, backpointers.T
+    return trellis
+
+
+@profiled('forward', sparse_counts)
+def viterbi_last_column_sparse(Y, neighbours, weights, Em, space='log', start_scores=None, backend='auto'):
+    # Last column of viterbi_forward_sparse (same values, same spaces)
+    # without keeping the trellis: two K-length columns are swapped every
+    # step and every step writes into them, and into one (K, 4) candidate
+    # buffer, with out= arguments. Memory is O(K) whatever len(Y) is, and
+    # the per-step cost stays flat, as nothing is allocated after setup.
+    K = neighbours.shape[0]
+    T = len(Y)
+    obs = np.asarray(Y) - 1
+    compiled = kernels.resolve_backend(backend, K * T) == 'numba'
+    log_space = space == 'log'
+    combine = np.add if log_space else np.multiply
+    if log_space:
+        weights, Em = safe_log(weights), safe_log(Em)
+    weights = np.ascontiguousarray(weights)
+    # One contiguous row per reading for the NumPy steps
+    emissions = np.ascontiguousarray(Em) if compiled else np.ascontiguousarray(Em.T)
+
+    log_scale = np.zeros(1)
+    prev = np.empty(K)
+    column = np.empty(K)
+    first_sparse_row(prev, obs[0], Em, space, start_scores, log_scale)
+    candidates = np.empty(neighbours.shape)
+    no_backpointers = np.empty(0, dtype=np.int8)
+
+    for j in range(1, T):
+        if compiled:
+            peak = kernels.sparse_step(prev, column, no_backpointers, neighbours, weights, emissions, obs[j],
+                                       0, K, log_space)
+        else:
+            np.take(prev, neighbours, out=candidates)
+            combine(candidates, weights, out=candidates)
+            candidates.max(axis=1, out=column)
+            combine(column, emissions[obs[j]], out=column)
+            if space == 'scaled':
+                peak = column.max()
+        if space == 'scaled':
+            # rescale_step with only the running total kept
+            if peak > 0:
+                column /= peak
+                log_scale[0] += np.log(peak)
+        prev, column = column, prev
+
+    if space == 'scaled':
+        return safe_log(prev) + log_scale[0]
+    return prev
+
+
+@profiled('forward', grid_counts)
+def viterbi_forward_grid(Y, free, Eg, space='prob', return_backpointers=False, start_scores=None, on_step=None):
+    # Stencil form of viterbi_forward_sparse that works on the map itself:
+    # trellis[j] has the map's shape, and each step takes the max of the
+    # 2*D shifted copies of the previous step weighted by 1/deg. Eg comes
+    # from MapIndex.grid_emission. The result is already the list of
+    # output maps.
+    # With return_backpointers, also returns a (T, *map shape) int8 array of
+    # direction_offsets indices pointing at each cell's best predecessor.
+    # start_scores works as in viterbi_forward_sparse. With on_step, every
+    # step is passed to on_step(step) as soon as it is computed instead of
+    # being kept, and only the last step is returned, so memory does not
+    # grow with T (apart from the int8 backpointers).
+    shape = free.shape
+    offsets = direction_offsets(free.ndim)
+    K = np.count_nonzero(free)
+    T = len(Y)
+    obs = np.asarray(Y) - 1
+    inv_degree = inverse_degree_grid(free)
+
+    if space == 'log':
+        combine, zero = np.add, -np.inf
+        inv_degree, Eg = safe_log(inv_degree), Eg.log()
+        uniform = -np.log(K)
+    else:
+        combine, zero = np.multiply, 0.0
+        uniform = 1 / K
+    log_scale = np.zeros(T)
+
+    # Streamed steps only need the previous one: trellis[j % kept] is step j
+    kept = T if on_step is None else 2
+    trellis = np.zeros((kept,) + shape)
+    if start_scores is None:
+        trellis[0] = combine(uniform, Eg[obs[0]])
+        if space == 'scaled':
+            rescale_step(trellis[0], log_scale, 0)
+    else:
+        set_start_scores(trellis[0], start_scores, space, log_scale)
+
+    def finished(j):
+        step = trellis[j % kept]
+        return safe_log(step) + log_scale[j] if space == 'scaled' else step
+
+    if on_step is not None:
+        on_step(finished(0))
+
+    # Obstacles and the border stay at `zero`, so they never win the max
+    padded = np.full(tuple(n + 2 for n in shape), zero)
+    inner = padded[interior(free.ndim)]
+    best = np.empty(shape)
+    # views[d][c] is the previous step at the neighbour of c in direction d
+    views = [neighbour_view(padded, offset) for offset in offsets]
+    if return_backpointers:
+        backpointers = np.zeros((T,) + shape, dtype=np.int8)
+        candidates = np.empty((len(offsets),) + shape)
+
+    for j in range(1, T):
+        combine(trellis[(j-1) % kept], inv_degree, out=inner)
+        if return_backpointers:
+            for d, view in enumerate(views):
+                candidates[d] = view
+            backpointers[j] = candidates.argmax(axis=0)
+            np.max(candidates, axis=0, out=best)
+        else:
+            np.maximum(views[0], views[1], out=best)
+            for view in views[2:]:
+                np.maximum(best, view, out=best)
+        combine(best, Eg[obs[j]], out=trellis[j % kept])
+        if space == 'scaled':
+            rescale_step(trellis[j % kept], log_scale, j)
+        if on_step is not None:
+            on_step(finished(j))
+
+    if on_step is not None:
+        trellis = finished(T - 1)
+    elif space == 'scaled':
+        trellis = safe_log(trellis) + log_scale.reshape((T,) + (1,) * free.ndim)
+    if return_backpointers:
+        return trellis, backpointers
+    return trellis
+
+
+@profiled('forward', batch_counts)
+def viterbi_forward_batch(sequences, neighbours, weights, Em, space='prob'):
+    # viterbi_forward_sparse for N observation sequences on the same map,
+    # run together as one (N, K) recursion so every step is a single
+    # vectorized update. Sequences may differ in length; shorter ones are
+    # padded and their extra columns dropped. Returns a list with one
+    # (K, len(sequence)) trellis per sequence.
+    K = neighbours.shape[0]
+    N = len(sequences)
+    lengths = [len(Y) for Y in sequences]
+    T = max(lengths)
+    obs = np.zeros((N, T), dtype=np.int64)
+    for n, Y in enumerate(sequences):
+        obs[n, :lengths[n]] = np.asarray(Y) - 1
+
+    if space == 'log':
+        combine = np.add
+        weights, Em = safe_log(weights), safe_log(Em)
+        uniform = -np.log(K)
+    else:
+        combine = np.multiply
+        uniform = 1 / K
+    EmT = np.ascontiguousarray(Em.T)  # (16, K), so EmT[obs[:, j]] is (N, K)
+    log_scale = np.zeros((N, T, 1))
+
+    trellis = np.zeros((N, T, K))
+    trellis[:, 0] = combine(uniform, EmT[obs[:, 0]])
+    if space == 'scaled':
+        rescale_rows(trellis[:, 0], log_scale[:, 0], None)
+
+    for j in range(1, T):
+        candidates = combine(trellis[:, j-1][:, neighbours], weights)
+        trellis[:, j] = combine(candidates.max(axis=2), EmT[obs[:, j]])
+        if space == 'scaled':
+            rescale_rows(trellis[:, j], log_scale[:, j], log_scale[:, j-1])
+
+    if space == 'scaled':
+        trellis = safe_log(trellis) + log_scale
+    return [trellis[n, :lengths[n]].T for n in range(N)]
+
+
+def rescale_rows(columns, log_scale, previous):
+    # rescale_step for a batch: divide every row of `columns` by its maximum
+    # and add log(maximum) to the previous cumulated scale
+    peak = columns.max(axis=1, keepdims=True)
+    peak = np.where(peak > 0, peak, 1.0)
+    columns /= peak
+    log_scale[...] = np.log(peak) if previous is None else previous + np.log(peak)
+
+
+def path_end(scores, space='log'):
+    # Flat index of the best score, where a backtrace starts. Obstacles and
+    # the cells no path reaches score 0 in the prob space and -inf in the
+    # others, so if the best is no better (or a beam kept no state at all)
+    # the readings fit no path
+    if np.size(scores) == 0 or np.max(scores) <= (0.0 if space == 'prob' else -np.inf):
+        raise ValueError("no path fits the readings")
+    return int(np.argmax(scores))
+
+
+@profiled('backtrace', path_counts)
+def backtrace_sparse(last_column, backpointers, neighbours, end=None, backend='auto', space='log'):
+    # Most probable state sequence ending in the best state of the last
+    # column (or in state `end`), as a list of state ids. last_column is
+    # in `space`; ValueError if no state can end a path.
+    T = backpointers.shape[1]
+    end = path_end(last_column, space) if end is None else end
+    if kernels.resolve_backend(backend, backpointers.size) == 'numba':
+        return kernels.sparse_backtrace(end, backpointers, neighbours).tolist()
+    path = [end]
+    for j in range(T - 1, 0, -1):
+        path.append(int(neighbours[path[-1], backpointers[path[-1], j]]))
+    path.reverse()
+    return path
+
+
+@profiled('backtrace', path_counts)
+def backtrace_grid(last_step, backpointers, end=None, space='log'):
+    # Most probable path ending in the best cell of the last step (or in
+    # cell `end`), as a list of coordinate tuples like state_space returns.
+    # last_step is in `space`; ValueError if no cell can end a path, so the
+    # path never starts from an obstacle.
+    T = backpointers.shape[0]
+    offsets = direction_offsets(last_step.ndim)
+    cell = np.unravel_index(path_end(last_step, space), last_step.shape) if end is None else end
+    cell = tuple(int(c) for c in cell)
+    path = [cell]
+    for j in range(T - 1, 0, -1):
+        offset = offsets[backpointers[(j,) + cell]]
+        cell = tuple(c + o for c, o in zip(cell, offset))
+        path.append(cell)
+    path.reverse()
+    return path
+
+
+def decode_path_sparse(Y, neighbours, weights, Em, S, space='log', backend='auto'):
+    # Most probable path as coordinates; S is state_space(map_data)
+    trellis, backpointers = viterbi_forward_sparse(Y, neighbours, weights, Em, space, return_backpointers=True,
+                                                   backend=backend)
+    return [S[i] for i in backtrace_sparse(trellis[:, -1], backpointers, neighbours, backend=backend, space=space)]
+
+
+def decode_path_grid(Y, free, Eg, space='log'):
+    trellis, backpointers = viterbi_forward_grid(Y, free, Eg, space, return_backpointers=True)
+    return backtrace_grid(trellis[-1], backpointers, space=space)
+
+
+def gap_segments(gaps):
+    # (start, stop) of the runs of readings one step apart
+    T = len(gaps)
+    starts = [0] + [j for j in range(1, T) if gaps[j] > 1] + [T]
+    return list(zip(starts, starts[1:]))
+
+
+@profiled('forward', gap_counts)
+def viterbi_forward_gaps(Y, gaps, motion, Em, space='prob', return_backpointers=False, backend='auto',
+                         threads=1):
+    # viterbi_forward_sparse over readings that are not all one step
+    # apart: gaps[j] is the number of steps from reading j-1 to reading j
+    # (gaps[0] is ignored), motion a MotionOperator. Runs of consecutive
+    # readings go through viterbi_forward_sparse with the one-step table,
+    # and a gap of k steps is one step with motion.power(k, 'max'), or k
+    # steps with no reading (gap_steps) when that table would be too big;
+    # either way the robot takes its likeliest moves through the missed
+    # readings, which are not decoded. Backpointers of the columns that
+    # follow a gap are left 0, as they index a different table;
+    # backtrace_gaps recomputes them. backend and threads are passed on to
+    # viterbi_forward_sparse.
+    K = motion.neighbours.shape[0]
+    T = len(Y)
+    Y = np.asarray(Y)
+    trellis = np.zeros((K, T))
+    if return_backpointers:
+        backpointers = np.zeros((K, T), dtype=direction_dtype(motion.neighbours))
+    for start, stop in gap_segments(gaps):
+        start_scores = None
+        if start > 0:
+            start_scores = trellis[:, start] = gap_column(trellis[:, start - 1], Y[start], gaps[start], motion,
+                                                          Em, space, backend, threads)
+        if stop - start == 1 and start > 0:
+            continue
+        result = viterbi_forward_sparse(Y[start:stop], motion.neighbours, motion.weights, Em, space,
+                                        return_backpointers, start_scores, backend, threads)
+        if return_backpointers:
+            result, segment_backpointers = result
+            backpointers[:, start + 1:stop] = segment_backpointers[:, 1:]
+        # The first column of a segment after a gap is start_scores already
+        first = 0 if start == 0 else 1
+        trellis[:, start + first:stop] = result[:, first:]
+    if return_backpointers:
+        return trellis, backpointers
+    return trellis
+
+
+def gap_column(column, o, k, motion, Em, space='prob', backend='auto', threads=1):
+    # Trellis column of reading o (1-based) k steps after `column`, as
+    # viterbi_forward_gaps computes it
+    table = motion.power(k, 'max')
+    if table is not None:
+        return viterbi_forward_sparse([o, o], *table, Em, space, start_scores=column, backend=backend,
+                                      threads=threads)[:, 1]
+    last = gap_steps(column, k, motion, space, backend=backend, threads=threads)[:, -1]
+    return last * Em[:, o - 1] if space == 'prob' else last + safe_log(Em[:, o - 1])
+
+
+def gap_steps(column, k, motion, space='prob', return_backpointers=False, backend='auto', threads=1):
+    # k one-step updates from trellis column `column` with no readings:
+    # viterbi_forward_sparse with an emission of 1 everywhere, returning
+    # the (K, k + 1) trellis that starts at `column`
+    ones = np.ones((motion.neighbours.shape[0], 1))
+    return viterbi_forward_sparse(np.ones(k + 1, dtype=np.int64), motion.neighbours, motion.weights, ones, space,
+                                  return_backpointers, column, backend, threads)
+
+
+@profiled('backtrace', path_counts)
+def backtrace_gaps(trellis, backpointers, gaps, motion, space='prob', backend='auto'):
+    # backtrace_sparse for viterbi_forward_gaps: state ids of the best
+    # path at every reading. Across a gap the predecessor is the argmax
+    # of the same combination the forward step maximized, or, where that
+    # step was gap_steps, the start of their best path.
+    state = path_end(trellis[:, -1], space)
+    path = []
+    for start, stop in reversed(gap_segments(gaps)):
+        segment = backtrace_sparse(None, backpointers[:, start:stop], motion.neighbours, end=state,
+                                   backend=backend)
+        path.extend(reversed(segment))
+        if start > 0:
+            state = segment[0]
+            table = motion.power(gaps[start], 'max')
+            if table is None:
+                _, steps = gap_steps(trellis[:, start - 1], gaps[start], motion, space, True, backend)
+                state = backtrace_sparse(None, steps, motion.neighbours, end=state, backend=backend)[0]
+                continue
+            neighbours, weights = table
+            if space == 'prob':
+                values = trellis[neighbours[state], start - 1] * weights[state]
+            else:
+                values = trellis[neighbours[state], start - 1] + safe_log(weights[state])
+            state = int(neighbours[state, np.argmax(values)])
+    path.reverse()
+    return path
+
+
+def checkpointed_backtrace(forward, backtrace, T, interval=None):
+    # Exact Viterbi path with O(T/interval + interval) columns in memory.
+    # A first pass keeps only the last column of every `interval` steps;
+    # the path is then recovered segment by segment, last to first, by
+    # rerunning each segment from its checkpoint with backpointers. Every
+    # step is computed twice; interval defaults to sqrt(T), which minimises
+    # memory, and smaller values trade checkpoints for shorter segments.
+    #   forward(start, stop, start_scores, return_backpointers) runs steps
+    #       start..stop-1, seeded with the column at step `start` if given,
+    #       and returns (last column, backpointers or None)
+    #   backtrace(last, backpointers, end) is backtrace_sparse/_grid
+    if interval is None:
+        interval = max(1, int(np.ceil(np.sqrt(T))))
+    stops = list(range(interval, T, interval)) + [T]
+
+    def run_segment(k, return_backpointers):
+        if k == 0:
+            return forward(0, stops[0], None, return_backpointers)
+        return forward(stops[k-1] - 1, stops[k], checkpoints[k-1], return_backpointers)
+
+    # checkpoints[k] is the column at step stops[k] - 1
+    checkpoints = []
+    for k in range(len(stops)):
+        checkpoints.append(run_segment(k, False)[0])
+
+    path = []
+    end = None
+    for k in range(len(stops) - 1, -1, -1):
+        _, backpointers = run_segment(k, True)
+        segment = backtrace(checkpoints[k], backpointers, end)
+        if k > 0:
+            # The first entry is the previous segment's last step
+            end = segment[0]
+            segment = segment[1:]
+        path[:0] = segment
+        checkpoints[k] = None
+    return path
+
+
+@profiled('decode', sparse_counts)
+def decode_path_sparse_checkpointed(Y, neighbours, weights, Em, S, interval=None, backend='auto'):
+    # decode_path_sparse in O(sqrt(T) K) memory, see checkpointed_backtrace
+    def forward(start, stop, start_scores, return_backpointers):
+        if not return_backpointers:
+            # Checkpoint pass: only the last column of the segment is kept
+            return viterbi_last_column_sparse(Y[start:stop], neighbours, weights, Em, 'log', start_scores,
+                                              backend), None
+        result = viterbi_forward_sparse(Y[start:stop], neighbours, weights, Em, 'log', return_backpointers,
+                                        start_scores, backend)
+        return result[0][:, -1], result[1]
+    path = checkpointed_backtrace(
+        forward, lambda last, backpointers, end: backtrace_sparse(last, backpointers, neighbours, end, backend),
+        len(Y), interval)
+    return [S[i] for i in path]
+
+
+@profiled('decode', grid_counts)
+def decode_path_grid_checkpointed(Y, free, Eg, interval=None):
+    # decode_path_grid in O(sqrt(T) rows cols) memory, see checkpointed_backtrace
+    def forward(start, stop, start_scores, return_backpointers):
+        result = viterbi_forward_grid(Y[start:stop], free, Eg, 'log', return_backpointers, start_scores)
+        if return_backpointers:
+            return result[0][-1], result[1]
+        return result[-1], None
+    return checkpointed_backtrace(forward, backtrace_grid, len(Y), interval)
+
+
+@profiled('forward', sparse_counts)
+def viterbi_forward_beam(Y, neighbours, weights, Em, margin=None, beam=None):
+    # Approximate max-sum Viterbi over the sparse table that only carries
+    # the states still in the running: after every step, states more than
+    # `margin` below the step's best log score, and all but the `beam`
+    # best, are dropped (either limit or both). A step only evaluates the
+    # map neighbours of the surviving states, so it costs O(B log B) for B
+    # survivors instead of O(K); only the first step is O(K).
+    # Returns (states, scores, directions, stats), the first three holding
+    # one array per step: the surviving state ids in increasing order,
+    # their log scores and, from step 1 on, the backpointer column of
+    # `neighbours` (see backtrace_beam). Survivors' scores are exact unless
+    # their best path went through a dropped state. stats is a dict:
+    #   pruning_ratio  share of the K*T trellis entries never kept
+    #   mean_active    survivors per step
+    #   best           final best log score
+    #   dropped_bound  upper bound on the final score of any path through
+    #                  a dropped state: its score when dropped plus the
+    #                  largest gain (log transition + log emission) any
+    #                  state could make on each remaining reading
+    #   error_bound    max(0, dropped_bound - best): the exact Viterbi
+    #                  score is at most this much above `best`. It is
+    #                  loose, as it grants dropped paths the best gain on
+    #                  every later step
+    #   closest_drop   log ratio of the best dropped state to its step's
+    #                  best state (at most -margin; -inf if none dropped)
+    #   exact          error_bound == 0, i.e. the beam path is a true
+    #                  most probable path
+    K = neighbours.shape[0]
+    T = len(Y)
+    obs = np.asarray(Y) - 1
+    log_weights, log_Em = safe_log(weights), safe_log(Em)
+
+    # remaining_gain[j] bounds what a path can add after step j
+    best_gain = (log_weights.max(axis=1)[:, None] + log_Em).max(axis=0)
+    remaining_gain = np.zeros(T)
+    remaining_gain[:-1] = np.cumsum(best_gain[obs[:0:-1]])[::-1]
+
+    # Log score of every survivor of the last step, -inf elsewhere; only
+    # survivors' entries are ever set, so resetting them is O(B)
+    score = np.full(K, -np.inf)
+    dropped_bound = closest_drop = -np.inf
+
+    def prune(values, j):
+        nonlocal dropped_bound, closest_drop
+        keep = np.isfinite(values)
+        if margin is not None and keep.any():
+            keep &= values >= values[keep].max() - margin
+        kept = np.flatnonzero(keep)
+        if beam is not None and len(kept) > beam:
+            kept = np.sort(kept[np.argpartition(values[kept], len(kept) - beam)[len(kept) - beam:]])
+        dropped = np.ones(len(values), dtype=bool)
+        dropped[kept] = False
+        dropped_peak = values[dropped].max(initial=-np.inf)
+        if np.isfinite(dropped_peak):
+            dropped_bound = max(dropped_bound, dropped_peak + remaining_gain[j])
+            closest_drop = max(closest_drop, dropped_peak - values.max())
+        return kept
+
+    first = -np.log(K) + log_Em[:, obs[0]]
+    kept = prune(first, 0)
+    states, scores, directions = [kept], [first[kept]], [np.zeros(0, dtype=direction_dtype(neighbours))]
+    score[kept] = first[kept]
+
+    for j in range(1, T):
+        candidates = np.unique(neighbours[states[-1]])
+        values = score[neighbours[candidates]] + log_weights[candidates]
+        direction = values.argmax(axis=1)
+        values = values[np.arange(len(candidates)), direction] + log_Em[candidates, obs[j]]
+        score[states[-1]] = -np.inf
+
+        kept = prune(values, j)
+        states.append(candidates[kept])
+        scores.append(values[kept])
+        directions.append(direction[kept].astype(direction_dtype(neighbours)))
+        score[states[-1]] = scores[-1]
+
+    active = sum(len(step) for step in states)
+    best = scores[-1].max(initial=-np.inf)
+    stats = {
+        'pruning_ratio': 1 - active / (K * T),
+        'mean_active': active / T,
+        'best': float(best),
+        'dropped_bound': float(dropped_bound),
+        'error_bound': float(max(0.0, dropped_bound - best)),
+        'exact': bool(dropped_bound <= best),
+        'closest_drop': float(closest_drop),
+    }
+    return states, scores, directions, stats
+
+
+@profiled('backtrace', path_counts)
+def backtrace_beam(states, scores, directions, neighbours):
+    # backtrace_sparse for viterbi_forward_beam: state ids of the best
+    # surviving path, first step first
+    path = [int(states[-1][path_end(scores[-1])])]
+    for j in range(len(states) - 1, 0, -1):
+        position = np.searchsorted(states[j], path[-1])
+        path.append(int(neighbours[path[-1], directions[j][position]]))
+    path.reverse()
+    return path
+
+
+def beam_trellis(states, scores, K):
+    # (K, T) log trellis of a viterbi_forward_beam run, -inf where pruned
+    trellis = np.full((K, len(states)), -np.inf)
+    for j, (step_states, step_scores) in enumerate(zip(states, scores)):
+        trellis[step_states, j] = step_scores
+    return trellis
+
+
+def normalize_column(column):
+    # Scale column in place to sum to 1 and return the old sum
+    total = column.sum()
+    if total > 0:
+        column /= total
+    return total
+
+
+@profiled('forward-backward', sparse_counts)
+def forward_backward_sparse(Y, neighbours, weights, Em, smooth=True):
+    # Sum-product counterpart of viterbi_forward_sparse over the same
+    # operators. Returns (K, T) posteriors P(X_j | Y[0..j]) (filtering) or,
+    # with smooth, P(X_j | all of Y); every column sums to 1.
+    table = neighbours, weights, 1
+    reverse = transpose_table(neighbours, weights) + (1,) if smooth else None
+    return forward_backward_steps(Y, Em, lambda j: table, lambda j: reverse, smooth)
+
+
+@profiled('forward-backward', gap_counts)
+def forward_backward_gaps(Y, gaps, motion, Em, smooth=True):
+    # forward_backward_sparse over readings that are not all one step
+    # apart (see viterbi_forward_gaps), with a MotionOperator's tables. A
+    # gap of k steps is one step with motion.power(k), or k steps with the
+    # one-step table where power(k) would be too big.
+    def table(j):
+        power = motion.power(gaps[j])
+        return (motion.neighbours, motion.weights, gaps[j]) if power is None else power + (1,)
+
+    def reverse_table(j):
+        transposed = motion.transposed(gaps[j])
+        return motion.transposed(1) + (gaps[j],) if transposed is None else transposed + (1,)
+
+    return forward_backward_steps(Y, Em, table, reverse_table, smooth)
+
+
+def forward_backward_steps(Y, Em, table, reverse_table, smooth):
+    # table(j) is (neighbours, weights, n): the neighbour table from
+    # reading j-1 to reading j is that table applied n times.
+    # reverse_table(j) is the same for its transpose_table.
+    K = Em.shape[0]
+    T = len(Y)
+    obs = np.asarray(Y) - 1
+
+    belief = np.zeros((K, T))
+    scale = np.ones(T)
+    belief[:, 0] = (1 / K) * Em[:, obs[0]]
+    scale[0] = normalize_column(belief[:, 0])
+    for j in range(1, T):
+        neighbours, weights, n = table(j)
+        column = belief[:, j-1]
+        for _ in range(n):
+            column = (column[neighbours] * weights).sum(axis=1)
+        belief[:, j] = column * Em[:, obs[j]]
+        scale[j] = normalize_column(belief[:, j])
+
+    if not smooth:
+        return belief
+
+    beta = np.ones(K)
+    for j in range(T - 2, -1, -1):
+        # The states every state moves to, and the probabilities
+        targets, weights, n = reverse_table(j + 1)
+        beta = Em[:, obs[j+1]] * beta
+        for _ in range(n):
+            beta = (weights * beta[targets]).sum(axis=1)
+        if scale[j+1] > 0:
+            beta /= scale[j+1]
+        belief[:, j] *= beta
+        normalize_column(belief[:, j])
+    return belief
+
+
+@profiled('forward-backward', grid_counts)
+def forward_backward_grid(Y, free, Eg, smooth=True):
+    # forward_backward_sparse as a stencil on the map, like
+    # viterbi_forward_grid; returns (T, *map shape) posteriors
+    shape = free.shape
+    K = np.count_nonzero(free)
+    T = len(Y)
+    obs = np.asarray(Y) - 1
+    inv_degree = inverse_degree_grid(free)
+
+    padded = np.zeros(tuple(n + 2 for n in shape))
+    inner = padded[interior(free.ndim)]
+    views = [neighbour_view(padded, offset) for offset in direction_offsets(free.ndim)]
+
+    def neighbour_sum(out):
+        np.add(views[0], views[1], out=out)
+        for view in views[2:]:
+            out += view
+
+    belief = np.zeros((T,) + shape)
+    scale = np.ones(T)
+    belief[0] = (1 / K) * Eg[obs[0]]
+    scale[0] = normalize_column(belief[0])
+    for j in range(1, T):
+        np.multiply(belief[j-1], inv_degree, out=inner)
+        neighbour_sum(belief[j])
+        belief[j] *= Eg[obs[j]]
+        scale[j] = normalize_column(belief[j])
+
+    if not smooth:
+        return belief
+
+    beta = np.ones(shape)
+    for j in range(T - 2, -1, -1):
+        np.multiply(Eg[obs[j+1]], beta, out=inner)
+        neighbour_sum(beta)
+        beta *= inv_degree
+        if scale[j+1] > 0:
+            beta /= scale[j+1]
+        belief[j] *= beta
+        normalize_column(belief[j])
+    return belief
+
+
+class StreamingLocalizer:
+    # Online localization over the sparse operator: feed one reading per
+    # tick to step() and get the updated column back. Only the current
+    # column (plus `lag` backpointer columns) is kept, so earlier steps are
+    # never revisited.
+    #   mode 'viterbi': max-product column, rescaled to a maximum of 1
+    #   mode 'filter':  forward (sum-product) belief, normalized to sum 1
+    # log_scale accumulates the log of every rescaling factor, so
+    # column * exp(log_scale) is the unscaled trellis column.
+
+    def __init__(self, neighbours, weights, Em, S, mode='viterbi', lag=0):
+        if mode not in ('viterbi', 'filter'):
+            raise ValueError(f"unknown mode {mode!r}")
+        if lag and mode != 'viterbi':
+            raise ValueError("fixed-lag smoothing needs mode='viterbi'")
+        self.neighbours = neighbours
+        self.weights = weights
+        self.Em = Em
+        self.S = S
+        self.mode = mode
+        self.lag = lag
+
+        K = neighbours.shape[0]
+        self.states = np.arange(K)
+        self.column = np.zeros(K)
+        self.candidates = np.empty(neighbours.shape)
+        # backpointers of step j live in row j % lag
+        self.backpointers = np.zeros((lag, K), dtype=direction_dtype(neighbours))
+        self.reset()
+
+    @classmethod
+    def from_map(cls, map_data, error_rate, mode='viterbi', lag=0):
+        return cls.from_index(map_index(map_data), error_rate, mode, lag)
+
+    @classmethod
+    def from_index(cls, index, error_rate, mode='viterbi', lag=0):
+        S = [tuple(coord) for coord in index.coords.tolist()]
+        return cls(index.neighbours, index.weights, index.state_emission(error_rate), S, mode, lag)
+
+    def reset(self):
+        self.t = 0
+        self.log_scale = 0.0
+
+    def step(self, reading):
+        # reading is an NSWE string like '1011', or an index as
+        # binary_to_decimal returns it
+        o = int(reading, 2) if isinstance(reading, str) else reading - 1
+        K = self.column.shape[0]
+
+        if self.t == 0:
+            np.multiply(1 / K, self.Em[:, o], out=self.column)
+        else:
+            np.take(self.column, self.neighbours, out=self.candidates)
+            self.candidates *= self.weights
+            if self.mode == 'filter':
+                self.candidates.sum(axis=1, out=self.column)
+            elif self.lag:
+                direction = self.candidates.argmax(axis=1)
+                self.backpointers[self.t % self.lag] = direction
+                self.column[...] = self.candidates[self.states, direction]
+            else:
+                self.candidates.max(axis=1, out=self.column)
+            self.column *= self.Em[:, o]
+
+        total = self.column.max() if self.mode == 'viterbi' else self.column.sum()
+        if total > 0:
+            self.column /= total
+            self.log_scale += np.log(total)
+        self.t += 1
+        return self.column.copy()
+
+    def smoothed_path(self):
+        # Best path over the last lag+1 steps ending in the current best
+        # state, as coordinates, oldest first. The first entry is the
+        # fixed-lag estimate for step t - 1 - lag.
+        state = int(np.argmax(self.column))
+        path = [state]
+        for j in range(self.t - 1, max(self.t - 1 - self.lag, 0), -1):
+            state = int(self.neighbours[state, self.backpointers[j % self.lag, state]])
+            path.append(state)
+        path.reverse()
+        return [self.S[i] for i in path]
+
+    def as_map(self, rows, cols):
+        # Current column scattered onto a (rows, cols) output map
+        result = np.zeros((rows, cols))
+        for (i, j), p in zip(self.S, self.column):
+            result[i][j] = p
+        return result
+
+
+class Localizer:
+    # Library entry point for long-lived processes: the map's index and
+    # emission table are built once, then any number of reading sequences
+    # are localized against them. A Localizer keeps no per-call state and
+    # its arrays are read-only, so threads can share one.
+    # Readings are NSWE strings like '1011' or indices as binary_to_decimal
+    # returns them; in viterbi, filter and decode_path a None stands for a
+    # missed reading, and the results then cover the other readings only.
+    # space, backend and threads are passed on to viterbi_forward_sparse;
+    # 'log' and 'scaled' do not underflow on long sequences the way 'prob'
+    # does. motion is a MotionModel (default: MotionModel()).
+
+    __slots__ = ('index', 'error_rate', 'space', 'backend', 'threads', 'motion', 'neighbours', 'weights', 'Em',
+                 'EmT', 'S')
+
+    def __init__(self, index, error_rate, space='prob', backend='auto', threads=1, motion=None):
+        if space not in SPACES:
+            raise ValueError(f"unknown space {space!r}")
+        # Checks the backend without loading numba for 'auto'
+        kernels.resolve_backend(backend, 0)
+        self.index = index
+        self.error_rate = float(error_rate)
+        self.space = space
+        self.backend = backend
+        self.threads = threads
+        self.motion = (motion or MotionModel()).compile(index)
+        self.neighbours = self.motion.neighbours
+        self.weights = self.motion.weights
+        self.Em = index.state_emission(self.error_rate)
+        self.Em.setflags(write=False)
+        # (2^bits, K), so EmT[obs] is one (N, K) row per reading
+        self.EmT = np.ascontiguousarray(self.Em.T)
+        self.EmT.setflags(write=False)
+        self.S = [tuple(coord) for coord in index.coords.tolist()]
+
+    @classmethod
+    def from_map(cls, map_data, error_rate, **options):
+        # map_data as parse_input returns it
+        return cls(map_index(map_data), error_rate, **options)
+
+    @classmethod
+    def from_free(cls, free, error_rate, cache_dir=None, **options):
+        # Occupancy grid of any dimension, as parse_input_arrays returns it
+        return cls(load_map_index(free, cache_dir), error_rate, **options)
+
+    @property
+    def shape(self):
+        return self.index.free.shape
+
+    def observations(self, readings):
+        # Readings as a Y array, 1-based like binary_to_decimal
+        bits = 2 * self.index.free.ndim
+        if any(isinstance(r, str) and len(r) != bits for r in readings):
+            raise ValueError(f"readings must be {bits}-bit strings")
+        Y = np.array([int(r, 2) + 1 if isinstance(r, str) else r for r in readings], dtype=np.int64)
+        if len(Y) == 0:
+            raise ValueError("no readings")
+        if Y.min() < 1 or Y.max() > 2 ** bits:
+            raise ValueError(f"reading indices must be 1 to {2 ** bits}")
+        return Y
+
+    def observations_with_gaps(self, readings):
+        # observations of the readings that are not None, and the steps
+        # from each to the one before (see viterbi_forward_gaps). Missed
+        # readings before the first one are ignored.
+        present = [j for j, r in enumerate(readings) if r is not None]
+        Y = self.observations([readings[j] for j in present])
+        gaps = np.diff(present, prepend=present[0] - 1)
+        return Y, gaps
+
+    def viterbi(self, readings, normalize=False):
+        # Max-product scores as (T, *map shape) maps, like the CLI writes
+        Y, gaps = self.observations_with_gaps(readings)
+        if np.all(gaps == 1):
+            trellis = viterbi_forward_sparse(Y, self.neighbours, self.weights, self.Em, self.space,
+                                             backend=self.backend, threads=self.threads)
+        else:
+            trellis = viterbi_forward_gaps(Y, gaps, self.motion, self.Em, self.space, backend=self.backend,
+                                           threads=self.threads)
+        if self.space != 'prob':
+            trellis = probabilities_from_log(trellis, 0, normalize)
+        elif normalize:
+            trellis = normalize_steps(trellis, 0)
+        return maps_from_states(self.index.free, trellis)
+
+    def filter(self, readings, smooth=False):
+        # Forward posteriors (forward-backward with smooth) as (T, *map
+        # shape) maps, every step summing to 1
+        Y, gaps = self.observations_with_gaps(readings)
+        trellis = forward_backward_gaps(Y, gaps, self.motion, self.Em, smooth=smooth)
+        return maps_from_states(self.index.free, trellis)
+
+    def decode_path(self, readings):
+        # Most probable path as one coordinate tuple per reading
+        Y, gaps = self.observations_with_gaps(readings)
+        if np.all(gaps == 1):
+            return decode_path_sparse(Y, self.neighbours, self.weights, self.Em, self.S, backend=self.backend)
+        trellis, backpointers = viterbi_forward_gaps(Y, gaps, self.motion, self.Em, 'log', True, self.backend,
+                                                     self.threads)
+        return [self.S[i] for i in backtrace_gaps(trellis, backpointers, gaps, self.motion, 'log', self.backend)]
+
+    def step_batch(self, columns, readings, first=None, mode='viterbi'):
+        # One StreamingLocalizer.step for N robots at once, as a single
+        # vectorized update. columns is (N, K), each robot's current column;
+        # rows where `first` (an (N,) mask) is set start over from the
+        # uniform prior instead. Returns the new (N, K) columns, rescaled to
+        # a maximum of 1 (mode 'viterbi') or a sum of 1 (mode 'filter'),
+        # and the (N,) log of the factors they were divided by.
+        if mode not in ('viterbi', 'filter'):
+            raise ValueError(f"unknown mode {mode!r}")
+        obs = self.observations(readings) - 1
+        candidates = columns[:, self.neighbours]
+        candidates *= self.weights
+        if mode == 'viterbi':
+            updated = candidates.max(axis=2)
+        else:
+            updated = candidates.sum(axis=2)
+        if first is not None:
+            updated[first] = 1 / self.index.states
+        updated *= self.EmT[obs]
+        total = updated.max(axis=1) if mode == 'viterbi' else updated.sum(axis=1)
+        total = np.where(total > 0, total, 1.0)
+        updated /= total[:, None]
+        return updated, np.log(total)
+
+
+@profiled('output')
+def probabilities_from_log(log_trellis, state_axes, normalize=False):
+    # Turn log scores back into output maps. Without normalize this is just
+    # exp, matching the prob space (and underflowing where it does); with
+    # normalize every step is rescaled to sum to 1 over `state_axes`
+    if not normalize:
+        return np.exp(log_trellis)
+    peak = log_trellis.max(axis=state_axes, keepdims=True)
+    peak = np.where(np.isfinite(peak), peak, 0.0)
+    probabilities = np.exp(log_trellis - peak)
+    return normalize_steps(probabilities, state_axes)
+
+
+@profiled('output')
+def normalize_steps(trellis, state_axes):
+    # Scale every step so its probabilities sum to 1; all-zero steps stay 0
+    total = trellis.sum(axis=state_axes, keepdims=True)
+    return trellis / np.where(total > 0, total, 1.0)
+
+
+@profiled('prepare_output', output_counts)
 def prepare_output(rows, cols, mapdata, trellis):
-    map_size = [rows,cols]
-    result = [np.zeros(map_size) for i in range(len(Y))]
-    S = state_space(mapdata)
-    transposed_trellis = np.transpose(trellis)
-    for t, prob in enumerate(transposed_trellis):
-        for index, p in enumerate(prob):
-            i,j = S[index]
-            result[t][i][j] = p
+    # One (rows, cols) map per step, each state's score at its cell
+    result = np.zeros((trellis.shape[1], rows * cols))
+    result[:, map_index(mapdata).cells] = trellis.T
+    return list(result.reshape(-1, rows, cols))
+
+
+
+@profiled('prepare_output', output_counts)
+def maps_from_states(free, trellis):
+    # prepare_output for an occupancy grid of any dimension: scatter a
+    # (K, T) trellis onto T maps of the grid's shape
+    result = np.zeros((trellis.shape[1],) + free.shape)
+    result[:, free] = trellis.T
     return result
 
-    
 
+@profiled('read')
 def read_input_from_file(file_name):
     with open(file_name, 'r') as file:
         input_str = file.read()
     return input_str
 
 
+def localize_batch(input_files, space='prob', normalize=False, motion=None, cache_dir=None):
+    # Run several input files that share one map and error rate through
+    # viterbi_forward_batch, with MotionModel `motion` (default: the
+    # model of transmission_matrix). Maps of any dimension, as
+    # parse_input_arrays reads them; cache_dir is load_map_index's.
+    # Returns the shared occupancy grid and one (K, T) trellis over its
+    # free cells per file, for trellis_writer to turn into maps step by
+    # step.
+    parsed = []
+    for name in input_files:
+        try:
+            parsed.append(parse_input_arrays(read_input_from_file(name)))
+        except ValueError as e:
+            raise ValueError(f"{name}: {e}") from None
+    free, _, error_rate = parsed[0]
+    for name, (other_free, _, other_rate) in zip(input_files, parsed):
+        if other_free.shape != free.shape or not np.array_equal(other_free, free) or other_rate != error_rate:
+            raise ValueError(f"{name}: batch inputs must share the map and error rate of {input_files[0]}")
+
+    sequences = [observations.astype(np.int64) + 1 for _, observations, _ in parsed]
+    index = load_map_index(free, cache_dir)
+    if motion is None:
+        neighbours, weights = index.neighbours, index.weights
+    else:
+        operator = motion.compile(index)
+        neighbours, weights = operator.neighbours, operator.weights
+    Em = index.state_emission(error_rate)
+    results = []
+    for trellis in viterbi_forward_batch(sequences, neighbours, weights, Em, space):
+        if space != 'prob':
+            trellis = probabilities_from_log(trellis, 0, normalize)
+        elif normalize:
+            trellis = normalize_steps(trellis, 0)
+        results.append(trellis)
+    return free, results
+
+
 if __name__ == "__main__":
-    # Get input file name from command-line argument
-    if len(sys.argv) != 2:
-        print("Usage: python file.py [inputfile]")
-        sys.exit(1)
-    
-    input_file = sys.argv[1]
+    parser = argparse.ArgumentParser(usage="python viterbi.py [inputfile] [more inputfiles on the same map...]")
+    parser.add_argument('input_files', nargs='+',
+                        help="one input writes output.npz; several inputs sharing a map are "
+                             "run as one batch and write output_<input>.npz each")
+    parser.add_argument('--engine', choices=['grid', 'sparse', 'dense'], default='grid',
+                        help="grid: stencil on the map, sparse: (K, 2D) neighbour table, "
+                             "dense: K x K transition matrix (2D maps only)")
+    parser.add_argument('--space', choices=SPACES, default='prob',
+                        help="prob: raw probabilities, log: max-sum in log space, "
+                             "scaled: max-product rescaled every step (grid and sparse engines)")
+    parser.add_argument('--normalize', action='store_true',
+                        help="scale every output map to sum to 1")
+    parser.add_argument('--path', action='store_true',
+                        help="also print the most probable path, one 'x y' (or 'x y z') per step")
+    parser.add_argument('--mode', choices=['viterbi', 'filter', 'smooth'], default='viterbi',
+                        help="viterbi: max-product scores, filter: forward posteriors, "
+                             "smooth: forward-backward posteriors (grid and sparse engines)")
+    parser.add_argument('--backend', choices=kernels.BACKENDS, default='auto',
+                        help="sparse Viterbi kernels: numba (compiled, needs numba installed), "
+                             "numpy, or auto: numba when it is installed and the run is large enough to "
+                             "repay loading it")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="split every sparse Viterbi step over this many threads (0: one per core)")
+    parser.add_argument('--beam', type=int, metavar='B',
+                        help="approximate Viterbi keeping only the B best states per step (log scores)")
+    parser.add_argument('--margin', type=float, metavar='M',
+                        help="approximate Viterbi dropping states more than M below the step's best "
+                             "log score; with --beam, both limits apply")
+    parser.add_argument('--last-step', action='store_true',
+                        help="only compute and write the map of the last reading, in memory that does "
+                             "not grow with the number of readings")
+    parser.add_argument('--stay', type=float, default=0.0,
+                        help="probability that the robot stands still between readings (sparse engine)")
+    parser.add_argument('--bias', type=float, nargs='+', metavar='W',
+                        help="relative weight of every move direction, in reading bit order "
+                             "(N S W E, then up down; sparse engine)")
+    parser.add_argument('--moves', type=int, default=1,
+                        help="cells the robot moves between two readings (sparse engine)")
+    parser.add_argument('--profile', action='store_true',
+                        help="print the time, states and steps of every stage to stderr")
+    parser.add_argument('--profile-memory', action='store_true',
+                        help="like --profile, and also trace allocations (slower)")
+    parser.add_argument('--index-cache', metavar='DIR',
+                        help="keep the map's precomputed index in DIR, keyed by the map's content "
+                             "hash, and reuse it on later runs (grid and sparse engines)")
+    parser.add_argument('--output', default='output.npz', help="output file for a single input")
+    parser.add_argument('--output-mode', choices=trellis_writer.OUTPUT_MODES, default='dense',
+                        help="dense: one full map per step (arr_0, arr_1, ...), states: float32 "
+                             "(T, K) over free cells, topk: the --top-k best cells per step, "
+                             "threshold: cells holding at least --threshold of their step's "
+                             "probability")
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--threshold', type=float, default=1e-6)
+    parser.add_argument('--compress', action=argparse.BooleanOptionalAction,
+                        help="deflate the archive (default: on for every mode except dense)")
+    args = parser.parse_args()
+    output_options = {'k': args.top_k, 'threshold': args.threshold, 'compress': args.compress}
+    report = None
+    if args.profile or args.profile_memory:
+        report = profiling.ProfileReport()
+        profiling.subscribe(report, memory=args.profile_memory)
+    if args.engine == 'dense' and (args.space != 'prob' or args.path or args.mode != 'viterbi'):
+        parser.error("the dense engine only supports --space prob and --mode viterbi without --path")
+    if args.engine == 'dense':
+        try:
+            shape = parse_map_shape(read_input_from_file(args.input_files[0]))
+        except ValueError as e:
+            parser.error(f"{args.input_files[0]}: {e}")
+        if len(shape) != 2:
+            parser.error(f"the dense engine only supports 2D maps, {args.input_files[0]} is {len(shape)}D")
+    if args.mode != 'viterbi' and args.path:
+        parser.error("--path needs --mode viterbi")
+    try:
+        # Only checks the choice; with no work yet, 'auto' does not load numba
+        kernels.resolve_backend(args.backend, 0)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        motion_model = MotionModel(args.stay, args.bias, args.moves)
+    except ValueError as e:
+        parser.error(str(e))
+    if (args.stay or args.bias or args.moves != 1) and args.engine != 'sparse':
+        parser.error("--stay, --bias and --moves need --engine sparse")
+    beam_search = args.beam is not None or args.margin is not None
+    if args.last_step and (args.engine != 'sparse' or args.mode != 'viterbi' or beam_search):
+        parser.error("--last-step needs --engine sparse and --mode viterbi, without --beam or --margin")
+    if beam_search and (args.engine != 'sparse' or args.mode != 'viterbi'):
+        parser.error("--beam and --margin need --engine sparse and --mode viterbi")
+
+    if len(args.input_files) > 1:
+        if args.engine == 'dense' or args.mode != 'viterbi' or args.path:
+            parser.error("batches run the sparse Viterbi engine without --path")
+        try:
+            free, batch_results = localize_batch(args.input_files, args.space, args.normalize, motion_model,
+                                                 args.index_cache)
+        except ValueError as e:
+            parser.error(str(e))
+        for input_file, trellis in zip(args.input_files, batch_results):
+            trellis_writer.write_trellis(f"output_{os.path.basename(input_file)}.npz", free, trellis.T,
+                                         args.output_mode, **output_options)
+        if report:
+            report.print_report()
+        sys.exit(0)
 
     # Read content from file
-    input_str = read_input_from_file(input_file)
+    input_str = read_input_from_file(args.input_files[0])
 
-    # print(parse_input(input_str))
-    rows, columns, map_data, no_of_observations, observation_list, error_rate = parse_input(input_str)
-    # print(observation_space(4))
-    # print(state_space(map_data))
+    if args.engine != 'dense':
+        try:
+            free, observations, error_rate = parse_input_arrays(input_str)
+        except ValueError as e:
+            parser.error(f"{args.input_files[0]}: {e}")
+        Y = observations.astype(np.int64) + 1
+        map_axes = tuple(range(1, free.ndim + 1))
+        index = load_map_index(free, args.index_cache)
 
-    Em = emission_matrix(map_data,float(error_rate))
-    Tm = transmission_matrix(map_data, columns)
-    # print(Em,Tm)
-    Y = binary_to_decimal(observation_list)
-    # print(Y)
+    # Paths are decoded from log scores: in the prob space long inputs
+    # underflow to all zeros, and every argmax then picks direction 0
+    space = 'log' if args.path and args.space == 'prob' else args.space
 
+    if args.engine == 'grid':
+        Eg = index.grid_emission(error_rate)
+        if args.mode != 'viterbi':
+            final_result = forward_backward_grid(Y, free, Eg, smooth=args.mode == 'smooth')
+            if args.normalize:
+                final_result = normalize_steps(final_result, map_axes)
+        else:
+            # Every step goes to the writer as soon as the engine has it, so
+            # the (T, *map shape) trellis is never held
+            step_axes = tuple(range(free.ndim))
 
-    trellis = viterbi_forward(map_data, Y, Tm, Em)
-    # print(trellis)
+            def write_step(step):
+                if space != 'prob':
+                    step = probabilities_from_log(step, step_axes, args.normalize)
+                elif args.normalize:
+                    step = normalize_steps(step, step_axes)
+                with profiling.stage('write', states=index.states, steps=1):
+                    writer.write_step(step)
 
-    final_result = prepare_output(rows, columns, map_data, trellis)
+            writer = trellis_writer.TrellisWriter(args.output, free, len(Y), args.output_mode, **output_options)
+            last_step = viterbi_forward_grid(Y, free, Eg, space, return_backpointers=args.path,
+                                             on_step=write_step)
+            with profiling.stage('write', states=index.states, steps=len(Y)):
+                writer.close()
+            if args.path:
+                try:
+                    path = backtrace_grid(*last_step)
+                except ValueError as e:
+                    parser.error(f"{args.input_files[0]}: {e}")
+            final_result = None
+    elif args.engine == 'sparse':
+        try:
+            motion = motion_model.compile(index)
+        except ValueError as e:
+            parser.error(str(e))
+        neighbours, weights = motion.neighbours, motion.weights
+        Em = index.state_emission(error_rate)
+        if args.mode != 'viterbi':
+            trellis = forward_backward_sparse(Y, neighbours, weights, Em, smooth=args.mode == 'smooth')
+        elif beam_search:
+            states, scores, directions, stats = viterbi_forward_beam(Y, neighbours, weights, Em,
+                                                                     args.margin, args.beam)
+            print(f"beam: pruned {stats['pruning_ratio']:.1%} of the trellis, "
+                  f"{stats['mean_active']:.0f} states per step, best log score {stats['best']:.4f}, "
+                  f"error bound {stats['error_bound']:.4f}" + (" (exact)" if stats['exact'] else ""),
+                  file=sys.stderr)
+            trellis = beam_trellis(states, scores, index.states)
+            if args.path:
+                trellis = trellis, None
+        elif args.last_step:
+            # (K, 1) trellis in O(K) memory; the path comes from checkpoints
+            trellis = viterbi_last_column_sparse(Y, neighbours, weights, Em, space,
+                                                 backend=args.backend)[:, None]
+            if args.path:
+                try:
+                    path = decode_path_sparse_checkpointed(Y, neighbours, weights, Em, index.coords,
+                                                           backend=args.backend)
+                except ValueError as e:
+                    parser.error(f"{args.input_files[0]}: {e}")
+        else:
+            trellis = viterbi_forward_sparse(Y, neighbours, weights, Em, space,
+                                             return_backpointers=args.path, backend=args.backend,
+                                             threads=args.threads or None)
+        if args.path and not args.last_step:
+            trellis, backpointers = trellis
+            try:
+                if beam_search:
+                    path = backtrace_beam(states, scores, directions, neighbours)
+                else:
+                    path = backtrace_sparse(trellis[:, -1], backpointers, neighbours, backend=args.backend)
+            except ValueError as e:
+                parser.error(f"{args.input_files[0]}: {e}")
+            path = [tuple(index.coords[i]) for i in path]
+        elif args.path:
+            path = [tuple(cell) for cell in path]
+        if (space != 'prob' or beam_search) and args.mode == 'viterbi':
+            trellis = probabilities_from_log(trellis, 0, args.normalize)
+        elif args.normalize:
+            trellis = normalize_steps(trellis, 0)
+        # Columns over the free cells go straight to the writer
+        final_result = trellis.T
+    else:
+        # print(parse_input(input_str))
+        rows, columns, map_data, no_of_observations, observation_list, error_rate = parse_input(input_str)
+        # print(observation_space(4))
+        # print(state_space(map_data))
+
+        Y = binary_to_decimal(observation_list)
+        # print(Y)
+
+        Em = emission_matrix(map_data,float(error_rate))
+        Tm = transmission_matrix(map_data, columns)
+        trellis = viterbi_forward_vectorized(Y, Tm, Em)
+        # print(trellis)
+        if args.normalize:
+            trellis = normalize_steps(trellis, 0)
+
+        free = free_grid(map_data)
+        final_result = trellis.T
 
 
     # print(final_result)
-    np.savez("output.npz", *final_result)
+    if final_result is not None:
+        trellis_writer.write_trellis(args.output, free, final_result, args.output_mode, **output_options)
+
+    if args.path:
+        for cell in path:
+            print(*(int(c) for c in cell))
+    if report:
+        report.print_report()